@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+"""
+In-process LRU cache with TTL expiry.
+
+Entries keep an optional ETag so stale entries can be revalidated with a
+conditional request instead of being fetched again.
+"""
+
+CacheEntry = namedtuple("CacheEntry", ["value", "etag", "expires_at"])
+
+
+class LRUCache:
+    def __init__(self, max_size=256, ttl=60):
+        """
+        :param max_size: Maximum number of entries kept
+        :param ttl: Seconds an entry stays fresh, None to never expire
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def _expires_at(self):
+        if self.ttl is None:
+            return None
+        return time.monotonic() + self.ttl
+
+    def is_fresh(self, entry):
+        return entry.expires_at is None or entry.expires_at > time.monotonic()
+
+    def get_entry(self, key):
+        """
+        Get the entry stored for a key, fresh or stale
+
+        :param key: Cache key
+        :return: CacheEntry or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def get(self, key, default=None):
+        """
+        Get a fresh value and record a hit or a miss
+
+        :param key: Cache key
+        :param default: Value returned on a miss
+        :return: Cached value or default
+        """
+        entry = self.get_entry(key)
+        if entry is not None and self.is_fresh(entry):
+            self.record_hit()
+            return entry.value
+        self.record_miss()
+        return default
+
+    def set(self, key, value, etag=None):
+        with self._lock:
+            self._entries[key] = CacheEntry(value, etag, self._expires_at())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def touch(self, key):
+        """
+        Mark a stale entry as fresh again after a successful revalidation
+
+        :param key: Cache key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = entry._replace(expires_at=self._expires_at())
+                self.revalidations += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self):
+        """
+        :return: Dictionary with hit, miss, revalidation and eviction counters
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+            }
@@ -0,0 +1,157 @@
+import threading
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+"""
+Shared boto3 client/resource registry.
+
+Creating a boto3 client resolves credentials and builds a new HTTP connection
+pool, so every aws_io helper reuses one client per (service, region) instead.
+Clients are created lazily and are safe to share between threads.
+"""
+
+# default client configuration
+MAX_POOL_CONNECTIONS = 50
+RETRY_MODE = "standard"
+MAX_ATTEMPTS = 5
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+
+# default S3 multipart transfer configuration
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MAX_TRANSFER_CONCURRENCY = 10
+
+_config_kwargs = {
+    "max_pool_connections": MAX_POOL_CONNECTIONS,
+    "retries": {"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+    "connect_timeout": CONNECT_TIMEOUT,
+    "read_timeout": READ_TIMEOUT,
+}
+_clients = {}
+_resources = {}
+_lock = threading.Lock()
+
+# Keep references to the real factories so patched boto3 functions
+# (see luzidos_utils.testing.mock.boto3) bypass the registry.
+_BOTO3_CLIENT = boto3.client
+_BOTO3_RESOURCE = boto3.resource
+
+
+def configure(max_pool_connections=None, retry_mode=None, max_attempts=None, connect_timeout=None, read_timeout=None):
+    """
+    Update the configuration used for new clients and drop cached ones
+
+    :param max_pool_connections: Maximum HTTP connections kept per client
+    :param retry_mode: botocore retry mode ("legacy", "standard" or "adaptive")
+    :param max_attempts: Maximum attempts per request, including the first one
+    :param connect_timeout: Connection timeout in seconds
+    :param read_timeout: Read timeout in seconds
+    """
+    with _lock:
+        if max_pool_connections is not None:
+            _config_kwargs["max_pool_connections"] = max_pool_connections
+        if retry_mode is not None:
+            _config_kwargs["retries"]["mode"] = retry_mode
+        if max_attempts is not None:
+            _config_kwargs["retries"]["max_attempts"] = max_attempts
+        if connect_timeout is not None:
+            _config_kwargs["connect_timeout"] = connect_timeout
+        if read_timeout is not None:
+            _config_kwargs["read_timeout"] = read_timeout
+        _clients.clear()
+        _resources.clear()
+
+
+def get_config(**overrides):
+    """
+    Build a botocore Config from the registry settings
+
+    :param overrides: Config keyword arguments that take precedence
+    :return: botocore Config
+    """
+    config_kwargs = dict(_config_kwargs)
+    config_kwargs["retries"] = dict(_config_kwargs["retries"])
+    config_kwargs.update(overrides)
+    return Config(**config_kwargs)
+
+
+def get_transfer_config(part_size=None, max_concurrency=None):
+    """
+    Build the S3 multipart transfer configuration
+
+    :param part_size: Multipart part size in bytes, also used as the multipart threshold
+    :param max_concurrency: Maximum number of parts transferred concurrently
+    :return: boto3 TransferConfig
+    """
+    if part_size is None:
+        threshold, chunksize = MULTIPART_THRESHOLD, MULTIPART_CHUNKSIZE
+    else:
+        threshold, chunksize = part_size, part_size
+    return TransferConfig(
+        multipart_threshold=threshold,
+        multipart_chunksize=chunksize,
+        max_concurrency=max_concurrency or MAX_TRANSFER_CONCURRENCY,
+    )
+
+
+def get_client(service_name, region_name=None):
+    """
+    Get the shared boto3 client for a service and region
+
+    :param service_name: AWS service name, e.g. 's3'
+    :param region_name: AWS region, None for the default region
+    :return: boto3 client
+    """
+    if boto3.client is not _BOTO3_CLIENT:
+        return boto3.client(service_name, **_region_kwargs(region_name))
+
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service_name, config=get_config(), **_region_kwargs(region_name))
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name, region_name=None):
+    """
+    Get the shared boto3 resource for a service and region
+
+    boto3 resources are not thread-safe, so one resource is kept per thread.
+
+    :param service_name: AWS service name, e.g. 'dynamodb'
+    :param region_name: AWS region, None for the default region
+    :return: boto3 resource
+    """
+    if boto3.resource is not _BOTO3_RESOURCE:
+        return boto3.resource(service_name, **_region_kwargs(region_name))
+
+    key = (service_name, region_name, threading.get_ident())
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = boto3.resource(service_name, config=get_config(), **_region_kwargs(region_name))
+                _resources[key] = resource
+    return resource
+
+
+def clear_clients():
+    """
+    Drop all cached clients and resources
+    """
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+
+
+def _region_kwargs(region_name):
+    if region_name is None:
+        return {}
+    return {"region_name": region_name}
@@ -1,12 +1,29 @@
-import boto3
+import random
+import time
+from luzidos_utils.aws_io import clients
+from luzidos_utils.aws_io.cache import LRUCache
+from luzidos_utils.constants.aws import REGION_NAME
 from botocore.exceptions import ClientError
 
+EMAIL_TO_USER_ID_TABLE = 'emailToUserId'
+BATCH_GET_LIMIT = 100
+BATCH_RETRIES = 5
+BATCH_BACKOFF = 0.1
+USER_ID_CACHE_TTL = 300
+
+# email -> user id lookups rarely change, keep them for a few minutes
+_user_id_cache = LRUCache(max_size=1024, ttl=USER_ID_CACHE_TTL)
+
 def get_user_from_db(email):
+    user_id = _user_id_cache.get(email)
+    if user_id is not None:
+        return user_id
+
     # Initialize a session using Amazon DynamoDB
-    dynamodb = boto3.resource('dynamodb', region_name='us-west-2')
+    dynamodb = clients.get_resource('dynamodb', region_name=REGION_NAME)
 
     # Select your table
-    table = dynamodb.Table('emailToUserId')
+    table = dynamodb.Table(EMAIL_TO_USER_ID_TABLE)
 
     # Get the item from the table
     try:
@@ -16,12 +33,79 @@ def get_user_from_db(email):
             }
         )
         if 'Item' in response:
-            return response['Item'].get('value')
+            user_id = response['Item'].get('value')
+            if user_id is not None:
+                _user_id_cache.set(email, user_id)
+            return user_id
         else:
             print(f"No item found with email: {email}")
             return None
     except ClientError as e:
         print(e.response['Error']['Message'])
         return None
-    
 
+def batch_get_users_from_db(emails, retries=BATCH_RETRIES, backoff_factor=BATCH_BACKOFF):
+    """
+    Get the user ids of many emails with BatchGetItem
+
+    Emails are requested 100 at a time. Unprocessed keys are retried with
+    jittered exponential backoff.
+
+    :param emails: List of emails
+    :param retries: Number of retries for unprocessed keys
+    :param backoff_factor: Base delay in seconds between retries
+    :return: Dictionary of email to user id, None for unknown emails
+    """
+    emails = list(dict.fromkeys(emails))
+    users = {}
+    missing_emails = []
+    for email in emails:
+        user_id = _user_id_cache.get(email)
+        if user_id is None:
+            missing_emails.append(email)
+        else:
+            users[email] = user_id
+
+    dynamodb = clients.get_resource('dynamodb', region_name=REGION_NAME)
+    for i in range(0, len(missing_emails), BATCH_GET_LIMIT):
+        chunk = missing_emails[i:i + BATCH_GET_LIMIT]
+        request_items = {EMAIL_TO_USER_ID_TABLE: {'Keys': [{'email': email} for email in chunk]}}
+        for attempt in range(retries + 1):
+            try:
+                response = dynamodb.batch_get_item(RequestItems=request_items)
+            except ClientError as e:
+                print(e.response['Error']['Message'])
+                break
+            for item in response.get('Responses', {}).get(EMAIL_TO_USER_ID_TABLE, []):
+                users[item['email']] = item.get('value')
+                if item.get('value') is not None:
+                    _user_id_cache.set(item['email'], item['value'])
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+            if attempt < retries:
+                time.sleep(backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5))
+        else:
+            print(f"Unprocessed keys left after {retries} retries: {request_items}")
+
+    for email in emails:
+        users.setdefault(email, None)
+    return users
+
+def cache_user_id(email, user_id):
+    """
+    Store the user id of an email after it was written to the table
+    """
+    _user_id_cache.set(email, user_id)
+
+def invalidate_user_cache(email):
+    """
+    Drop the cached user id of an email
+    """
+    _user_id_cache.invalidate(email)
+
+def clear_user_cache():
+    """
+    Drop cached email to user id lookups
+    """
+    _user_id_cache.clear()
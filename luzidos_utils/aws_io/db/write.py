@@ -1,7 +1,16 @@
 import requests
-import boto3
+import random
+import time
+from luzidos_utils.aws_io import clients
+from luzidos_utils.aws_io.db import read as db_read
+from luzidos_utils.aws_io.s3 import write as s3_write
 from botocore.exceptions import ClientError
 
+INVOICE_TABLE = 'invoiceTable-staging'
+EMAIL_TO_USER_ID_TABLE = 'emailToUserId'
+BATCH_WRITE_LIMIT = 25
+BATCH_RETRIES = 5
+BATCH_BACKOFF = 0.1
 
 def add_invoice(user_id, invoice_id, vendor_name, transaction_items, transaction_total, transaction_datetime, transaction_status):
     """
@@ -15,10 +24,10 @@ def add_invoice(user_id, invoice_id, vendor_name, transaction_items, transaction
     """
 
     # Initialize a session using Amazon DynamoDB
-    dynamodb = boto3.resource('dynamodb')
+    dynamodb = clients.get_resource('dynamodb')
 
     # Select your table
-    table = dynamodb.Table('invoiceTable-staging')
+    table = dynamodb.Table(INVOICE_TABLE)
 
     # Put the item into the table
     try:
@@ -41,10 +50,10 @@ def add_invoice(user_id, invoice_id, vendor_name, transaction_items, transaction
 
 def update_invoice_status(user_id, invoice_id, status):
     # Initialize a session using Amazon DynamoDB
-    dynamodb = boto3.resource('dynamodb')
+    dynamodb = clients.get_resource('dynamodb')
 
     # Select your table
-    table = dynamodb.Table('invoiceTable-staging')
+    table = dynamodb.Table(INVOICE_TABLE)
 
     # Update the item in the table
     try:
@@ -59,6 +68,7 @@ def update_invoice_status(user_id, invoice_id, status):
             },
             ReturnValues="UPDATED_NEW"
         )
+        s3_write.update_invoice_index(user_id, invoice_id, transaction_status=status)
         return response
     except ClientError as e:
         print(e.response['Error']['Message'])
@@ -68,10 +78,10 @@ def update_invoice_status(user_id, invoice_id, status):
 
 def add_email_and_user_to_db(email, value):
     # Initialize a session using Amazon DynamoDB
-    dynamodb = boto3.resource('dynamodb')
+    dynamodb = clients.get_resource('dynamodb')
 
     # Select your table
-    table = dynamodb.Table('emailToUserId')
+    table = dynamodb.Table(EMAIL_TO_USER_ID_TABLE)
 
     # Put the item into the table
     try:
@@ -81,11 +91,92 @@ def add_email_and_user_to_db(email, value):
                 'value': value
             }
         )
+        db_read.cache_user_id(email, value)
         return response
     except ClientError as e:
         print(e.response['Error']['Message'])
+        # the write may have gone through, the next lookup reads the table
+        db_read.invalidate_user_cache(email)
         return None
 
+def _batch_write_items(table_name, items, key_names, retries=BATCH_RETRIES, backoff_factor=BATCH_BACKOFF):
+    """
+    Put many items into a table with BatchWriteItem
+
+    Items are written 25 at a time. Unprocessed items are retried with
+    jittered exponential backoff. BatchWriteItem rejects requests with
+    duplicate keys, so only the last item with each key is written.
+
+    :param table_name: Name of the table
+    :param items: List of items
+    :param key_names: Names of the table's key attributes
+    :return: True if all items were written, else False
+    """
+    items = list({tuple(item[key_name] for key_name in key_names): item for item in items}.values())
+    dynamodb = clients.get_resource('dynamodb')
+    status = True
+    for i in range(0, len(items), BATCH_WRITE_LIMIT):
+        request_items = {table_name: [{'PutRequest': {'Item': item}} for item in items[i:i + BATCH_WRITE_LIMIT]]}
+        for attempt in range(retries + 1):
+            try:
+                response = dynamodb.batch_write_item(RequestItems=request_items)
+            except ClientError as e:
+                print(e.response['Error']['Message'])
+                status = False
+                break
+            request_items = response.get('UnprocessedItems')
+            if not request_items:
+                break
+            if attempt < retries:
+                time.sleep(backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5))
+        else:
+            print(f"Unprocessed items left after {retries} retries in {table_name}")
+            status = False
+    return status
+
+def batch_add_invoices(invoices):
+    """
+    Add many invoices with BatchWriteItem
+
+    :param invoices: List of dictionaries with the add_invoice arguments as keys:
+        user_id, invoice_id, vendor_name, transaction_items, transaction_total,
+        transaction_datetime and transaction_status
+    :return: True if all invoices were written, else False
+    """
+    items = [
+        {
+            "userID": invoice["user_id"],
+            "invoiceID": invoice["invoice_id"],
+            "vendorName": invoice["vendor_name"],
+            "transactionItems": invoice["transaction_items"],
+            "transactionTotal": invoice["transaction_total"],
+            "transactionDatetime": invoice["transaction_datetime"],
+            "transactionStatus": invoice["transaction_status"],
+        }
+        for invoice in invoices
+    ]
+    status = _batch_write_items(INVOICE_TABLE, items, ["userID", "invoiceID"])
+    if not status:
+        print("Error in batch add Invoices to DB execution.")
+    return status
+
+def batch_add_emails_and_users_to_db(email_to_user):
+    """
+    Add many email to user id mappings with BatchWriteItem
+
+    :param email_to_user: Dictionary of email to user id
+    :return: True if all mappings were written, else False
+    """
+    items = [{'email': email, 'value': value} for email, value in email_to_user.items()]
+    status = _batch_write_items(EMAIL_TO_USER_ID_TABLE, items, ["email"])
+    for email, value in email_to_user.items():
+        if status:
+            db_read.cache_user_id(email, value)
+        else:
+            # unknown which mappings were written
+            db_read.invalidate_user_cache(email)
+    return status
+
 if __name__ == "__main__":
     #update_invoice_status("927aa041-e5ba-4acf-ab0e-19a1c629bee9", "Test", "Incomplete!")
     add_invoice(
@@ -0,0 +1,151 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from luzidos_utils.aws_io.s3 import read as s3_read
+from luzidos_utils.aws_io.s3 import write as s3_write
+
+"""
+Asyncio variant of luzidos_utils.aws_io.s3.read and write.
+
+Every coroutine runs the matching blocking function on a shared thread pool,
+so one event loop can keep many S3 requests in flight. The blocking function
+is looked up when the coroutine is called, which keeps patched functions
+(see luzidos_utils.testing.mock.s3) working.
+"""
+
+MAX_WORKERS = 64
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def set_max_workers(max_workers):
+    """
+    Replace the shared executor with one of the given size
+
+    :param max_workers: Maximum number of concurrent blocking S3 calls
+    """
+    global _executor
+    with _executor_lock:
+        old_executor = _executor
+        _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3-aio")
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="s3-aio")
+    return _executor
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    Run a blocking function on the shared S3 executor
+
+    :param func: Blocking function
+    :return: Function result
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _bridge(module, name):
+    async def coroutine(*args, **kwargs):
+        return await run_in_executor(getattr(module, name), *args, **kwargs)
+    coroutine.__name__ = name
+    coroutine.__qualname__ = name
+    coroutine.__doc__ = getattr(module, name).__doc__
+    return coroutine
+
+
+"""
+READ UTILS
+"""
+read_file_from_s3 = _bridge(s3_read, "read_file_from_s3")
+file_exists_in_s3 = _bridge(s3_read, "file_exists_in_s3")
+read_json_from_s3 = _bridge(s3_read, "read_json_from_s3")
+download_file_from_s3 = _bridge(s3_read, "download_file_from_s3")
+download_file_obj_from_s3 = _bridge(s3_read, "download_file_obj_from_s3")
+read_dir_filenames_from_s3 = _bridge(s3_read, "read_dir_filenames_from_s3")
+list_childdirectories = _bridge(s3_read, "list_childdirectories")
+list_childdirectories_sharded = _bridge(s3_read, "list_childdirectories_sharded")
+read_invoice_data_from_s3 = _bridge(s3_read, "read_invoice_data_from_s3")
+read_invoice_state_from_s3 = _bridge(s3_read, "read_invoice_state_from_s3")
+read_transaction_data_from_s3 = _bridge(s3_read, "read_transaction_data_from_s3")
+read_einvoice_data_from_s3 = _bridge(s3_read, "read_einvoice_data_from_s3")
+read_email_body_from_s3 = _bridge(s3_read, "read_email_body_from_s3")
+read_email_attachments_from_s3 = _bridge(s3_read, "read_email_attachments_from_s3")
+read_email_attachment_data_from_s3 = _bridge(s3_read, "read_email_attachment_data_from_s3")
+read_attachment_cache_from_s3 = _bridge(s3_read, "read_attachment_cache_from_s3")
+read_email_from_s3 = _bridge(s3_read, "read_email_from_s3")
+read_user_data_from_s3 = _bridge(s3_read, "read_user_data_from_s3")
+read_many_user_data_from_s3 = _bridge(s3_read, "read_many_user_data_from_s3")
+get_user_email = _bridge(s3_read, "get_user_email")
+is_agent_locked = _bridge(s3_read, "is_agent_locked")
+get_open_agent_processes = _bridge(s3_read, "get_open_agent_processes")
+read_invoice_index_from_s3 = _bridge(s3_read, "read_invoice_index_from_s3")
+query_invoice_index = _bridge(s3_read, "query_invoice_index")
+read_email_credentials_from_s3 = _bridge(s3_read, "read_email_credentials_from_s3")
+read_email_token_from_s3 = _bridge(s3_read, "read_email_token_from_s3")
+read_gmail_sync_state_from_s3 = _bridge(s3_read, "read_gmail_sync_state_from_s3")
+read_agent_processes_from_s3 = _bridge(s3_read, "read_agent_processes_from_s3")
+read_state_log_from_s3 = _bridge(s3_read, "read_state_log_from_s3")
+read_state_log_tail_from_s3 = _bridge(s3_read, "read_state_log_tail_from_s3")
+get_all_users = _bridge(s3_read, "get_all_users")
+
+
+async def read_many_json_from_s3(objects):
+    """
+    Read many json files from S3 concurrently
+
+    :param objects: List of (bucket_name, object_name) tuples
+    :return: List of S3ReadResult, in the same order as objects
+    """
+    return await asyncio.gather(*[
+        run_in_executor(s3_read._read_json_result, bucket_name, object_name)
+        for bucket_name, object_name in objects
+    ])
+
+
+"""
+WRITE UTILS
+"""
+upload_file_to_s3 = _bridge(s3_write, "upload_file_to_s3")
+upload_file_obj_to_s3 = _bridge(s3_write, "upload_file_obj_to_s3")
+upload_email_attachment_to_s3 = _bridge(s3_write, "upload_email_attachment_to_s3")
+upload_email_attachment_json_to_s3 = _bridge(s3_write, "upload_email_attachment_json_to_s3")
+upload_attachment_cache_to_s3 = _bridge(s3_write, "upload_attachment_cache_to_s3")
+upload_email_body_to_s3 = _bridge(s3_write, "upload_email_body_to_s3")
+upload_dict_as_json_to_s3 = _bridge(s3_write, "upload_dict_as_json_to_s3")
+upload_dict_as_json_to_s3_if_match = _bridge(s3_write, "upload_dict_as_json_to_s3_if_match")
+atomic_update_json = _bridge(s3_write, "atomic_update_json")
+upload_invoice_data_to_s3 = _bridge(s3_write, "upload_invoice_data_to_s3")
+update_invoice_data_in_s3 = _bridge(s3_write, "update_invoice_data_in_s3")
+update_invoice_state_in_s3 = _bridge(s3_write, "update_invoice_state_in_s3")
+update_invoice_state_field_in_s3 = _bridge(s3_write, "update_invoice_state_field_in_s3")
+update_invoice_state_fields_in_s3 = _bridge(s3_write, "update_invoice_state_fields_in_s3")
+update_invoice_contact_in_s3 = _bridge(s3_write, "update_invoice_contact_in_s3")
+upload_invoice_file_to_s3 = _bridge(s3_write, "upload_invoice_file_to_s3")
+copy_file = _bridge(s3_write, "copy_file")
+delete_file_from_s3 = _bridge(s3_write, "delete_file_from_s3")
+delete_files_from_s3 = _bridge(s3_write, "delete_files_from_s3")
+copy_einvoice_to_invoice_dir = _bridge(s3_write, "copy_einvoice_to_invoice_dir")
+lock_agent = _bridge(s3_write, "lock_agent")
+unlock_agent = _bridge(s3_write, "unlock_agent")
+log_state = _bridge(s3_write, "log_state")
+compact_state_log = _bridge(s3_write, "compact_state_log")
+update_agent_processes = _bridge(s3_write, "update_agent_processes")
+update_invoice_index = _bridge(s3_write, "update_invoice_index")
+rebuild_invoice_index = _bridge(s3_write, "rebuild_invoice_index")
+upload_email_token_to_s3 = _bridge(s3_write, "upload_email_token_to_s3")
+upload_gmail_sync_state_to_s3 = _bridge(s3_write, "upload_gmail_sync_state_to_s3")
+update_gmail_sync_state_in_s3 = _bridge(s3_write, "update_gmail_sync_state_in_s3")
+init_agent = _bridge(s3_write, "init_agent")
+write_invoice_state_to_s3 = _bridge(s3_write, "write_invoice_state_to_s3")
+write_transaction_data_to_s3 = _bridge(s3_write, "write_transaction_data_to_s3")
+update_transaction_data_in_s3 = _bridge(s3_write, "update_transaction_data_in_s3")
@@ -9,6 +9,10 @@ INVOICE_EINVOICE_FILE_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/fil
 INVOICE_EINVOICE_DATA_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/files/einvoice.json"
 INVOICE_LOCKED_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/is_locked.json"
 INVOICE_LOG_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/log.json"
+INVOICE_LOG_DIR_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/log/"
+INVOICE_LOG_ENTRIES_DIR_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/log/entries/"
+INVOICE_LOG_ENTRY_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/log/entries/{entry_id}.json"
+INVOICE_LOG_SNAPSHOT_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/log/snapshot.json"
 INVOICE_STATE_PATH = "public/{user_id}/invoices/invoice_{invoice_id}/state.json"
 
 # Email object path
@@ -17,6 +21,12 @@ EMAIL_JSON_PATH = "public/{user_id}/emails/email_{email_id}/email.json"
 EMAIL_ATTACHMENT_DIR_PATH = "public/{user_id}/emails/email_{email_id}/attachments/"
 EMAIL_ATTACHMENT_PATH = "public/{user_id}/emails/email_{email_id}/attachments/{attachment_name}"
 
+# Attachment processing cache, keyed by the sha256 of the file contents
+ATTACHMENT_CACHE_PATH = "attachment_cache/{content_hash}.json"
+
+# OpenAI response cache, keyed by the hash of the request
+GPT_CACHE_PATH = "gpt_cache/{cache_key}.json"
+
 
 # user object path
 USERS_DIR_PATH = "public/{user_id}/user/"
@@ -24,6 +34,9 @@ USER_DATA_PATH = "public/{user_id}/user/user_data.json"
 USER_AGENT_PROCESSES_PATH = "public/{user_id}/user/agent_processes.json"
 USER_EMAIL_CREDENTIALS_PATH = "public/{user_id}/user/email_credentials.json"
 USER_EMAIL_TOKEN_PATH = "public/{user_id}/user/email_token.json"
+USER_EMAIL_TOKEN_LEASE_PATH = "public/{user_id}/user/email_token_lease.json"
+USER_GMAIL_SYNC_STATE_PATH = "public/{user_id}/user/gmail_sync_state.json"
+USER_INVOICE_INDEX_PATH = "public/{user_id}/user/invoice_index.json"
 USER_CEDULA_PATH = "public/{user_id}/user/cedula.pdf"
 USER_RUT_PATH = "public/{user_id}/user/rut.pdf"
 
@@ -1,16 +1,97 @@
 from os import read
-import boto3
+from luzidos_utils.aws_io import clients
+import copy
 import json
 import uuid
 from botocore.exceptions import ClientError
 from luzidos_utils.aws_io.s3 import file_paths as fp
+from luzidos_utils.aws_io.cache import LRUCache
 import datetime as dt
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 #constants
 BUCKET_NAME = "luzidosdatadump"
 ROOT_INVOICE_PATH = "invoices/invoice"
 ROOT_EMAIL_PATH = "emails/email"
 ROOT_USER_PATH = 'userid'
+MAX_READ_WORKERS = 16
+LOG_READ_BATCH_SIZE = 16
+# attempts of state log reads racing a compaction
+LOG_READ_RETRIES = 3
+STREAM_CHUNK_SIZE = 1024 * 1024
+LIST_PAGE_SIZE = 1000
+# user ids are uuids, so their first character is a lowercase hex digit
+USER_ID_SHARDS = "0123456789abcdef"
+
+# Result of a single read in read_many_json_from_s3. error is None on success.
+S3ReadResult = namedtuple("S3ReadResult", ["bucket_name", "object_name", "data", "error"])
+
+# Returned by read_file_with_etag_from_s3 when the stored ETag still matches.
+NOT_MODIFIED = object()
+
+# Opt-in read-through cache for read_json_from_s3, see enable_json_cache.
+_json_cache = None
+
+"""
+CACHE UTILS
+"""
+
+def enable_json_cache(max_size=256, ttl=60):
+    """
+    Enable the in-process cache used by read_json_from_s3
+
+    Fresh entries are served from memory. Stale entries are revalidated
+    with a conditional GET on their ETag.
+
+    :param max_size: Maximum number of cached objects
+    :param ttl: Seconds an object is served without revalidation
+    """
+    global _json_cache
+    _json_cache = LRUCache(max_size=max_size, ttl=ttl)
+
+def disable_json_cache():
+    """
+    Disable and drop the read_json_from_s3 cache
+    """
+    global _json_cache
+    _json_cache = None
+
+def get_json_cache_stats():
+    """
+    Get read_json_from_s3 cache counters
+
+    :return: Dictionary of cache counters, None if the cache is disabled
+    """
+    if _json_cache is None:
+        return None
+    return _json_cache.stats()
+
+def invalidate_json_cache(bucket_name, object_name):
+    """
+    Drop a cached object
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    """
+    if _json_cache is not None:
+        _json_cache.invalidate((bucket_name, object_name))
+
+def cache_json_write(bucket_name, object_name, dict_data, etag):
+    """
+    Store a freshly written object in the cache
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :param dict_data: Written data
+    :param etag: ETag returned by S3, None to just invalidate
+    """
+    if _json_cache is None:
+        return
+    if etag is None:
+        _json_cache.invalidate((bucket_name, object_name))
+    else:
+        _json_cache.set((bucket_name, object_name), copy.deepcopy(dict_data), etag)
 """
 READ UTILS
 """
@@ -23,7 +104,7 @@ def read_file_from_s3(bucket_name, object_name):
     :param object_name: Object name in S3
     :return: File data
     """
-    s3_client = boto3.client('s3')
+    s3_client = clients.get_client('s3')
     try:
         # Get the object from the S3 bucket
         response = s3_client.get_object(Bucket=bucket_name, Key=object_name)
@@ -35,6 +116,115 @@ def read_file_from_s3(bucket_name, object_name):
         return None
     return file_data
 
+def open_file_stream_from_s3(bucket_name, object_name, byte_range=None):
+    """
+    Open a file in an S3 bucket for streaming reads
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :param byte_range: Optional (first_byte, last_byte) tuple, both inclusive.
+        last_byte may be None to read to the end of the file.
+    :return: File-like object, None if the file could not be opened
+    """
+    s3_client = clients.get_client('s3')
+    kwargs = {}
+    if byte_range is not None:
+        first_byte, last_byte = byte_range
+        kwargs["Range"] = f"bytes={first_byte}-{'' if last_byte is None else last_byte}"
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_name, **kwargs)
+    except Exception as e:
+        print(e, f"\nFile not found in {bucket_name}/{object_name}")
+        return None
+    return response['Body']
+
+def iter_file_chunks_from_s3(bucket_name, object_name, chunk_size=STREAM_CHUNK_SIZE, byte_range=None):
+    """
+    Read a file from an S3 bucket in chunks
+
+    Only one chunk is held in memory at a time.
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :param chunk_size: Chunk size in bytes
+    :param byte_range: Optional (first_byte, last_byte) tuple, see open_file_stream_from_s3
+    :return: Generator of bytes chunks
+    :raises FileNotFoundError: If the file could not be opened
+    """
+    stream = open_file_stream_from_s3(bucket_name, object_name, byte_range)
+    if stream is None:
+        raise FileNotFoundError(f"File not found in {bucket_name}/{object_name}")
+    try:
+        for chunk in stream.iter_chunks(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        stream.close()
+
+def download_file_from_s3(bucket_name, object_name, file_path, part_size=None, max_concurrency=None):
+    """
+    Download a file from an S3 bucket to disk, using ranged parts for large files
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :param file_path: Local destination path
+    :param part_size: Multipart part size in bytes
+    :param max_concurrency: Maximum number of parts downloaded concurrently
+    :return: True if file was downloaded, else False
+    """
+    s3_client = clients.get_client('s3')
+    try:
+        s3_client.download_file(bucket_name, object_name, file_path, Config=clients.get_transfer_config(part_size, max_concurrency))
+    except Exception as e:
+        print(e, f"\nFile not found in {bucket_name}/{object_name}")
+        return False
+    return True
+
+def download_file_obj_from_s3(bucket_name, object_name, file_obj, part_size=None, max_concurrency=None):
+    """
+    Download a file from an S3 bucket into a writable file object
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :param file_obj: Writable binary file object
+    :param part_size: Multipart part size in bytes
+    :param max_concurrency: Maximum number of parts downloaded concurrently
+    :return: True if file was downloaded, else False
+    """
+    s3_client = clients.get_client('s3')
+    try:
+        s3_client.download_fileobj(bucket_name, object_name, file_obj, Config=clients.get_transfer_config(part_size, max_concurrency))
+    except Exception as e:
+        print(e, f"\nFile not found in {bucket_name}/{object_name}")
+        return False
+    return True
+
+def read_file_with_etag_from_s3(bucket_name, object_name, if_none_match=None):
+    """
+    Read a file and its ETag from an S3 bucket
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :param if_none_match: ETag of a cached copy, to make the GET conditional
+    :return: (file data, ETag). File data is NOT_MODIFIED if the ETag matched,
+        (None, None) if the file could not be read
+    """
+    s3_client = clients.get_client('s3')
+    kwargs = {}
+    if if_none_match is not None:
+        kwargs["IfNoneMatch"] = if_none_match
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_name, **kwargs)
+        file_data = response['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return NOT_MODIFIED, if_none_match
+        print(e, f"\nFile not found in {bucket_name}/{object_name}")
+        return None, None
+    except Exception as e:
+        print(e, f"\nFile not found in {bucket_name}/{object_name}")
+        return None, None
+    return file_data, response.get('ETag')
+
 def file_exists_in_s3(bucket_name, object_name=None):
     """
     Check if a file exists in an S3 bucket
@@ -57,11 +247,90 @@ def read_json_from_s3(bucket_name, object_name):
     :param object_name: S3 object name
     :return: json data
     """
+    if _json_cache is not None:
+        return _read_json_cached(bucket_name, object_name)
     response = read_file_from_s3(bucket_name, object_name)
     if response is None:
         return None
     return json.loads(response)
 
+def _read_json_cached(bucket_name, object_name):
+    cache = _json_cache
+    key = (bucket_name, object_name)
+    entry = cache.get_entry(key)
+    if entry is not None and cache.is_fresh(entry):
+        cache.record_hit()
+        return copy.deepcopy(entry.value)
+
+    response, etag = read_file_with_etag_from_s3(bucket_name, object_name, entry.etag if entry else None)
+    if response is NOT_MODIFIED:
+        cache.touch(key)
+        cache.record_hit()
+        return copy.deepcopy(entry.value)
+
+    cache.record_miss()
+    if response is None:
+        cache.invalidate(key)
+        return None
+    data = json.loads(response)
+    if etag is not None:
+        cache.set(key, copy.deepcopy(data), etag)
+    return data
+
+def _read_json_or_raise(bucket_name, object_name):
+    # goes through the json cache like single reads, and warms it
+    data = read_json_from_s3(bucket_name, object_name)
+    if data is None:
+        raise FileNotFoundError(f"File not found in {bucket_name}/{object_name}")
+    return data
+
+def _read_json_result(bucket_name, object_name):
+    try:
+        return S3ReadResult(bucket_name, object_name, _read_json_or_raise(bucket_name, object_name), None)
+    except Exception as e:
+        return S3ReadResult(bucket_name, object_name, None, e)
+
+def read_many_json_from_s3(objects, max_workers=MAX_READ_WORKERS):
+    """
+    Read many json files from S3 concurrently
+    Reads go through the json cache when it is enabled, like read_json_from_s3.
+
+    :param objects: List of (bucket_name, object_name) tuples
+    :param max_workers: Maximum number of concurrent reads
+    :return: List of S3ReadResult, in the same order as objects
+    """
+    objects = list(objects)
+    if len(objects) <= 1 or max_workers <= 1:
+        return [_read_json_result(bucket_name, object_name) for bucket_name, object_name in objects]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(objects))) as executor:
+        return list(executor.map(lambda obj: _read_json_result(*obj), objects))
+
+def iter_dir_filenames_from_s3(bucket_name, dir_name, start_after=None, page_size=LIST_PAGE_SIZE, max_items=None):
+    """
+    Iterate over filenames in a directory in an S3 bucket
+    Follows list_objects_v2 pagination, so directories with more than one page of files are listed completely.
+    Filenames include the full path to the file object and files nested in subdirectories.
+
+    :param bucket_name: Bucket to read from
+    :param dir_name: S3 directory name
+    :param start_after: Only list keys sorting after this key
+    :param page_size: Number of keys requested per page
+    :param max_items: Maximum number of filenames to return, None for all
+    :return: Generator of filenames
+    """
+    s3_client = clients.get_client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    kwargs = {"Bucket": bucket_name, "Prefix": dir_name, "PaginationConfig": {"PageSize": page_size}}
+    if start_after is not None:
+        kwargs["StartAfter"] = start_after
+    n_items = 0
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            if max_items is not None and n_items >= max_items:
+                return
+            n_items += 1
+            yield obj['Key']
+
 def read_dir_filenames_from_s3(bucket_name, dir_name):
     """
     Read filenames from a directory in an S3 bucket
@@ -73,18 +342,40 @@ def read_dir_filenames_from_s3(bucket_name, dir_name):
     :param dir_name: S3 directory name
     :return: List of filenames
     """
-    s3_client = boto3.client('s3')
     try:
-        # Get the object from the S3 bucket
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=dir_name)
-        # Read the object contents
-        filenames = [obj['Key'] for obj in response['Contents']]
+        filenames = list(iter_dir_filenames_from_s3(bucket_name, dir_name))
         print(f"Files read successfully from {bucket_name}/{dir_name}")
     except Exception as e:
         print(e)
         return []
     return filenames
 
+def iter_childdirectories(bucket_name, prefix, start_after=None, page_size=LIST_PAGE_SIZE, max_items=None):
+    """
+    Iterate over the immediate subdirectories of a specific S3 bucket/prefix.
+    Follows list_objects_v2 pagination.
+    The subdirectories are returned as strings with the full path to the subdirectory object.
+
+    :param bucket_name: Bucket to read from
+    :param prefix: S3 prefix
+    :param start_after: Only list keys sorting after this key
+    :param page_size: Number of keys requested per page
+    :param max_items: Maximum number of subdirectories to return, None for all
+    :return: Generator of subdirectories
+    """
+    s3_client = clients.get_client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    kwargs = {"Bucket": bucket_name, "Prefix": prefix, "Delimiter": '/', "PaginationConfig": {"PageSize": page_size}}
+    if start_after is not None:
+        kwargs["StartAfter"] = start_after
+    n_items = 0
+    for page in paginator.paginate(**kwargs):
+        for content in page.get('CommonPrefixes', []):
+            if max_items is not None and n_items >= max_items:
+                return
+            n_items += 1
+            yield content['Prefix']
+
 def list_childdirectories(bucket_name, prefix):
     """
     List directories in a specific S3 bucket/prefix.
@@ -93,16 +384,39 @@ def list_childdirectories(bucket_name, prefix):
     The subdirectories are returned as strings with the full path to the subdirectory object.
     """
 
-    s3_client = boto3.client('s3')
     subfolders = []
     try: 
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
-        for content in response.get('CommonPrefixes', []):
-            subfolders.append(content['Prefix'])
+        subfolders = list(iter_childdirectories(bucket_name, prefix))
     except Exception as e:
         print(e)
     return subfolders
 
+def list_childdirectories_sharded(bucket_name, prefix, shards=USER_ID_SHARDS, max_workers=MAX_READ_WORKERS):
+    """
+    List directories in a specific S3 bucket/prefix, one concurrent listing per shard.
+    Each shard lists the subdirectories whose name starts with that character,
+    so subdirectories starting with any other character are not returned.
+
+    :param bucket_name: Bucket to read from
+    :param prefix: S3 prefix, ending in "/"
+    :param shards: First characters of the subdirectory names
+    :param max_workers: Maximum number of concurrent listings
+    :return: Sorted list of subdirectories
+    :raises Exception: If a shard could not be listed, rather than returning a partial list
+    """
+    def list_shard(shard):
+        try:
+            return list(iter_childdirectories(bucket_name, prefix + shard))
+        except Exception as e:
+            print(e, f"\nFailed to list shard {prefix + shard} in {bucket_name}")
+            raise
+
+    subfolders = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(shards))) as executor:
+        for shard_subfolders in executor.map(list_shard, shards):
+            subfolders.extend(shard_subfolders)
+    return sorted(subfolders)
+
 def read_invoice_data_from_s3(user_id, invoice_id, file_name):
     """
     Read invoice data from S3 bucket
@@ -176,12 +490,10 @@ def read_email_attachments_from_s3(user_id, thread_id):
     bucket_name = fp.ROOT_BUCKET
     attachment_dir = fp.EMAIL_ATTACHMENT_DIR_PATH.format(user_id=user_id, email_id=thread_id)
     attachment_filenames = read_dir_filenames_from_s3(bucket_name, attachment_dir)
-    email_attachments = []
     #only read json files
-    for attachment_filename in attachment_filenames:
-        if attachment_filename.split(".")[-1] == "json":
-            attachment = read_json_from_s3(bucket_name, attachment_filename)
-            email_attachments.append(attachment)
+    objects = [(bucket_name, attachment_filename) for attachment_filename in attachment_filenames
+               if attachment_filename.split(".")[-1] == "json"]
+    email_attachments = [result.data for result in read_many_json_from_s3(objects)]
     return email_attachments
 
 def read_email_attachment_data_from_s3(user_id, thread_id, attachment_id):
@@ -201,27 +513,50 @@ def read_email_attachment_data_from_s3(user_id, thread_id, attachment_id):
     #     return attachment_data["attachment_description"]
     # return attachment_data["attachment_OCR"]
 
+def read_attachment_cache_from_s3(content_hash):
+    """
+    Read the cached OCR and description of an attachment
+
+    :param content_hash: sha256 hex digest of the attachment contents
+    :return: Cached attachment data or None
+    """
+    object_name = fp.ATTACHMENT_CACHE_PATH.format(content_hash=content_hash)
+    return read_json_from_s3(fp.ROOT_BUCKET, object_name)
+
 def read_email_from_s3(user_id, thread_id, focused_message_id=None):
     """
     Read email from S3 bucket
 
     :param bucket_name: Name of the S3 bucket
     :param thread_id: Thread id
-    :return: Email
+    :return: Email. Attachments that could not be read are None in each message's attachments list
     """
     # TODO incorporate attachments into each individual email message
     email_body = read_email_body_from_s3(user_id, thread_id)
     if focused_message_id == None:
         focused_message_id = list(email_body["messages"].keys())[-1]
+
+    # fetch every attachment of the thread in one concurrent batch
+    bucket_name = fp.ROOT_BUCKET
+    attachment_refs = []
     for message_id in email_body["messages"]:
         email_body["messages"][message_id]["attachments"] = []
         for attachment_id in email_body["messages"][message_id]["attachment_ids"]:
-            attachment_data = read_email_attachment_data_from_s3(user_id, thread_id, attachment_id)
-            if focused_message_id == message_id:
-                attachment_info = attachment_data["attachment_OCR"]
-            else:
-                attachment_info = attachment_data["attachment_description"]
-            email_body["messages"][message_id]["attachments"].append(attachment_info)
+            attachment_path = fp.EMAIL_ATTACHMENT_PATH.format(user_id=user_id, email_id=thread_id, attachment_name=f"{attachment_id}.json")
+            attachment_refs.append((message_id, (bucket_name, attachment_path)))
+    results = read_many_json_from_s3([obj for _, obj in attachment_refs])
+
+    for (message_id, _), result in zip(attachment_refs, results):
+        if result.error is not None:
+            # keep attachments index aligned with attachment_ids
+            print(result.error)
+            email_body["messages"][message_id]["attachments"].append(None)
+            continue
+        if focused_message_id == message_id:
+            attachment_info = result.data["attachment_OCR"]
+        else:
+            attachment_info = result.data["attachment_description"]
+        email_body["messages"][message_id]["attachments"].append(attachment_info)
 
     return email_body
 
@@ -281,6 +616,52 @@ def get_open_agent_processes(user_id):
        return []
     return open_agent_processes["open_agent_processes"]
 
+def read_invoice_index_from_s3(user_id):
+    """
+    Read the user's invoice index
+
+    :param user_id: User id
+    :return: Dictionary of invoice id to index entry
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.USER_INVOICE_INDEX_PATH.format(user_id=user_id)
+    invoice_index = read_json_from_s3(bucket_name, object_name)
+    if invoice_index is None:
+        return {}
+    return invoice_index["invoices"]
+
+def query_invoice_index(user_id, current_state=None, agent_status=None, locked=None, min_age=None, max_age=None):
+    """
+    Query the user's invoice index with a single read
+
+    :param user_id: User id
+    :param current_state: Only return invoices in this state, or in any state of a list
+    :param agent_status: Only return invoices with this agent status, e.g. INIT or COMPLETE
+    :param locked: Only return locked (True) or unlocked (False) invoices
+    :param min_age: Only return invoices not updated for at least this datetime.timedelta
+    :param max_age: Only return invoices updated within this datetime.timedelta
+    :return: Dictionary of invoice id to index entry
+    """
+    if isinstance(current_state, str):
+        current_state = [current_state]
+    now = dt.datetime.now()
+
+    invoices = {}
+    for invoice_id, entry in read_invoice_index_from_s3(user_id).items():
+        if current_state is not None and entry.get("current_state") not in current_state:
+            continue
+        if agent_status is not None and entry.get("agent_status") != agent_status:
+            continue
+        if locked is not None and entry.get("locked", False) != locked:
+            continue
+        age = now - dt.datetime.fromisoformat(entry["last_update_time"])
+        if min_age is not None and age < min_age:
+            continue
+        if max_age is not None and age > max_age:
+            continue
+        invoices[invoice_id] = entry
+    return invoices
+
 def read_email_credentials_from_s3(user_id):
     """
     Read email credentials from S3 bucket
@@ -293,18 +674,33 @@ def read_email_credentials_from_s3(user_id):
     email_credentials = read_json_from_s3(bucket_name, object_name)
     return email_credentials
 
-def read_email_token_from_s3(user_id):
+def read_email_token_from_s3(user_id, use_cache=True):
     """
     Read email token from S3 bucket
 
     :param user_id: User id
+    :param use_cache: False to bypass the json cache and see tokens written by other workers
     :return: Email token
     """
     bucket_name = fp.ROOT_BUCKET
     object_name = fp.USER_EMAIL_TOKEN_PATH.format(user_id=user_id)
+    if not use_cache:
+        response = read_file_from_s3(bucket_name, object_name)
+        return json.loads(response) if response is not None else None
     email_token = read_json_from_s3(bucket_name, object_name)
     return email_token
 
+def read_gmail_sync_state_from_s3(user_id):
+    """
+    Read the Gmail sync state (last synced history id) from S3 bucket
+
+    :param user_id: User id
+    :return: Gmail sync state or None if the mailbox was never synced
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.USER_GMAIL_SYNC_STATE_PATH.format(user_id=user_id)
+    return read_json_from_s3(bucket_name, object_name)
+
 
 def read_agent_processes_from_s3(user_id):
     """
@@ -321,21 +717,177 @@ def read_agent_processes_from_s3(user_id):
     return agent_processes
 
 
-def get_all_users():
+def read_state_log_snapshot_from_s3(user_id, invoice_id):
+    """
+    Read the compacted state log
+
+    Falls back to the legacy log.json document when no snapshot exists yet.
+
+    :return: Snapshot dictionary with "state_log" and "last_entry_key"
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.INVOICE_LOG_SNAPSHOT_PATH.format(user_id=user_id, invoice_id=invoice_id)
+    snapshot = read_json_from_s3(bucket_name, object_name)
+    if snapshot is not None:
+        return snapshot
+    object_name = fp.INVOICE_LOG_PATH.format(user_id=user_id, invoice_id=invoice_id)
+    legacy_log = read_json_from_s3(bucket_name, object_name)
+    state_log = legacy_log["state_log"] if legacy_log else []
+    return {"state_log": state_log, "last_entry_key": None}
+
+def read_state_log_entry_keys(user_id, invoice_id, start_after=None):
+    """
+    List the keys of state log entries that are not compacted yet
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :param start_after: Only return keys sorting after this key
+    :return: Sorted list of entry keys, oldest first
+    """
+    bucket_name = fp.ROOT_BUCKET
+    entries_dir = fp.INVOICE_LOG_ENTRIES_DIR_PATH.format(user_id=user_id, invoice_id=invoice_id)
+    try:
+        entry_keys = sorted(iter_dir_filenames_from_s3(bucket_name, entries_dir, start_after=start_after))
+    except Exception as e:
+        print(e)
+        return []
+    return entry_keys
+
+def iter_state_log_entries(entry_keys, skip_errors=True):
+    """
+    Read state log entries lazily, in small concurrent batches
+
+    :param entry_keys: List of entry keys
+    :param skip_errors: Skip entries that can not be read, raise the read error if False
+    :return: Generator of log entries
+    """
+    bucket_name = fp.ROOT_BUCKET
+    for i in range(0, len(entry_keys), LOG_READ_BATCH_SIZE):
+        objects = [(bucket_name, key) for key in entry_keys[i:i + LOG_READ_BATCH_SIZE]]
+        for result in read_many_json_from_s3(objects):
+            if result.error is not None:
+                if not skip_errors:
+                    raise result.error
+                print(result.error)
+                continue
+            yield result.data
+
+def iter_state_log(user_id, invoice_id):
+    """
+    Iterate over the state log of an invoice agent, oldest entry first
+
+    Compacted entries come from the snapshot, newer entries are read lazily
+    in small concurrent batches. An entry that can not be read raises instead
+    of leaving a gap in the log.
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :return: Generator of log entries
+    """
+    snapshot = read_state_log_snapshot_from_s3(user_id, invoice_id)
+    yield from snapshot["state_log"]
+    entry_keys = read_state_log_entry_keys(user_id, invoice_id, snapshot["last_entry_key"])
+    yield from iter_state_log_entries(entry_keys, skip_errors=False)
+
+def read_state_log_from_s3(user_id, invoice_id):
+    """
+    Read the full state log of an invoice agent
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :return: Dictionary in the log.json format, {"state_log": [...]}
+    """
+    return {"state_log": _retry_state_log_read(lambda: list(iter_state_log(user_id, invoice_id)))}
+
+def _retry_state_log_read(read_log):
+    # entries listed before a compaction may be deleted by the time they are read,
+    # reading again starts from the new snapshot
+    for attempt in range(LOG_READ_RETRIES):
+        try:
+            return read_log()
+        except FileNotFoundError as e:
+            if attempt == LOG_READ_RETRIES - 1:
+                raise
+            print(e, "\nState log compacted while reading, reading again")
+
+def read_state_log_tail_from_s3(user_id, invoice_id, n_entries=1):
+    """
+    Read the latest entries of the state log of an invoice agent
+
+    Only the last n_entries entry objects are fetched. The snapshot is only
+    read if there are fewer uncompacted entries than requested.
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :param n_entries: Number of entries to read
+    :return: List of log entries, oldest first
+    """
+    return _retry_state_log_read(lambda: _read_state_log_tail(user_id, invoice_id, n_entries))
+
+def _read_state_log_tail(user_id, invoice_id, n_entries):
+    entry_keys = read_state_log_entry_keys(user_id, invoice_id)
+    if len(entry_keys) >= n_entries:
+        return list(iter_state_log_entries(entry_keys[len(entry_keys) - n_entries:], skip_errors=False))
+
+    snapshot = read_state_log_snapshot_from_s3(user_id, invoice_id)
+    if snapshot["last_entry_key"] is not None:
+        entry_keys = [key for key in entry_keys if key > snapshot["last_entry_key"]]
+    entries = list(iter_state_log_entries(entry_keys, skip_errors=False))
+    n_snapshot_entries = n_entries - len(entries)
+    if n_snapshot_entries > 0:
+        entries = snapshot["state_log"][-n_snapshot_entries:] + entries
+    return entries
+
+def get_all_users(sharded=False):
     """
     Get all users
 
+    :param sharded: List users with one concurrent listing per user id shard.
+        A failed shard listing raises instead of returning part of the users
     :return: List of user ids
     """
     # return list of all user ids
     # user ids are all the subdirectories directly underneath USER_DIR_PATH
     bucket_name = fp.ROOT_BUCKET
 
-    subdirectories = list_childdirectories(bucket_name, "public/")
+    if sharded:
+        subdirectories = list_childdirectories_sharded(bucket_name, "public/")
+    else:
+        subdirectories = list_childdirectories(bucket_name, "public/")
 
     user_ids = [subdirectory.split("/")[1] for subdirectory in subdirectories]
 
     return user_ids
+
+def iter_all_users(start_after=None, page_size=LIST_PAGE_SIZE, max_items=None):
+    """
+    Iterate over all users, one listing page at a time
+
+    :param start_after: Only return users whose id sorts after this user id
+    :param page_size: Number of users requested per page
+    :param max_items: Maximum number of users to return, None for all
+    :return: Generator of user ids
+    """
+    bucket_name = fp.ROOT_BUCKET
+    if start_after is not None:
+        # "0" is the byte right after "/", so this skips every key of that user
+        start_after = f"public/{start_after}0"
+    for subdirectory in iter_childdirectories(bucket_name, "public/", start_after, page_size, max_items):
+        yield subdirectory.split("/")[1]
+
+def read_many_user_data_from_s3(user_ids=None):
+    """
+    Read user data for many users concurrently
+
+    :param user_ids: List of user ids, defaults to all users
+    :return: Dictionary of user id to user data, None for users without data
+    """
+    if user_ids is None:
+        user_ids = get_all_users()
+    bucket_name = fp.ROOT_BUCKET
+    objects = [(bucket_name, fp.USER_DATA_PATH.format(user_id=user_id)) for user_id in user_ids]
+    results = read_many_json_from_s3(objects)
+    return {user_id: result.data for user_id, result in zip(user_ids, results)}
     
 
 if __name__ == "__main__":
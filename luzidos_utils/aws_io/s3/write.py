@@ -1,6 +1,9 @@
 from os import read
-import boto3
+from luzidos_utils.aws_io import clients
+import copy
 import json
+import random
+import time
 import uuid
 from botocore.exceptions import ClientError
 from luzidos_utils.aws_io.s3 import file_paths as fp
@@ -13,41 +16,66 @@ BUCKET_NAME = "luzidosdatadump"
 ROOT_INVOICE_PATH = "invoices/invoice"
 ROOT_EMAIL_PATH = "emails/email"
 ROOT_USER_PATH = 'userid'
+ATOMIC_UPDATE_RETRIES = 5
+ATOMIC_UPDATE_BACKOFF = 0.1
+LOG_COMPACTION_THRESHOLD = 50
+# entries younger than this may still be in flight and are left for the next compaction
+LOG_COMPACTION_SETTLE_TIME = dt.timedelta(minutes=5)
+LOG_ENTRY_ID_FORMAT = '%Y%m%dT%H%M%S%f'
+# seconds a worker may hold the email token lease before others can take it over
+EMAIL_TOKEN_LEASE_DURATION = 60
+
+class ConcurrentModificationError(Exception):
+    """Raised when a conditional write finds the object changed since it was read"""
+
+class _NothingToCompact(Exception):
+    pass
+
+class _CompactionReadError(Exception):
+    pass
 
 """
 WRITE UTILS
 """
-def upload_file_to_s3(file_path, bucket_name, object_name):
+def upload_file_to_s3(file_path, bucket_name, object_name, part_size=None, max_concurrency=None):
     """
     Upload a file to an S3 bucket
+    Large files are uploaded as concurrent multipart uploads.
 
     :param bucket_name: Bucket to upload to
     :param file_path: File to upload
     :param object_name: S3 object name
+    :param part_size: Multipart part size in bytes
+    :param max_concurrency: Maximum number of parts uploaded concurrently
     :return: True if file was uploaded, else False
     """
 
-    s3_client = boto3.client('s3')
+    s3_client = clients.get_client('s3')
     try:
-        s3_client.upload_file(file_path, bucket_name, object_name)
+        s3_client.upload_file(file_path, bucket_name, object_name, Config=clients.get_transfer_config(part_size, max_concurrency))
+        s3_read.invalidate_json_cache(bucket_name, object_name)
     except Exception as e:
         print(e)
         return False
     return True
 
-def upload_file_obj_to_s3(file_obj, bucket_name,  object_name):
+def upload_file_obj_to_s3(file_obj, bucket_name,  object_name, part_size=None, max_concurrency=None):
     """
     Upload a file object to an S3 bucket
+    The file object is read in parts, large files are uploaded as concurrent multipart uploads.
 
     :param bucket_name: Bucket to upload to
     :param file_obj: File object
     :param object_name: S3 object name
+    :param part_size: Multipart part size in bytes
+    :param max_concurrency: Maximum number of parts uploaded concurrently
     :return: True if file was uploaded, else False
     """
 
-    s3_client = boto3.client('s3')
+    s3_client = clients.get_client('s3')
     try:
-        s3_client.upload_fileobj(file_obj, bucket_name, object_name)
+        s3_client.upload_fileobj(file_obj, bucket_name, object_name, Config=clients.get_transfer_config(part_size, max_concurrency))
+        s3_read.invalidate_json_cache(bucket_name, object_name)
     except Exception as e:
         print(e)
         return False
@@ -80,6 +108,17 @@ def upload_email_attachment_json_to_s3(user_id, email_id, attachment_name, attac
     return status
 
 
+def upload_attachment_cache_to_s3(content_hash, attachment_data):
+    """
+    Store the OCR and description of an attachment under its content hash
+
+    :param content_hash: sha256 hex digest of the attachment contents
+    :param attachment_data: Attachment data to cache
+    :return: True if the data was uploaded, else False
+    """
+    object_name = fp.ATTACHMENT_CACHE_PATH.format(content_hash=content_hash)
+    return upload_dict_as_json_to_s3(fp.ROOT_BUCKET, attachment_data, object_name)
+
 def upload_email_body_to_s3(user_id, thread_id, email_body):
     """
     Upload email body to S3 bucket
@@ -101,20 +140,107 @@ def upload_dict_as_json_to_s3(bucket_name, dict_data, object_name):
     :param dict_data: Dictionary to upload
     :param object_name: Object name in S3 bucket
     """
-    s3_client = boto3.client('s3')
+    s3_client = clients.get_client('s3')
 
     # Convert dictionary to JSON string
     json_string = json.dumps(dict_data)
 
     try:
         # Upload the JSON string as an S3 object
-        s3_client.put_object(Body=json_string, Bucket=bucket_name, Key=object_name)
+        response = s3_client.put_object(Body=json_string, Bucket=bucket_name, Key=object_name)
+        s3_read.cache_json_write(bucket_name, object_name, json.loads(json_string), response.get('ETag'))
         print(f"File uploaded successfully to {bucket_name}/{object_name}")
     except Exception as e:
         print(e)
         return False
     return True
 
+def upload_dict_as_json_to_s3_if_match(bucket_name, dict_data, object_name, etag):
+    """
+    Upload a dictionary as a JSON object only if the object has not changed
+
+    :param bucket_name: Name of the S3 bucket
+    :param dict_data: Dictionary to upload
+    :param object_name: Object name in S3 bucket
+    :param etag: ETag the object must still have, None if the object must not exist yet
+    :return: True if file was uploaded, else False
+    :raises ConcurrentModificationError: If the object was changed by another writer
+    """
+    s3_client = clients.get_client('s3')
+    json_string = json.dumps(dict_data)
+    if etag is None:
+        condition = {"IfNoneMatch": "*"}
+    else:
+        condition = {"IfMatch": etag}
+
+    try:
+        response = s3_client.put_object(Body=json_string, Bucket=bucket_name, Key=object_name, **condition)
+        s3_read.cache_json_write(bucket_name, object_name, json.loads(json_string), response.get('ETag'))
+        print(f"File uploaded successfully to {bucket_name}/{object_name}")
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            s3_read.invalidate_json_cache(bucket_name, object_name)
+            raise ConcurrentModificationError(f"{bucket_name}/{object_name} was modified concurrently") from e
+        print(e)
+        return False
+    except Exception as e:
+        print(e)
+        return False
+    return True
+
+def atomic_update_json(bucket_name, object_name, mutator, default=None, retries=ATOMIC_UPDATE_RETRIES, backoff_factor=ATOMIC_UPDATE_BACKOFF):
+    """
+    Read, modify and write a JSON object using optimistic concurrency
+
+    The object is written with a conditional PUT on the ETag that was read.
+    If another writer got there first, the object is read again and the
+    mutator is re-applied, up to retries times with jittered backoff.
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3 bucket
+    :param mutator: Function receiving the current data and returning the new data.
+        It may also mutate the data in place and return None.
+    :param default: Data to start from if the object does not exist, None to fail instead
+    :param retries: Number of attempts
+    :param backoff_factor: Base delay in seconds between attempts
+    :return: True if the object was updated, else False
+    """
+    for attempt in range(retries):
+        response, etag = s3_read.read_file_with_etag_from_s3(bucket_name, object_name)
+        if response is None:
+            if default is None:
+                print(f"Cannot update missing file {bucket_name}/{object_name}")
+                return False
+            data = copy.deepcopy(default)
+            etag = None
+        else:
+            data = json.loads(response)
+
+        new_data = mutator(data)
+        if new_data is None:
+            new_data = data
+
+        try:
+            return upload_dict_as_json_to_s3_if_match(bucket_name, new_data, object_name, etag)
+        except ConcurrentModificationError as e:
+            print(e, f"\nRetrying update (attempt {attempt + 1} of {retries})")
+            time.sleep(backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    print(f"Failed to update {bucket_name}/{object_name} after {retries} attempts")
+    return False
+
+def _set_nested_value(data, key, value):
+    """
+    Set a value in nested dictionaries
+
+    :param key: Key formated as "key1/key2/.../keyN"
+    """
+    substate = data
+    keys = key.split("/")
+    for subkey in keys[:-1]:
+        substate = substate[subkey]
+    substate[keys[-1]] = value
+
 def upload_invoice_data_to_s3(user_id, invoice_id, invoice_data, data_type):
     """
     Upload invoice data to S3 bucket
@@ -137,9 +263,7 @@ def update_invoice_data_in_s3(user_id, invoice_id, new_invoice_data, data_type):
     """
     bucket_name = fp.ROOT_BUCKET
     object_name = fp.INVOICE_DATA_PATH.format(user_id=user_id, invoice_id=invoice_id, file_name=data_type)
-    invoice_data = s3_read.read_invoice_data_from_s3(user_id, invoice_id, data_type)
-    invoice_data.update(new_invoice_data)
-    status = upload_dict_as_json_to_s3(bucket_name, invoice_data, object_name)
+    status = atomic_update_json(bucket_name, object_name, lambda invoice_data: invoice_data.update(new_invoice_data))
     return status
 
 def update_invoice_state_in_s3(user_id, invoice_id, new_state):
@@ -150,12 +274,7 @@ def update_invoice_state_in_s3(user_id, invoice_id, new_state):
     :param invoice_id: Invoice id
     :param new_invoice_data: New invoice data
     """
-    bucket_name = fp.ROOT_BUCKET
-    object_name = f"{ROOT_USER_PATH}-{user_id}/{ROOT_INVOICE_PATH}-{invoice_id}/state-{invoice_id}.json"
-    state = s3_read.read_invoice_state_from_s3(user_id, invoice_id)
-    state.update(new_state)
-    status = upload_dict_as_json_to_s3(bucket_name, state, object_name)
-    return status
+    return _update_invoice_state(user_id, invoice_id, lambda state: state.update(new_state))
 
 def update_invoice_state_field_in_s3(user_id, invoice_id, key, value):
     """
@@ -166,46 +285,42 @@ def update_invoice_state_field_in_s3(user_id, invoice_id, key, value):
     :param key: Key to update. formated as "key1/key2/.../keyN"
     :param value: New value
     """
-    bucket_name = fp.ROOT_BUCKET
-    object_name = f"{ROOT_USER_PATH}-{user_id}/{ROOT_INVOICE_PATH}-{invoice_id}/state-{invoice_id}.json"
-    state = s3_read.read_invoice_state_from_s3(user_id, invoice_id)
-
-    # Update the state field
-    substate = state
-    keys = key.split("/")
-    for i, subkey in enumerate(keys):
-        if i == len(keys) - 1:
-            substate[subkey] = value
-        else:
-            substate = substate[subkey]
-
-    status = upload_dict_as_json_to_s3(bucket_name, state, object_name)
-    return status
+    return _update_invoice_state(user_id, invoice_id, lambda state: _set_nested_value(state, key, value))
 
 def update_invoice_state_fields_in_s3(user_id, invoice_id, data):
     """
-    Update invoice state field in S3 bucket
+    Update invoice state fields in S3 bucket
 
     :param bucket_name: Name of the S3 bucket
     :param invoice_id: Invoice id
-    :param key: Key to update. formated as "key1/key2/.../keyN"
-    :param value: New value
+    :param data: Dictionary of keys to new values. Keys are formated as "key1/key2/.../keyN"
     """
-    bucket_name = fp.ROOT_BUCKET
-    object_name = f"{ROOT_USER_PATH}-{user_id}/{ROOT_INVOICE_PATH}-{invoice_id}/state-{invoice_id}.json"
-    state = s3_read.read_invoice_state_from_s3(user_id, invoice_id)
-    
-    # Update the state field
-    substate = state
-    keys = key.split("/")
-    for key, value in data.items():
-        for i, subkey in enumerate(keys):
-            if i == len(keys) - 1:
-                substate[subkey] = value
-            else:
-                substate = substate[subkey]
+    def mutator(state):
+        for key, value in data.items():
+            _set_nested_value(state, key, value)
 
-    status = upload_dict_as_json_to_s3(bucket_name, state, object_name)
+    return _update_invoice_state(user_id, invoice_id, mutator)
+
+def _update_invoice_state(user_id, invoice_id, mutator):
+    """
+    Apply mutator to the invoice state and refresh the invoice index entry
+    if the update changed current_state
+    """
+    current_states = {}
+
+    def update(state):
+        current_states["old"] = _get_current_state(state)
+        new_state = mutator(state)
+        if new_state is None:
+            new_state = state
+        current_states["new"] = _get_current_state(new_state)
+        return new_state
+
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.INVOICE_STATE_PATH.format(user_id=user_id, invoice_id=invoice_id)
+    status = atomic_update_json(bucket_name, object_name, update)
+    if status and current_states["new"] != current_states["old"]:
+        update_invoice_index(user_id, invoice_id, refresh_state=True)
     return status
 
 def update_invoice_contact_in_s3(user_id, invoice_id, new_contact, primary_contact=False, pop_first_alternate=False):
@@ -217,16 +332,19 @@ def update_invoice_contact_in_s3(user_id, invoice_id, new_contact, primary_conta
     :param new_contact: New contact
     :param primary_contact: True if new contact is primary contact, else False
     """
-    transaction_json = s3_read.read_transaction_data_from_s3(user_id, invoice_id)
-    if primary_contact:
-        old_contact = transaction_json["vendor_details"]["vendor_email"]
-        transaction_json["vendor_details"]["vendor_email"] = new_contact
-        transaction_json["vendor_details"]["additional_vendor_contacts"].append({"vendor_email": old_contact, "status": "WRONG_CONTACT"})
-    else:
-        transaction_json["vendor_details"]["additional_vendor_contacts"].append({"vendor_email": new_contact, "status": "NOT_CONTACTED"})
-    if pop_first_alternate:
-        transaction_json["vendor_details"]["additional_vendor_contacts"] = transaction_json["vendor_details"]["additional_vendor_contacts"][1:]
-    status = write_transaction_data_to_s3(user_id, invoice_id, transaction_json)
+    def mutator(transaction_json):
+        if primary_contact:
+            old_contact = transaction_json["vendor_details"]["vendor_email"]
+            transaction_json["vendor_details"]["vendor_email"] = new_contact
+            transaction_json["vendor_details"]["additional_vendor_contacts"].append({"vendor_email": old_contact, "status": "WRONG_CONTACT"})
+        else:
+            transaction_json["vendor_details"]["additional_vendor_contacts"].append({"vendor_email": new_contact, "status": "NOT_CONTACTED"})
+        if pop_first_alternate:
+            transaction_json["vendor_details"]["additional_vendor_contacts"] = transaction_json["vendor_details"]["additional_vendor_contacts"][1:]
+
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.INVOICE_DATA_PATH.format(user_id=user_id, invoice_id=invoice_id, file_name="transaction")
+    status = atomic_update_json(bucket_name, object_name, mutator)
     return status
 
 
@@ -265,7 +383,7 @@ def copy_file(bucket_name, source_file, dest_file):
     :param dest_file: Destination file
     :return: True if file was copied, else False
     """
-    s3_client = boto3.client('s3')
+    s3_client = clients.get_client('s3')
     try:
         copy_source = {
             'Bucket': bucket_name,
@@ -276,11 +394,57 @@ def copy_file(bucket_name, source_file, dest_file):
         print("Source: ", source_file)
         print("Destination: ", dest_file)
         s3_client.copy_object(Bucket=bucket_name, CopySource=copy_source, Key=dest_file)
+        s3_read.invalidate_json_cache(bucket_name, dest_file)
+    except Exception as e:
+        print(e)
+        return False
+    return True
+
+def delete_file_from_s3(bucket_name, object_name):
+    """
+    Delete a file from an S3 bucket
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_name: Object name in S3
+    :return: True if file was deleted, else False
+    """
+    s3_client = clients.get_client('s3')
+    try:
+        s3_client.delete_object(Bucket=bucket_name, Key=object_name)
+        s3_read.invalidate_json_cache(bucket_name, object_name)
     except Exception as e:
         print(e)
         return False
     return True
 
+def delete_files_from_s3(bucket_name, object_names):
+    """
+    Delete many files from an S3 bucket, 1000 keys per request
+
+    :param bucket_name: Name of the S3 bucket
+    :param object_names: List of object names in S3
+    :return: True if all files were deleted, else False
+    """
+    s3_client = clients.get_client('s3')
+    object_names = list(object_names)
+    status = True
+    for i in range(0, len(object_names), 1000):
+        chunk = object_names[i:i + 1000]
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': object_name} for object_name in chunk], 'Quiet': True}
+            )
+            for error in response.get('Errors', []):
+                print(f"Failed to delete {bucket_name}/{error['Key']}: {error.get('Message')}")
+                status = False
+        except Exception as e:
+            print(e)
+            status = False
+        for object_name in chunk:
+            s3_read.invalidate_json_cache(bucket_name, object_name)
+    return status
+
 def copy_einvoice_to_invoice_dir(user_id, invoice_id,thread_id, einvoice_filename):
     """
     Copy einvoice to invoice directory in S3 bucket
@@ -305,6 +469,7 @@ def lock_agent(user_id, invoice_id):
     bucket_name = fp.ROOT_BUCKET
     object_name = fp.INVOICE_LOCKED_PATH.format(user_id=user_id, invoice_id=invoice_id)
     status = upload_dict_as_json_to_s3(bucket_name, {"locked": True}, object_name)
+    update_invoice_index(user_id, invoice_id, locked=True)
     return status
 
 def unlock_agent(user_id, invoice_id):
@@ -317,22 +482,100 @@ def unlock_agent(user_id, invoice_id):
     bucket_name = fp.ROOT_BUCKET
     object_name = fp.INVOICE_LOCKED_PATH.format(user_id=user_id, invoice_id=invoice_id)
     status = upload_dict_as_json_to_s3(bucket_name, {"locked": False}, object_name)
+    update_invoice_index(user_id, invoice_id, locked=False)
     return status
 
 def log_state(user_id, invoice_id, actor, state_data):
+    """
+    Append an entry to the state log of an invoice agent
+
+    Each entry is written as its own object under the log entries directory,
+    so appending does not depend on the length of the log.
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :param actor: Name of the component logging the state
+    :param state_data: State data to log
+    """
     update_time = dt.datetime.now().isoformat()
     log_entry = {
         "actor": actor,
         "update_time": update_time,
         "state_data": state_data
     }
+    # entry ids sort by creation time
+    entry_id = f"{dt.datetime.now(dt.timezone.utc).strftime(LOG_ENTRY_ID_FORMAT)}-{uuid.uuid4().hex[:8]}"
     bucket_name = fp.ROOT_BUCKET
-    object_name = fp.INVOICE_LOG_PATH.format(user_id=user_id, invoice_id=invoice_id)
-    state_log = s3_read.read_json_from_s3(bucket_name, object_name)
-    state_log["state_log"].append(log_entry)
-    status = upload_dict_as_json_to_s3(bucket_name, state_log, object_name)
+    object_name = fp.INVOICE_LOG_ENTRY_PATH.format(user_id=user_id, invoice_id=invoice_id, entry_id=entry_id)
+    status = upload_dict_as_json_to_s3(bucket_name, log_entry, object_name)
     return status
 
+def compact_state_log(user_id, invoice_id, min_entries=LOG_COMPACTION_THRESHOLD):
+    """
+    Fold state log entries into the log snapshot
+
+    The legacy log.json document is folded in on the first compaction.
+    Entry objects are deleted one compaction later than they are folded in,
+    together with the legacy log.json, so readers that listed them before the
+    new snapshot was written can still read them.
+    Entries newer than LOG_COMPACTION_SETTLE_TIME are not compacted, so an entry
+    written late or by a host with a skewed clock can not sort below the
+    snapshot's last_entry_key. The compaction is aborted if an entry can not be read.
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :param min_entries: Only compact when at least this many entries are pending
+    :return: True if the log is compacted or nothing had to be done, else False
+    """
+    bucket_name = fp.ROOT_BUCKET
+    previous_snapshot = {}
+    entries_dir = fp.INVOICE_LOG_ENTRIES_DIR_PATH.format(user_id=user_id, invoice_id=invoice_id)
+
+    def mutator(snapshot):
+        previous_snapshot["exists"] = "last_entry_key" in snapshot
+        previous_snapshot["last_entry_key"] = snapshot.get("last_entry_key")
+        if "last_entry_key" not in snapshot:
+            # first compaction, start from the legacy log.json document
+            snapshot.update(s3_read.read_state_log_snapshot_from_s3(user_id, invoice_id))
+        settled_before = entries_dir + (dt.datetime.now(dt.timezone.utc) - LOG_COMPACTION_SETTLE_TIME).strftime(LOG_ENTRY_ID_FORMAT)
+        entry_keys = [
+            key for key in s3_read.read_state_log_entry_keys(user_id, invoice_id, snapshot["last_entry_key"])
+            if key < settled_before
+        ]
+        if len(entry_keys) < min_entries or not entry_keys:
+            raise _NothingToCompact()
+        try:
+            entries = list(s3_read.iter_state_log_entries(entry_keys, skip_errors=False))
+        except Exception as e:
+            raise _CompactionReadError(e)
+        snapshot["state_log"].extend(entries)
+        snapshot["last_entry_key"] = entry_keys[-1]
+
+    object_name = fp.INVOICE_LOG_SNAPSHOT_PATH.format(user_id=user_id, invoice_id=invoice_id)
+    try:
+        status = atomic_update_json(bucket_name, object_name, mutator, default={"state_log": []})
+    except _NothingToCompact:
+        return True
+    except _CompactionReadError as e:
+        # deleting the entries would drop the unread ones
+        print(f"State log compaction aborted: {e}")
+        return False
+    if not status:
+        return False
+
+    # only delete what the previous snapshot already covered
+    stale_keys = []
+    if previous_snapshot["last_entry_key"] is not None:
+        stale_keys = [
+            key for key in s3_read.read_state_log_entry_keys(user_id, invoice_id)
+            if key <= previous_snapshot["last_entry_key"]
+        ]
+    if previous_snapshot["exists"]:
+        stale_keys.append(fp.INVOICE_LOG_PATH.format(user_id=user_id, invoice_id=invoice_id))
+    if not stale_keys:
+        return True
+    return delete_files_from_s3(bucket_name, stale_keys)
+
 # status can be INIT COMPLETE CANCEL
 # we should make this a constant
 def update_agent_processes(user_id, invoice_id, status=INIT):
@@ -343,19 +586,110 @@ def update_agent_processes(user_id, invoice_id, status=INIT):
     :param invoice_id: Invoice id
     :param action: Action to perform
     """
-    agent_processes = s3_read.read_agent_processes_from_s3(user_id)
-    if status == INIT:
-        agent_processes["open_agent_processes"].append(invoice_id)
-    elif status == COMPLETE:
-        agent_processes["open_agent_processes"].remove(invoice_id)
-        agent_processes["completed_agent_processes"].append(invoice_id)
-    else:
+    agent_status = status
+    status = _update_agent_processes_list(user_id, invoice_id, agent_status)
+    if status:
+        update_invoice_index(user_id, invoice_id, agent_status=agent_status)
+    return status
+
+def _update_agent_processes_list(user_id, invoice_id, status):
+    if status not in (INIT, COMPLETE):
         raise ValueError(f"Invalid status: {status}")
+
+    def mutator(agent_processes):
+        if status == INIT:
+            agent_processes["open_agent_processes"].append(invoice_id)
+        else:
+            agent_processes["open_agent_processes"].remove(invoice_id)
+            agent_processes["completed_agent_processes"].append(invoice_id)
+
     bucket_name = fp.ROOT_BUCKET
     object_name = fp.USER_AGENT_PROCESSES_PATH.format(user_id=user_id)
-    status = upload_dict_as_json_to_s3(bucket_name, agent_processes, object_name)
+    default = {"open_agent_processes": [], "completed_agent_processes": [], "cancelled_agent_processes": []}
+    return atomic_update_json(bucket_name, object_name, mutator, default=default)
+
+def _get_current_state(state):
+    try:
+        return state["state"]["metadata"]["current_state"]
+    except (KeyError, TypeError):
+        return None
+
+def update_invoice_index(user_id, invoice_id, refresh_state=False, **fields):
+    """
+    Update the entry of an invoice in the user's invoice index
+    The index maps invoice ids to their current_state, agent_status, locked
+    and transaction_status fields, plus the time of the last update.
+
+    With refresh_state, current_state is read from the invoice state object
+    inside the index update, after the index itself was read, and stored with
+    the state object's ETag. An index write that lost a race with a newer
+    state write is retried and picks up that newer state, so the index cannot
+    be left behind by writers finishing out of order.
+
+    :param user_id: User id
+    :param invoice_id: Invoice id
+    :param refresh_state: Read current_state from the invoice state object
+    :param fields: Index fields to set
+    :return: True if the index was updated, else False
+    """
+    update_time = dt.datetime.now().isoformat()
+    bucket_name = fp.ROOT_BUCKET
+
+    def mutator(invoice_index):
+        entry = invoice_index["invoices"].setdefault(invoice_id, {})
+        entry.update(fields)
+        if refresh_state:
+            state_name = fp.INVOICE_STATE_PATH.format(user_id=user_id, invoice_id=invoice_id)
+            response, state_etag = s3_read.read_file_with_etag_from_s3(bucket_name, state_name)
+            if response is not None and entry.get("state_etag") != state_etag:
+                entry["current_state"] = _get_current_state(json.loads(response))
+                entry["state_etag"] = state_etag
+        entry["last_update_time"] = update_time
+
+    object_name = fp.USER_INVOICE_INDEX_PATH.format(user_id=user_id)
+    status = atomic_update_json(bucket_name, object_name, mutator, default={"invoices": {}})
+    if not status:
+        print(f"Invoice index of user {user_id} is stale for invoice {invoice_id}, run rebuild_invoice_index to repair it")
     return status
 
+def rebuild_invoice_index(user_id):
+    """
+    Rebuild the user's invoice index from the invoice state and lock files
+
+    :param user_id: User id
+    :return: True if the index was written, else False
+    """
+    bucket_name = fp.ROOT_BUCKET
+    invoice_dirs = s3_read.list_childdirectories(bucket_name, f"public/{user_id}/invoices/")
+    invoice_ids = [invoice_dir.rstrip("/").split("/")[-1][len("invoice_"):] for invoice_dir in invoice_dirs]
+    agent_processes = s3_read.read_agent_processes_from_s3(user_id)
+    update_time = dt.datetime.now().isoformat()
+
+    objects = []
+    for invoice_id in invoice_ids:
+        objects.append((bucket_name, fp.INVOICE_STATE_PATH.format(user_id=user_id, invoice_id=invoice_id)))
+        objects.append((bucket_name, fp.INVOICE_LOCKED_PATH.format(user_id=user_id, invoice_id=invoice_id)))
+    results = s3_read.read_many_json_from_s3(objects)
+
+    invoices = {}
+    for i, invoice_id in enumerate(invoice_ids):
+        state, is_locked = results[2 * i].data, results[2 * i + 1].data
+        if invoice_id in agent_processes["completed_agent_processes"]:
+            agent_status = COMPLETE
+        elif invoice_id in agent_processes["open_agent_processes"]:
+            agent_status = INIT
+        else:
+            agent_status = None
+        invoices[invoice_id] = {
+            "current_state": _get_current_state(state),
+            "locked": is_locked["locked"] if is_locked else False,
+            "agent_status": agent_status,
+            "last_update_time": update_time,
+        }
+
+    object_name = fp.USER_INVOICE_INDEX_PATH.format(user_id=user_id)
+    return upload_dict_as_json_to_s3(bucket_name, {"invoices": invoices}, object_name)
+
 def upload_email_token_to_s3(user_id, creds):
     """
     Upload email credentials to S3 bucket
@@ -368,6 +702,72 @@ def upload_email_token_to_s3(user_id, creds):
     status = upload_dict_as_json_to_s3(bucket_name, creds, object_name)
     return status
 
+def acquire_email_token_lease(user_id, owner, duration=EMAIL_TOKEN_LEASE_DURATION):
+    """
+    Take the lease on the user's email token so only one worker refreshes it
+    The lease object is written with a conditional PUT, so of several workers
+    racing for a free or expired lease exactly one gets it.
+
+    :param user_id: User id
+    :param owner: Id of the worker taking the lease
+    :param duration: Seconds until the lease expires if it is not released
+    :return: True if the lease was acquired, else False
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.USER_EMAIL_TOKEN_LEASE_PATH.format(user_id=user_id)
+    response, etag = s3_read.read_file_with_etag_from_s3(bucket_name, object_name)
+    if response is not None:
+        lease = json.loads(response)
+        if lease.get("owner") not in (None, owner) and lease.get("expires_at", 0) > time.time():
+            return False
+    try:
+        return upload_dict_as_json_to_s3_if_match(
+            bucket_name, {"owner": owner, "expires_at": time.time() + duration}, object_name, etag)
+    except ConcurrentModificationError:
+        return False
+
+def release_email_token_lease(user_id, owner):
+    """
+    Release the lease on the user's email token if owner still holds it
+
+    :param user_id: User id
+    :param owner: Id of the worker that took the lease
+    :return: True if the lease was released, else False
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.USER_EMAIL_TOKEN_LEASE_PATH.format(user_id=user_id)
+    response, etag = s3_read.read_file_with_etag_from_s3(bucket_name, object_name)
+    if response is None or json.loads(response).get("owner") != owner:
+        return False
+    try:
+        return upload_dict_as_json_to_s3_if_match(bucket_name, {"owner": None, "expires_at": 0}, object_name, etag)
+    except ConcurrentModificationError:
+        return False
+
+def upload_gmail_sync_state_to_s3(user_id, sync_state):
+    """
+    Upload the Gmail sync state (last synced history id) to S3 bucket
+
+    :param user_id: User id
+    :param sync_state: Gmail sync state
+    :return: True if the sync state was uploaded, else False
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.USER_GMAIL_SYNC_STATE_PATH.format(user_id=user_id)
+    return upload_dict_as_json_to_s3(bucket_name, sync_state, object_name)
+
+def update_gmail_sync_state_in_s3(user_id, new_fields):
+    """
+    Update fields of the Gmail sync state in S3 bucket, creating it if missing
+
+    :param user_id: User id
+    :param new_fields: Dictionary of fields to set
+    :return: True if the sync state was updated, else False
+    """
+    bucket_name = fp.ROOT_BUCKET
+    object_name = fp.USER_GMAIL_SYNC_STATE_PATH.format(user_id=user_id)
+    return atomic_update_json(bucket_name, object_name, lambda sync_state: sync_state.update(new_fields), default={})
+
 def init_agent(user_id, invoice_id, init_state):
     """
     Initialize agent
@@ -378,20 +778,19 @@ def init_agent(user_id, invoice_id, init_state):
     """
     bucket_name = fp.ROOT_BUCKET
 
-    # create state_log file
-    object_name = fp.INVOICE_LOG_PATH.format(user_id=user_id, invoice_id=invoice_id)
-    status = upload_dict_as_json_to_s3(bucket_name, {"state_log": []}, object_name)
-
     # create is_locked.json file and initialize it to False
     object_name = fp.INVOICE_LOCKED_PATH.format(user_id=user_id, invoice_id=invoice_id)
     status = upload_dict_as_json_to_s3(bucket_name, {"locked": False}, object_name)
 
     # update agent_processes.json
-    status = update_agent_processes(user_id, invoice_id, INIT)
+    status = _update_agent_processes_list(user_id, invoice_id, INIT)
 
     object_name = fp.INVOICE_STATE_PATH.format(user_id=user_id, invoice_id=invoice_id)
     status = upload_dict_as_json_to_s3(bucket_name, init_state, object_name)
 
+    # single index update for the lock, agent status and state written above
+    update_invoice_index(user_id, invoice_id, refresh_state=True, locked=False, agent_status=INIT)
+
     log_state(user_id, invoice_id, "INIT_INVOICE_AGENT_LAMBDA", init_state)
     return status
 
@@ -406,6 +805,8 @@ def write_invoice_state_to_s3(user_id, invoice_id, state):
     bucket_name = fp.ROOT_BUCKET
     object_name = fp.INVOICE_STATE_PATH.format(user_id=user_id, invoice_id=invoice_id)
     status = upload_dict_as_json_to_s3(bucket_name, state, object_name)
+    if status:
+        update_invoice_index(user_id, invoice_id, refresh_state=True)
     return status
 
 
@@ -1 +1,7 @@
-REGION_NAME = "us-west-2"
\ No newline at end of file
+REGION_NAME = "us-west-2"
+ACCOUNT_ID = "385772193343"
+
+# timebombs
+TIMEBOMB_LAMBDA_ARN = f"arn:aws:lambda:{REGION_NAME}:{ACCOUNT_ID}:function:timebomb"
+TIMEBOMB_SCHEDULER_ROLE_ARN = f"arn:aws:iam::{ACCOUNT_ID}:role/timebomb-scheduler"
+TIMEBOMB_SCHEDULE_GROUP = "default"
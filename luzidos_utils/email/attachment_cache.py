@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from luzidos_utils.aws_io.s3 import read as s3_read
+from luzidos_utils.aws_io.s3 import write as s3_write
+
+"""
+Content-addressed cache of attachment OCR output and descriptions.
+
+The same invoice is often attached to several messages of a thread or sent
+again by the vendor. Results are stored under the sha256 of the file bytes,
+so OCR and the summary prompt run once per distinct file.
+"""
+
+CACHED_FIELDS = ["attachment_OCR", "attachment_description"]
+
+_stats = {"hits": 0, "misses": 0, "stores": 0}
+_stats_lock = threading.Lock()
+
+
+def _record(counter):
+    with _stats_lock:
+        _stats[counter] += 1
+
+
+def new_hasher():
+    """
+    :return: hashlib object for computing a content hash incrementally
+    """
+    return hashlib.sha256()
+
+
+def hash_bytes(data):
+    """
+    :param data: File contents
+    :return: sha256 hex digest
+    """
+    hasher = new_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_s3_object(bucket_name, object_name):
+    """
+    Hash an S3 object without loading it into memory
+
+    :param bucket_name: Bucket name
+    :param object_name: S3 object name
+    :return: sha256 hex digest, None if the object could not be read
+    """
+    digest = new_hasher()
+    try:
+        for chunk in s3_read.iter_file_chunks_from_s3(bucket_name, object_name):
+            digest.update(chunk)
+    except FileNotFoundError as e:
+        print(e)
+        return None
+    return digest.hexdigest()
+
+
+def lookup(content_hash):
+    """
+    Get the cached OCR and description for an attachment
+
+    :param content_hash: sha256 hex digest of the attachment contents
+    :return: Dictionary with CACHED_FIELDS or None on a miss
+    """
+    if content_hash is None:
+        return None
+    cached_data = s3_read.read_attachment_cache_from_s3(content_hash)
+    if cached_data is None or any(field not in cached_data for field in CACHED_FIELDS):
+        _record("misses")
+        return None
+    _record("hits")
+    return {field: cached_data[field] for field in CACHED_FIELDS}
+
+
+def store(content_hash, attachment_data):
+    """
+    Cache the OCR and description of an attachment
+
+    :param content_hash: sha256 hex digest of the attachment contents
+    :param attachment_data: Attachment data containing CACHED_FIELDS
+    :return: True if the data was stored, else False
+    """
+    if content_hash is None:
+        return False
+    cached_data = {field: attachment_data[field] for field in CACHED_FIELDS}
+    if not s3_write.upload_attachment_cache_to_s3(content_hash, cached_data):
+        return False
+    _record("stores")
+    return True
+
+
+def get_stats():
+    """
+    :return: Dictionary with hit, miss and store counters and the dedup rate
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["dedup_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        for counter in _stats:
+            _stats[counter] = 0
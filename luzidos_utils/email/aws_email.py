@@ -1,15 +1,17 @@
 from luzidos_utils.aws_io.s3 import read as s3_read
 from luzidos_utils.aws_io.s3 import write as s3_write
 from luzidos_utils.aws_io.db import read as db_read
-import boto3
+from luzidos_utils.aws_io import clients
+from luzidos_utils.constants.aws import REGION_NAME
 from email.message import EmailMessage
 from email.parser import BytesParser
 from email import policy
 import email
 from email import encoders
 from email.utils import parseaddr, formataddr, make_msgid
-from luzidos_utils.openai.gpt_call import get_gpt_response
+from luzidos_utils.openai.gpt_call import get_gpt_response_for_long_input
 from luzidos_utils.email import prompts
+from luzidos_utils.email import attachment_cache
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -17,6 +19,10 @@ from datetime import datetime
 import uuid
 import os
 import json
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def _format_address(address):
     name, email = parseaddr(address)
@@ -41,6 +47,33 @@ def _get_email_body(msg):
         # not multipart - i.e. plain text, no attachments, keeping it simple
         return msg.get_payload(decode=True).decode()
 
+def _build_attachment_part(bucket_name, object_name, file_name, hasher=None):
+    """
+    Build a base64 encoded MIME attachment from a file in S3
+
+    The file is streamed and encoded chunk by chunk, so the raw file is never
+    held in memory next to its encoded copy.
+
+    :param hasher: Optional hashlib object updated with the file contents
+    """
+    encoded_lines = []
+    remainder = b''
+    for chunk in s3_read.iter_file_chunks_from_s3(bucket_name, object_name):
+        if hasher is not None:
+            hasher.update(chunk)
+        data = remainder + chunk
+        # base64 lines hold 57 input bytes, keep the rest for the next chunk
+        cut = len(data) - len(data) % 57
+        encoded_lines.append(base64.encodebytes(data[:cut]))
+        remainder = data[cut:]
+    encoded_lines.append(base64.encodebytes(remainder))
+
+    part = MIMEBase('application', "octet-stream")
+    part.set_payload(b''.join(encoded_lines).decode('ascii'))
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', f'attachment; filename="{file_name}"')
+    return part
+
 def _update_email_s3(email_details):
     name, sender = parseaddr(email_details['from'])
     recipients = email_details['to']
@@ -101,105 +134,214 @@ def _update_email_s3(email_details):
 
     return s3_write.upload_email_body_to_s3(userSub, thread_id, email_json)
 
+# attachment processing pipeline settings, timeouts are in seconds
+ATTACHMENT_WORKERS = 8
+COPY_TIMEOUT = 60
+OCR_TIMEOUT = 300
+SUMMARY_TIMEOUT = 120
+PERSIST_TIMEOUT = 60
+
+_attachment_executor = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS, thread_name_prefix="attachments")
+
+def _copy_attachment(attachment_data):
+    print(attachment_data["bucket_name"], attachment_data["source_key"], attachment_data["s3_key"])
+    if not s3_write.copy_file(attachment_data["bucket_name"], attachment_data["source_key"], attachment_data["s3_key"]):
+        raise RuntimeError(f"File copy error for {attachment_data['source_key']}")
+    return attachment_data
+
+def _ocr_attachment(attachment_data):
+    cached_data = attachment_cache.lookup(attachment_data["content_hash"])
+    if cached_data is not None:
+        print('Using cached OCR and description.')
+        attachment_data.update(cached_data)
+        attachment_data["from_cache"] = True
+        return attachment_data
+
+    print('Calling OCR.')
+    lambda_client = clients.get_client('lambda')
+    response = lambda_client.invoke(
+        FunctionName='OCR',
+        InvocationType='RequestResponse',
+        Payload=json.dumps({'s3_bucket': attachment_data["bucket_name"], 's3_key': attachment_data["s3_key"]})
+    )
+    print('Response received.')
+
+    # Process the response from the invoked Lambda
+    payload = json.loads(response['Payload'].read().decode('utf-8'))
+    if response.get('FunctionError'):
+        # the payload is the error, it must not be persisted or cached as OCR output
+        raise RuntimeError(f"OCR failed for {attachment_data['s3_key']}: {payload}")
+    attachment_data["attachment_OCR"] = payload
+    return attachment_data
+
+def _summarize_attachment(attachment_data):
+    if attachment_data.get("from_cache"):
+        return attachment_data
+    attachment_data["attachment_description"] = get_gpt_response_for_long_input(
+        prompts.SUMMARIZE_ATTACHMENT_PROMPT,
+        content=str(attachment_data["attachment_OCR"]),
+        reduce_prompt_template=prompts.SUMMARIZE_ATTACHMENT_PARTS_PROMPT,
+        file_type=attachment_data["attachment_type"], 
+        file_name=attachment_data["attachment_filename"]
+    )
+    return attachment_data
+
+def _persist_attachment(attachment_data):
+    processed_data = {
+        key: attachment_data[key]
+        for key in ["attachment_id", "attachment_filename", "attachment_type", "attachment_OCR", "attachment_description"]
+    }
+    if not s3_write.upload_dict_as_json_to_s3(attachment_data["bucket_name"], processed_data, attachment_data["processed_s3_key"]):
+        raise RuntimeError(f"Failed to upload {attachment_data['processed_s3_key']}")
+    print('OCR response uploaded.')
+    if not attachment_data.get("from_cache"):
+        attachment_cache.store(attachment_data["content_hash"], attachment_data)
+    return attachment_data
+
+class _AttachmentPipeline:
+    """
+    Runs copy -> OCR -> summarize -> persist for every attachment of an email.
+    Attachments move through the stages independently on a shared bounded
+    worker pool, and each stage has its own timeout.
+
+    A stage that times out can not be stopped once it runs and keeps its
+    worker. Such stages are tracked, and when they hold every worker no new
+    stages are submitted, the remaining attachments are reported as failed.
+    """
+    STAGES = [
+        (_copy_attachment, COPY_TIMEOUT),
+        (_ocr_attachment, OCR_TIMEOUT),
+        (_summarize_attachment, SUMMARY_TIMEOUT),
+        (_persist_attachment, PERSIST_TIMEOUT),
+    ]
+
+    def __init__(self, attachments_data):
+        self.attachments_data = attachments_data
+        self.failed_attachment_ids = []
+        # timed out stages still holding a pool worker
+        self._abandoned = set()
+        self._thread = threading.Thread(target=self._run, name="attachment-pipeline")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return not self.failed_attachment_ids
+
+    def _fail(self, attachment_data, stage, reason, error=None):
+        message = f"Attachment {attachment_data['attachment_id']} {reason} in {self.STAGES[stage][0].__name__}"
+        print(f"{message}: {error}" if error is not None else message)
+        self.failed_attachment_ids.append(attachment_data["attachment_id"])
+
+    def _submit(self, pending, stage, attachment_data):
+        self._abandoned = {future for future in self._abandoned if not future.done()}
+        if len(self._abandoned) >= ATTACHMENT_WORKERS:
+            self._fail(attachment_data, stage, "not started", "every worker is held by a timed out stage")
+            return
+        stage_function, stage_timeout = self.STAGES[stage]
+        future = _attachment_executor.submit(stage_function, attachment_data)
+        pending[future] = (stage, attachment_data, time.monotonic() + stage_timeout)
+
+    def _run(self):
+        pending = {}
+        for attachment_data in self.attachments_data:
+            self._submit(pending, 0, attachment_data)
+
+        while pending:
+            next_deadline = min(deadline for _, _, deadline in pending.values())
+            done, not_done = wait(pending, timeout=max(next_deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for future in not_done:
+                stage, attachment_data, deadline = pending[future]
+                if deadline <= now:
+                    del pending[future]
+                    if not future.cancel():
+                        self._abandoned.add(future)
+                    self._fail(attachment_data, stage, "timed out")
+
+            for future in done:
+                stage, attachment_data, _ = pending.pop(future)
+                try:
+                    attachment_data = future.result()
+                except Exception as e:
+                    self._fail(attachment_data, stage, "failed", e)
+                    continue
+                if stage + 1 < len(self.STAGES):
+                    self._submit(pending, stage + 1, attachment_data)
+
 def _handle_attachments(attachments, msg, from_address):
-    lambda_client = boto3.client('lambda')
-    s3_client = boto3.client('s3')
+    """
+    Attach files from S3 to msg and start processing them
+
+    The MIME parts are built first, hashing the files as they are read.
+    Copying, OCR, summarizing and uploading the attachment data then run in
+    the background while the message is sent.
 
+    :return: (msg, attachment ids, _AttachmentPipeline)
+    """
     name, from_address = parseaddr(from_address)
     references = msg.get('References', '')
     if references:
         thread_id = references.split()[0]
     else:
         print('No references found in email object. Attachments function.')
-        return 
+        return msg, [], None
     
-    attachments_OCR = []
+    attachments_data = []
     attachment_ids = []
 
+    # every attachment belongs to the same sender, look the user up once
+    userSub = db_read.get_user_from_db(from_address)
+    if userSub is None:
+        print('Error: User Sub is NONE.')
+        return msg, [], None
+
     for file_path in attachments:
         bucket_name = file_path.split('/')[0]
         object_name = '/'.join(file_path.split('/')[1:])
         attachment_filename, file_extension = os.path.splitext(object_name)
 
-        # Copy file to S3.
         attachment_id = str(uuid.uuid4())  # Generate a unique ID for each attachment
-        userSub = db_read.get_user_from_db(from_address)
-        if userSub is None:
-            print('Error: User Sub is NONE.')
-            return False
-        attachment_s3_key = f"public/{userSub}/emails/email_{thread_id}/attachments/{attachment_id}{file_extension}"
-        print(bucket_name, object_name, attachment_s3_key)
-        if not s3_write.copy_file(bucket_name, object_name, attachment_s3_key):
-            print('File copy error')
-            return 
-
         attachment_ids.append(attachment_id)
-
-
-        attachmentOCR = {
-            'attachment_id': f"{attachment_id}",
-            'filename': attachment_filename,
-            's3_key': attachment_s3_key,
-            'type': file_extension
-        }
-
-        print("Attachment OCR: ", attachmentOCR)
-
-        attachments_OCR.append(attachmentOCR)
-
-        # attachment_ids.append(f"{attachment_id}{file_extension}")
-        file_data = s3_read.read_file_from_s3(bucket_name, object_name)
-        
-        part = MIMEBase('application', "octet-stream")
-        part.set_payload(file_data)
-        encoders.encode_base64(part)
-        
+        attachments_data.append({
+            "attachment_id": attachment_id,
+            "attachment_filename": attachment_filename,
+            "attachment_type": file_extension,
+            "bucket_name": bucket_name,
+            "source_key": object_name,
+            "s3_key": f"public/{userSub}/emails/email_{thread_id}/attachments/{attachment_id}{file_extension}",
+            "processed_s3_key": f"public/{userSub}/emails/email_{thread_id}/attachments/{attachment_id}.json",
+        })
+
+    for file_path, attachment_data in zip(attachments, attachments_data):
+        bucket_name = file_path.split('/')[0]
+        object_name = '/'.join(file_path.split('/')[1:])
         file_name = file_path.split('/')[-1]
-        part.add_header('Content-Disposition', f'attachment; filename="{file_name}"')
-        
+        # the content hash is computed from the bytes read for the MIME part
+        hasher = attachment_cache.new_hasher()
+        part = _build_attachment_part(bucket_name, object_name, file_name, hasher=hasher)
+        attachment_data["content_hash"] = hasher.hexdigest()
         msg.attach(part)
-    
-    for attachment in attachments_OCR:
-        print('Calling OCR.')
-        attachment_data = {}
-        attachment_data["attachment_id"] = attachment['attachment_id']
-        attachment_data["attachment_filename"] = attachment['filename']
-        attachment_data["attachment_type"] = attachment['type']
-
-        response = lambda_client.invoke(
-            FunctionName='OCR',
-            InvocationType='RequestResponse',
-            Payload=json.dumps({'s3_bucket': bucket_name, 's3_key': attachment['s3_key']})
-        )
-        print('Response received.')
-        
-        # Process the response from the invoked Lambda
-        response_payload = json.loads(response['Payload'].read().decode('utf-8'))
-        attachment_data["attachment_OCR"] = response_payload
-
-        # Summarize email
-        summarize_prompt = prompts.SUMMARIZE_ATTACHMENT_PROMPT.format(
-            file_type=attachment_data["attachment_type"], 
-            file_name=attachment_data["attachment_filename"], 
-            file_content=attachment_data["attachment_OCR"]
-        )
-        attachment_data["attachment_description"] = get_gpt_response(summarize_prompt)
-        
-        # Upload the response to S3
-        processed_s3_key = f"public/{userSub}/emails/email_{thread_id}/attachments/{attachment['attachment_id']}.json"
-        s3_client.put_object(Bucket=bucket_name, Key=processed_s3_key, Body=json.dumps(attachment_data))
-        print('OCR response uploaded.')
 
-    return msg, attachment_ids
+    attachment_pipeline = _AttachmentPipeline(attachments_data).start()
+
+    return msg, attachment_ids, attachment_pipeline
     
 
-def send_message(from_address, to_address, subject, body, attachments=None, cc=None, thread_id=None, message_id=None):
+def send_message(from_address, to_address, subject, body, attachments=None, cc=None, thread_id=None, message_id=None, wait_for_attachments=True):
     """Create and send an email message
     Print the returned message id
+    Attachments are processed concurrently while the email is sent. With
+    wait_for_attachments=False the function returns as soon as SES accepts
+    the email and processing finishes in the background, which is only
+    safe in long-running processes.
     Returns: Message object, including message id
     """
     
-    ses = boto3.client('ses', region_name='us-west-2')
+    ses = clients.get_client('ses', region_name=REGION_NAME)
 
     msg = MIMEMultipart()
     
@@ -222,8 +364,9 @@ def send_message(from_address, to_address, subject, body, attachments=None, cc=N
 
     # Attachments
     attachment_ids = []
+    attachment_pipeline = None
     if attachments:
-        msg, attachment_ids = _handle_attachments(attachments, msg, msg['From'])
+        msg, attachment_ids, attachment_pipeline = _handle_attachments(attachments, msg, msg['From'])
      
     # Send the email
     try:
@@ -251,13 +394,16 @@ def send_message(from_address, to_address, subject, body, attachments=None, cc=N
         return msg['References']
     except Exception as e:
         print("Failed to send email:", e)
+    finally:
+        if attachment_pipeline is not None and wait_for_attachments:
+            attachment_pipeline.wait()
 
     return
 
 
-def _reply_to_message(workmail_message_id, body, attachments=None, reply_all=False):
-    workmail = boto3.client('workmailmessageflow', region_name='us-west-2')
-    ses = boto3.client('ses', region_name='us-west-2')
+def _reply_to_message(workmail_message_id, body, attachments=None, reply_all=False, wait_for_attachments=True):
+    workmail = clients.get_client('workmailmessageflow', region_name=REGION_NAME)
+    ses = clients.get_client('ses', region_name=REGION_NAME)
 
     # Fetch the original email content from WorkMail using the thread_id (message ID)
     raw_msg = workmail.get_raw_message_content(messageId=workmail_message_id)
@@ -348,8 +494,9 @@ def _reply_to_message(workmail_message_id, body, attachments=None, reply_all=Fal
 
     # Attachments
     attachment_ids = []
+    attachment_pipeline = None
     if attachments:
-        new_msg, attachment_ids = _handle_attachments(attachments, new_msg, new_msg['From'])
+        new_msg, attachment_ids, attachment_pipeline = _handle_attachments(attachments, new_msg, new_msg['From'])
 
     try:
         # Send the email using SES
@@ -377,17 +524,20 @@ def _reply_to_message(workmail_message_id, body, attachments=None, reply_all=Fal
         return thread_id
     except Exception as e:
         print("Failed to send email:", e)
+    finally:
+        if attachment_pipeline is not None and wait_for_attachments:
+            attachment_pipeline.wait()
         
     return
 
 
-def reply_to_thread(thread_id, email_data, body, attachments=None, reply_all=False):
-    ses = boto3.client('ses', region_name='us-west-2')
+def reply_to_thread(thread_id, email_data, body, attachments=None, reply_all=False, wait_for_attachments=True):
+    ses = clients.get_client('ses', region_name=REGION_NAME)
     latest_email = list(email_data["messages"].values())[-1]
     latest_email_message_id = list(email_data["messages"].keys())[-1]
 
     if latest_email['workmail_id'] is not None:
-        return _reply_to_message(latest_email['workmail_id'], body, attachments, reply_all)
+        return _reply_to_message(latest_email['workmail_id'], body, attachments, reply_all, wait_for_attachments)
 
     # Construct the new email message
     new_msg = MIMEMultipart()
@@ -415,8 +565,9 @@ def reply_to_thread(thread_id, email_data, body, attachments=None, reply_all=Fal
 
     # Attachments
     attachment_ids = []
+    attachment_pipeline = None
     if attachments:
-        new_msg, attachment_ids = _handle_attachments(attachments, new_msg, new_msg['From'])
+        new_msg, attachment_ids, attachment_pipeline = _handle_attachments(attachments, new_msg, new_msg['From'])
 
 
     try:
@@ -445,6 +596,9 @@ def reply_to_thread(thread_id, email_data, body, attachments=None, reply_all=Fal
         return thread_id
     except Exception as e:
         print("Failed to send email:", e)
+    finally:
+        if attachment_pipeline is not None and wait_for_attachments:
+            attachment_pipeline.wait()
         
     return
 
@@ -1,7 +1,9 @@
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.http import HttpRequest
+from googleapiclient import discovery_cache
 from googleapiclient.errors import HttpError
 from googleapiclient import errors
 from email.mime.text import MIMEText
@@ -18,10 +20,20 @@ import requests
 from luzidos_utils.aws_io.s3 import read as s3_read
 from luzidos_utils.aws_io.s3 import write as s3_write
 from luzidos_utils.aws_io.s3 import file_paths as s3_fp
-from luzidos_utils.openai.gpt_call import get_gpt_response
+from luzidos_utils.openai.gpt_call import get_gpt_response_for_long_input
 from luzidos_utils.email import prompts
+from luzidos_utils.email import attachment_cache
+from luzidos_utils.email import streams
 import uuid
 import json
+import threading
+import random
+import time
+import datetime as dt
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from concurrent.futures import ThreadPoolExecutor
+from luzidos_utils.constants.format import DATE_TIME_FORMAT
 
 HEADER = '\033[95m'
 OKBLUE = '\033[94m'
@@ -33,75 +45,410 @@ ENDC = '\033[0m'
 BOLD = '\033[1m'
 UNDERLINE = '\033[4m'
 
+# Gmail batch request limits
+THREAD_PAGE_SIZE = 100
+# threads fetched per batch request, larger batches hit the per user rate limit
+THREAD_BATCH_SIZE = 15
+THREAD_FETCH_RETRIES = 4
+THREAD_FETCH_BACKOFF = 1.0
+# runs a thread may fail before sync moves past it
+MAX_THREAD_FAILURES = 3
+BATCH_MODIFY_LIMIT = 1000
+ATTACHMENT_DOWNLOAD_WORKERS = 4
+# messages added with these labels are our own replies and drafts, not new mail
+INCREMENTAL_SYNC_SKIP_LABELS = {"SENT", "DRAFT"}
+# attachments up to this size are decoded in memory, larger ones are streamed to s3
+INLINE_ATTACHMENT_LIMIT = 8 * 1024 * 1024
+
+GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# tokens expiring within this margin are refreshed before the client is handed out
+TOKEN_REFRESH_MARGIN = dt.timedelta(minutes=5)
+# seconds between checks for a token refreshed by the worker holding the lease
+TOKEN_LEASE_POLL_INTERVAL = 1.0
+
+# parsed discovery documents by (service name, version)
+_discovery_documents = {}
+_discovery_documents_lock = threading.Lock()
+# GmailClient per user id, see get_gmail_client
+_gmail_clients = {}
+_gmail_clients_lock = threading.Lock()
+# one lock per user id so only one thread builds a client or refreshes its token at a time
+_user_locks = {}
+
+
+def _get_user_lock(user_id):
+    with _gmail_clients_lock:
+        return _user_locks.setdefault(user_id, threading.RLock())
+
+
+def _get_discovery_document(service_name, version):
+    """
+    Parse the discovery document shipped with googleapiclient once per process
+    :return: Discovery document dictionary, None if the library has no static copy
+    """
+    key = (service_name, version)
+    with _discovery_documents_lock:
+        if key not in _discovery_documents:
+            document = discovery_cache.get_static_doc(service_name, version)
+            _discovery_documents[key] = json.loads(document) if document else None
+        return _discovery_documents[key]
+
+
+def _build_service(creds, request_builder=HttpRequest, service_name="gmail", version="v1"):
+    document = _get_discovery_document(service_name, version)
+    if document is None:
+        return build(service_name, version, credentials=creds, requestBuilder=request_builder)
+    return build_from_document(document, credentials=creds, requestBuilder=request_builder)
+
+
+def _credentials_need_refresh(creds):
+    """
+    :return: True if the credentials are invalid or expire within TOKEN_REFRESH_MARGIN
+    """
+    if creds is None or not creds.valid:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as a naive utc datetime
+    now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    return creds.expiry - TOKEN_REFRESH_MARGIN <= now
+
 class GmailClient:
     def __init__(self, token_data, credentials_data, scopes, user_id):
         self.service = None
-        self.creds = self.get_credentials(user_id, token_data, credentials_data, scopes)
+        self._thread_local = threading.local()
         self.user_id = user_id
+        self.credentials_data = credentials_data
+        self.scopes = scopes
+        self.creds = self.get_credentials(user_id, token_data, credentials_data, scopes)
         if self.creds:
-            self.service = build("gmail", "v1", credentials=self.creds)
+            self.service = _build_service(self.creds, self.__build_request)
+
+    def iter_thread_pages(self, query="", page_token=None, max_threads=None, page_size=None):
+        """Iterate over the pages of threads matching a query.
+        Args:
+            query: The query string used to filter threads.
+            page_token: Page to start from, None for the first page.
+            max_threads: Stop after this many threads, None for no limit.
+            page_size: Threads per page, defaults to THREAD_PAGE_SIZE.
+        Yields:
+            (thread ids of the page, token of the next page or None on the last page)
+        """
+        page_size = page_size or THREAD_PAGE_SIZE
+        remaining = max_threads
+        while remaining is None or remaining > 0:
+            request_kwargs = {"userId": "me", "maxResults": page_size if remaining is None else min(page_size, remaining)}
+            if query:
+                request_kwargs["q"] = query
+            if page_token:
+                request_kwargs["pageToken"] = page_token
+            response = self.service.users().threads().list(**request_kwargs).execute()
+            page_thread_ids = [thread["id"] for thread in response.get("threads", [])]
+            page_token = response.get("nextPageToken")
+            yield page_thread_ids, page_token
+            if not page_token:
+                return
+            if remaining is not None:
+                remaining -= len(page_thread_ids)
 
     # Fetch messages based on the query - read/unread
-    def upload_unread_messages_to_s3(self, query):
+    def upload_unread_messages_to_s3(self, query, max_threads=None, resume=True):
         """Get messages from the user's mailbox.
         Uploads all of the unread messages to s3 in the format that I chose
         It also uploads all of its relevant attachments to s3
         It also applies ocr to the attachments and uploads the ocr data to s3
+        Threads are processed page by page and only threads with new messages are written to s3.
+        The next page token is checkpointed in s3 after every page, so a run that stops early
+        (max_threads reached, timeout) continues from there on the next call with the same query.
         Args:
             query: The query string used to filter messages.
+            max_threads: Maximum number of threads to process in this run, None for no limit.
+            resume: Continue from the stored checkpoint of an unfinished run.
         Returns:
-            A dictionary of messages.
+            A list of the thread ids written to s3.
         """
-        if len(query) == 0:
-            try:
-                threads = (self.service.users().threads().list(userId="me").execute().get("threads", []))
-            except errors.HttpError as error:
-                print(f'An error occurred: {error}')
-
-        else:
-            threads = (self.service.users().threads().list(userId="me", q=query).execute().get("threads", []))
+        thread_ids, _ = self.__upload_thread_pages(query, max_threads, resume)
+        return thread_ids
 
-        
+    def __upload_thread_pages(self, query, max_threads, resume):
+        """
+        Returns:
+            (thread ids written to s3, True if the last page was reached)
+        """
+        page_token = None
+        if resume:
+            sync_state = s3_read.read_gmail_sync_state_from_s3(self.user_id) or {}
+            checkpoint = sync_state.get("page_checkpoint")
+            if checkpoint and checkpoint.get("query") == query:
+                print("Resuming thread listing from checkpoint.")
+                page_token = checkpoint["page_token"]
 
         thread_ids = []
-        for thread in threads:
-            tdata = (self.service.users().threads().get(userId="me", id=thread["id"]).execute())
-            nmsgs = len(tdata["messages"])
-            print("Messages per thread: ", nmsgs)
-
-            threadObj = {}
-            threadObj['thread_id'] = thread['id']
-            threadObj['messages'] = {}
-            email_data = s3_read.read_email_body_from_s3(self.user_id, thread["id"])
-
-            for rawMsgObj in tdata["messages"]:       
-                if email_data and rawMsgObj['id'] in email_data["messages"]:
-                    threadObj['messages'][rawMsgObj['id']] = email_data["messages"][rawMsgObj['id']]
-                    continue
-                extracted_data = {}
-                keys_of_interest = ['From', 'To', 'Date', 'Subject']
-
-                for header in rawMsgObj['payload']['headers']:
-                    if header['name'] in keys_of_interest:
-                        extracted_data[header['name']] = header['value']
-
-                extracted_data['labelIds'] = rawMsgObj['labelIds']
-                message_contents = self.__parse_message(rawMsgObj)
-                extracted_data['body'] = message_contents["body"]
-                extracted_data['attachments'] = message_contents["attachments"]
-
-                msgObj = extracted_data
-                msgObj['message_id'] = rawMsgObj['id']
-                threadObj['messages'][rawMsgObj['id']] = msgObj 
-
-                if "UNREAD" in rawMsgObj['labelIds']:
-                    print(f"Marking message {rawMsgObj['id']} as read.")
-                    self.__mark_message_as_read(rawMsgObj['id'])
-                else:
-                    print(rawMsgObj['labelIds'])
-            thread_ids.append(threadObj['thread_id'])
-            s3_write.upload_email_body_to_s3(self.user_id, threadObj['thread_id'], threadObj)
+        try:
+            for page_thread_ids, next_page_token in self.__iter_thread_pages_from_checkpoint(query, page_token, max_threads):
+                synced_thread_ids, failed_thread_ids = self.__sync_threads(page_thread_ids)
+                thread_ids.extend(synced_thread_ids)
+                if self.__record_thread_failures(page_thread_ids, failed_thread_ids):
+                    # keep the checkpoint on this page so the failed threads are fetched again next run
+                    print(f"Failed to fetch {len(failed_thread_ids)} threads, stopping at this page.")
+                    return thread_ids, False
+                checkpoint = {"query": query, "page_token": next_page_token} if next_page_token else None
+                s3_write.update_gmail_sync_state_in_s3(self.user_id, {"page_checkpoint": checkpoint})
+                if not next_page_token:
+                    return thread_ids, True
+        except errors.HttpError as error:
+            print(f'An error occurred: {error}')
+        return thread_ids, False
+
+    def __iter_thread_pages_from_checkpoint(self, query, page_token, max_threads):
+        """iter_thread_pages from a checkpoint page token.
+        A stale or invalid token is rejected with 400, the checkpoint is then
+        cleared and the listing starts over from the first page.
+        """
+        pages = self.iter_thread_pages(query, page_token, max_threads)
+        try:
+            first_page = next(pages, None)
+        except errors.HttpError as error:
+            if page_token is None or error.resp.status != 400:
+                raise
+            print(f"Invalid checkpoint page token, restarting thread listing: {error}")
+            s3_write.update_gmail_sync_state_in_s3(self.user_id, {"page_checkpoint": None})
+            pages = self.iter_thread_pages(query, None, max_threads)
+            first_page = next(pages, None)
+        if first_page is not None:
+            yield first_page
+            yield from pages
+
+    def sync_messages_to_s3(self, query="", label_id="INBOX", full_sync=False, max_threads=None):
+        """Incrementally sync the user's mailbox to s3.
+        The mailbox historyId is stored in s3 after every sync, the next sync only
+        fetches threads with messages added since then. Falls back to a full sync
+        with upload_unread_messages_to_s3 on the first sync, when full_sync is set
+        or when Gmail no longer has the stored history. A full sync that stops early
+        is continued by the next call.
+        The history API can not apply a search query, so query only filters full
+        syncs. Incremental syncs only pick up messages added with label_id and
+        never our own sent messages or drafts.
+        Args:
+            query: The query string used to filter threads on a full sync.
+            label_id: Only sync messages added with this label on an incremental sync, None for any label.
+            full_sync: Start a new full sync.
+            max_threads: Maximum number of threads processed per full sync run, None for no limit.
+        Returns:
+            A list of the thread ids written to s3.
+        """
+        sync_state = s3_read.read_gmail_sync_state_from_s3(self.user_id)
+        if full_sync or not sync_state or not sync_state.get("history_id"):
+            return self.__full_sync(query, max_threads, restart=full_sync)
+
+        try:
+            changed_thread_ids, history_id = self.__list_changed_threads(sync_state["history_id"], label_id)
+        except errors.HttpError as error:
+            if error.resp.status == 404:
+                # history ids expire after about a week
+                print(f"History id {sync_state['history_id']} expired, running a full sync.")
+                return self.__full_sync(query, max_threads, restart=True)
+            print(f'An error occurred: {error}')
+            return []
+
+        try:
+            thread_ids, failed_thread_ids = self.__sync_threads(changed_thread_ids)
+        except errors.HttpError as error:
+            print(f'An error occurred: {error}')
+            return []
+        if self.__record_thread_failures(changed_thread_ids, failed_thread_ids):
+            # keep the old history id so the next sync lists the failed threads again
+            print(f"Failed to fetch {len(failed_thread_ids)} threads, history id not advanced.")
+            return thread_ids
+        s3_write.update_gmail_sync_state_in_s3(self.user_id, {
+            "history_id": history_id,
+            "last_sync": dt.datetime.now().strftime(DATE_TIME_FORMAT),
+        })
+        return thread_ids
+
+    def __full_sync(self, query, max_threads=None, restart=False):
+        sync_state = s3_read.read_gmail_sync_state_from_s3(self.user_id) or {}
+        history_id = None if restart else sync_state.get("full_sync_history_id")
+        if history_id is None:
+            # read the history id first so messages added during the sync are picked up by the next one
+            history_id = self.service.users().getProfile(userId="me").execute()["historyId"]
+            s3_write.update_gmail_sync_state_in_s3(self.user_id, {
+                "history_id": None,
+                "full_sync_history_id": history_id,
+                "page_checkpoint": None,
+            })
+
+        thread_ids, complete = self.__upload_thread_pages(query, max_threads, resume=True)
+        if complete:
+            now = dt.datetime.now().strftime(DATE_TIME_FORMAT)
+            s3_write.update_gmail_sync_state_in_s3(self.user_id, {
+                "history_id": history_id,
+                "full_sync_history_id": None,
+                "last_full_sync": now,
+                "last_sync": now,
+            })
         return thread_ids
+
+    def __list_changed_threads(self, start_history_id, label_id=None):
+        """List the threads with messages added since start_history_id.
+        Returns:
+            (thread ids in the order they changed, current mailbox history id)
+        """
+        request_kwargs = {"userId": "me", "startHistoryId": start_history_id, "historyTypes": ["messageAdded"]}
+        if label_id is not None:
+            request_kwargs["labelId"] = label_id
+
+        thread_ids = {}
+        history_id = start_history_id
+        page_token = None
+        while True:
+            if page_token:
+                request_kwargs["pageToken"] = page_token
+            response = self.service.users().history().list(**request_kwargs).execute()
+            for history_record in response.get("history", []):
+                for message_added in history_record.get("messagesAdded", []):
+                    if INCREMENTAL_SYNC_SKIP_LABELS.intersection(message_added["message"].get("labelIds", [])):
+                        continue
+                    thread_ids[message_added["message"]["threadId"]] = None
+            history_id = response.get("historyId", history_id)
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+        return list(thread_ids), history_id
+
+    def __sync_threads(self, thread_ids):
+        """Fetch threads in batches and write the ones with new messages to s3.
+        New unread messages are marked as read with a single batchModify.
+        Returns:
+            (thread ids written to s3, thread ids that could not be fetched)
+        """
+        synced_thread_ids = []
+        failed_thread_ids = []
+        unread_message_ids = []
+        for start in range(0, len(thread_ids), THREAD_BATCH_SIZE):
+            batch_thread_ids = thread_ids[start:start + THREAD_BATCH_SIZE]
+            threads_data, batch_failed_ids = self.__get_threads(batch_thread_ids)
+            failed_thread_ids.extend(batch_failed_ids)
+            for thread_id in batch_thread_ids:
+                if thread_id in threads_data and self.__sync_thread(thread_id, threads_data[thread_id], unread_message_ids):
+                    synced_thread_ids.append(thread_id)
+        self.__mark_messages_as_read(unread_message_ids)
+        return synced_thread_ids, failed_thread_ids
+
+    def __record_thread_failures(self, thread_ids, failed_thread_ids):
+        """Count the runs each thread failed in, in the sync state.
+        Threads that failed MAX_THREAD_FAILURES runs are recorded in skipped_threads
+        and no longer hold back the page checkpoint or the history id.
+        Returns:
+            True if sync progress must be held for a failed thread.
+        """
+        sync_state = s3_read.read_gmail_sync_state_from_s3(self.user_id) or {}
+        thread_failures = dict(sync_state.get("thread_failures") or {})
+        if not failed_thread_ids and not thread_failures:
+            return False
+
+        skipped_threads = dict(sync_state.get("skipped_threads") or {})
+        for thread_id in thread_ids:
+            if thread_id not in failed_thread_ids:
+                thread_failures.pop(thread_id, None)
+        hold = False
+        for thread_id in failed_thread_ids:
+            thread_failures[thread_id] = thread_failures.get(thread_id, 0) + 1
+            if thread_failures[thread_id] >= MAX_THREAD_FAILURES:
+                print(f"Thread {thread_id} failed {thread_failures[thread_id]} runs, skipping it.")
+                del thread_failures[thread_id]
+                skipped_threads[thread_id] = dt.datetime.now().strftime(DATE_TIME_FORMAT)
+            else:
+                hold = True
+        s3_write.update_gmail_sync_state_in_s3(self.user_id, {
+            "thread_failures": thread_failures,
+            "skipped_threads": skipped_threads,
+        })
+        return hold
+
+    def __get_threads(self, thread_ids):
+        """Fetch many threads in one batch request.
+        Threads that fail, e.g. with 429 rateLimitExceeded, are retried in a new
+        batch with jittered backoff. Deleted threads (404) are skipped.
+        Returns:
+            (dictionary of thread id to thread data, thread ids that still failed after the retries)
+        """
+        threads_data = {}
+        failed_thread_ids = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                threads_data[request_id] = response
+            elif isinstance(exception, errors.HttpError) and exception.resp.status == 404:
+                print(f'Thread {request_id} no longer exists.')
+            else:
+                print(f'An error occurred fetching thread {request_id}: {exception}')
+                failed_thread_ids.append(request_id)
+
+        remaining_ids = list(thread_ids)
+        for attempt in range(THREAD_FETCH_RETRIES):
+            if attempt:
+                time.sleep(THREAD_FETCH_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            failed_thread_ids.clear()
+            batch = self.service.new_batch_http_request(callback=callback)
+            for thread_id in remaining_ids:
+                batch.add(self.service.users().threads().get(userId="me", id=thread_id), request_id=thread_id)
+            try:
+                batch.execute()
+            except errors.HttpError as error:
+                print(f'An error occurred executing the batch: {error}')
+                failed_thread_ids[:] = [thread_id for thread_id in remaining_ids if thread_id not in threads_data]
+            remaining_ids = list(failed_thread_ids)
+            if not remaining_ids:
+                break
+        return threads_data, remaining_ids
+
+    def __sync_thread(self, thread_id, tdata, unread_message_ids):
+        """Write a thread to s3 if it has messages that are not in s3 yet.
+        Ids of new unread messages are appended to unread_message_ids.
+        Returns:
+            True if the thread was written to s3.
+        """
+        nmsgs = len(tdata["messages"])
+        print("Messages per thread: ", nmsgs)
+
+        threadObj = {}
+        threadObj['thread_id'] = thread_id
+        threadObj['messages'] = {}
+        email_data = s3_read.read_email_body_from_s3(self.user_id, thread_id)
+
+        changed = not email_data
+        for rawMsgObj in tdata["messages"]:       
+            if email_data and rawMsgObj['id'] in email_data["messages"]:
+                threadObj['messages'][rawMsgObj['id']] = email_data["messages"][rawMsgObj['id']]
+                continue
+            changed = True
+            extracted_data = {}
+            keys_of_interest = ['From', 'To', 'Date', 'Subject']
+
+            for header in rawMsgObj['payload']['headers']:
+                if header['name'] in keys_of_interest:
+                    extracted_data[header['name']] = header['value']
+
+            extracted_data['labelIds'] = rawMsgObj['labelIds']
+            message_contents = self.__parse_message(rawMsgObj)
+            extracted_data['body'] = message_contents["body"]
+            extracted_data['attachments'] = message_contents["attachments"]
+
+            msgObj = extracted_data
+            msgObj['message_id'] = rawMsgObj['id']
+            threadObj['messages'][rawMsgObj['id']] = msgObj 
+
+            if "UNREAD" in rawMsgObj['labelIds']:
+                print(f"Marking message {rawMsgObj['id']} as read.")
+                unread_message_ids.append(rawMsgObj['id'])
+            else:
+                print(rawMsgObj['labelIds'])
+
+        if not changed:
+            return False
+        s3_write.upload_email_body_to_s3(self.user_id, threadObj['thread_id'], threadObj)
+        return True
     
     def send_message(self, sender, to, subject, body, attachments=None, cc=None, thread_id=None, message_id=None):
         """Create and send an email message
@@ -184,64 +531,109 @@ class GmailClient:
             print(f"An error occurred: {error}")
             return None
 
-    def __mark_message_as_read(self, message_id):
-        """Marks a message as read by removing the 'UNREAD' label."""
-        try:
-            body = {'removeLabelIds': ['UNREAD']}
-            self.service.users().messages().modify(userId="me", id=message_id, body=body).execute()
-        except errors.HttpError as error:
-            print(f'An error occurred: {error}')
-
+    def __mark_messages_as_read(self, message_ids):
+        """Marks messages as read by removing the 'UNREAD' label, up to 1000 messages per request."""
+        for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+            try:
+                body = {'ids': message_ids[start:start + BATCH_MODIFY_LIMIT], 'removeLabelIds': ['UNREAD']}
+                self.service.users().messages().batchModify(userId="me", body=body).execute()
+            except errors.HttpError as error:
+                print(f'An error occurred: {error}')
 
-    def __handle_attachments(self, payload, tdata):
-        """Download all attachments from a given email."""
-        attachment_ids = []
-        for part in payload['parts']:
-            if part['filename']:
-                bucket_name = s3_fp.ROOT_BUCKET
-
-                attachment_id = part['body']['attachmentId']
-                attachment = self.service.users().messages().attachments().get(userId="me", messageId=tdata, id=attachment_id).execute()
-                data = attachment['data']
-                file_data = base64.urlsafe_b64decode(data.encode('UTF-8'))
-                # Use BytesIO for in-memory file
-                file_obj = BytesIO(file_data)
-
-                attachment_filename = part['filename']
-                email_id = tdata['threadId']
-
-                attachment_type = attachment_filename.split('.')[-1]
-                attachment_name = ".".join(attachment_filename.split('.')[:-1])
-                # create using UUID
-                attachment_id = str(uuid.uuid4())
-                # Upload to S3
-                if s3_write.upload_email_attachment_to_s3(self.user_id,email_id, file_obj, f"{attachment_id}.{attachment_type}"):
-                    print(f"Attachment {part['filename']} uploaded to S3.")
-                else:
-                    print(f"Failed to upload {part['filename']}.")
-
-                attachment_data = {}
-                attachment_data["attachment_id"] = attachment_id
-                attachment_data["attachment_filename"] = attachment_name
-                attachment_data["attachment_type"] = attachment_type
-                # Apply OCR
-                ocr_api_url = "https://62n2j8msb4.execute-api.us-west-2.amazonaws.com/ocr_testing/ocr"
-                params = {'s3_bucket': bucket_name, 's3_key': s3_fp.EMAIL_ATTACHMENT_PATH(self.user_id, email_id, f"{attachment_id}.{attachment_type}")}
-                ocr_response = requests.get(ocr_api_url, params=params)
-                if ocr_response.status_code == 200:
-                    ocr_data = ocr_response.json()
-                    attachment_data["attachment_OCR"] = ocr_data.get("text", "OCR failed or returned no text.")
-                else:
-                    attachment_data["attachment_OCR"] = ocr_data.get("text", "OCR failed or returned no text.")
+    def __build_request(self, http, *args, **kwargs):
+        """Request builder of the service, requests run on the transport of the calling thread.
+        Clients are shared between threads by get_gmail_client and httplib2.Http is not thread safe."""
+        return HttpRequest(self.__thread_http() or http, *args, **kwargs)
 
-                # Summarize email
-                summarize_prompt = prompts.SUMMARIZE_ATTAACHMENT_PROMPT(attachment_type, attachment_name, attachment_data["attachment_OCR"])
-                attachment_data["attachment_description"] = get_gpt_response(summarize_prompt)
-                # upload data
-                s3_write.upload_email_attachment_json_to_s3(self.user_id, email_id, f"{attachment_id}.json", attachment_data)
-                attachment_ids.append(attachment_id)
+    def __thread_http(self):
+        """HTTP transport for the current thread, httplib2 connections can not be shared between threads."""
+        if self.creds is None:
+            return None
+        http = getattr(self._thread_local, "http", None)
+        if http is None:
+            http = AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._thread_local.http = http
+        return http
 
-        return attachment_ids
+    def __handle_attachments(self, payload, tdata):
+        """Download all attachments from a given email.
+        Attachments are downloaded and processed concurrently, ids are returned in the order of the parts."""
+        file_parts = [part for part in payload['parts'] if part['filename']]
+        if not file_parts:
+            return []
+        with ThreadPoolExecutor(max_workers=min(ATTACHMENT_DOWNLOAD_WORKERS, len(file_parts))) as executor:
+            return list(executor.map(lambda part: self.__handle_attachment(part, tdata), file_parts))
+
+    def __handle_attachment(self, part, tdata):
+        """Download an attachment, upload it to s3 with its OCR and description."""
+        bucket_name = s3_fp.ROOT_BUCKET
+
+        if 'data' in part['body']:
+            # small attachments are sent inline
+            data = part['body']['data']
+        else:
+            attachment = self.service.users().messages().attachments().get(userId="me", messageId=tdata['id'], id=part['body']['attachmentId']).execute(http=self.__thread_http())
+            data = attachment.pop('data')
+            del attachment
+
+        attachment_filename = part['filename']
+        email_id = tdata['threadId']
+
+        attachment_type = attachment_filename.split('.')[-1]
+        attachment_name = ".".join(attachment_filename.split('.')[:-1])
+        # create using UUID
+        attachment_id = str(uuid.uuid4())
+
+        hasher = None
+        if streams.decoded_size(data) <= INLINE_ATTACHMENT_LIMIT:
+            file_data = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+            content_hash = attachment_cache.hash_bytes(file_data)
+            # Use BytesIO for in-memory file
+            file_obj = BytesIO(file_data)
+        else:
+            # decode while uploading, the multipart upload reads the stream part by part
+            hasher = attachment_cache.new_hasher()
+            file_obj = streams.open_base64url_stream(data, hasher=hasher)
+        # Upload to S3
+        uploaded = s3_write.upload_email_attachment_to_s3(self.user_id,email_id, file_obj, f"{attachment_id}.{attachment_type}")
+        if uploaded:
+            print(f"Attachment {part['filename']} uploaded to S3.")
+        else:
+            print(f"Failed to upload {part['filename']}.")
+        if hasher is not None:
+            # the upload normally reads the stream to the end, hash whatever it left behind
+            while uploaded and file_obj.read(streams.DECODE_CHUNK_SIZE):
+                pass
+            content_hash = hasher.hexdigest() if uploaded else None
+        del data, file_obj
+
+        attachment_data = {}
+        attachment_data["attachment_id"] = attachment_id
+        attachment_data["attachment_filename"] = attachment_name
+        attachment_data["attachment_type"] = attachment_type
+
+        # Reuse OCR and description of identical files
+        cached_data = attachment_cache.lookup(content_hash)
+        if cached_data is not None:
+            attachment_data.update(cached_data)
+        else:
+            # Apply OCR
+            ocr_api_url = "https://62n2j8msb4.execute-api.us-west-2.amazonaws.com/ocr_testing/ocr"
+            params = {'s3_bucket': bucket_name, 's3_key': s3_fp.EMAIL_ATTACHMENT_PATH.format(user_id=self.user_id, email_id=email_id, attachment_name=f"{attachment_id}.{attachment_type}")}
+            ocr_response = requests.get(ocr_api_url, params=params)
+            ocr_data = ocr_response.json() if ocr_response.status_code == 200 else {}
+            attachment_data["attachment_OCR"] = ocr_data.get("text", "OCR failed or returned no text.")
+
+            # Summarize email
+            attachment_data["attachment_description"] = get_gpt_response_for_long_input(
+                prompts.SUMMARIZE_ATTACHMENT_PROMPT, content=attachment_data["attachment_OCR"],
+                reduce_prompt_template=prompts.SUMMARIZE_ATTACHMENT_PARTS_PROMPT,
+                file_type=attachment_type, file_name=attachment_name)
+            if ocr_response.status_code == 200:
+                attachment_cache.store(content_hash, attachment_data)
+        # upload data
+        s3_write.upload_email_attachment_json_to_s3(self.user_id, email_id, f"{attachment_id}.json", attachment_data)
+        return attachment_id
 
 
     def __parse_message(self, tdata):
@@ -301,26 +693,97 @@ class GmailClient:
         creds = None
         if token_data:
             creds = Credentials.from_authorized_user_info(token_data, scopes)
+        if not _credentials_need_refresh(creds):
+            return creds
+
+        # only one thread per process and one worker per user refreshes, the
+        # others wait on the lock or the s3 lease and pick up the new token
+        with _get_user_lock(user_id):
+            owner = str(uuid.uuid4())
+            deadline = time.time() + s3_write.EMAIL_TOKEN_LEASE_DURATION
+            while True:
+                acquired = s3_write.acquire_email_token_lease(user_id, owner)
+                # another thread or worker may have refreshed the token already
+                stored_token_data = s3_read.read_email_token_from_s3(user_id, use_cache=False)
+                if stored_token_data:
+                    stored_creds = Credentials.from_authorized_user_info(stored_token_data, scopes)
+                    if not _credentials_need_refresh(stored_creds):
+                        if acquired:
+                            s3_write.release_email_token_lease(user_id, owner)
+                        return stored_creds
+                    creds = stored_creds
+                # a lease that outlived its holder expires, refresh without it after that
+                if acquired or time.time() >= deadline:
+                    break
+                time.sleep(TOKEN_LEASE_POLL_INTERVAL)
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_config(credentials_data, scopes)
-                creds = flow.run_local_server(port=0)
+            try:
+                if creds and creds.refresh_token:
+                    creds.refresh(Request())
+                else:
+                    flow = InstalledAppFlow.from_client_config(credentials_data, scopes)
+                    creds = flow.run_local_server(port=0)
 
-            s3_write.upload_email_token_to_s3(user_id, json.loads(creds.to_json()))
-                
-        return creds
+                s3_write.upload_email_token_to_s3(user_id, json.loads(creds.to_json()))
+            finally:
+                if acquired:
+                    s3_write.release_email_token_lease(user_id, owner)
 
-def get_gmail_client(user_id):
-    scopes = ['https://www.googleapis.com/auth/gmail.modify']
+        return creds
 
-    token_data = s3_read.read_email_token_from_s3(user_id)
-    credentials_data = s3_read.read_email_credentials_from_s3(user_id)
-    gmail_client = GmailClient(token_data, credentials_data, scopes, user_id)
+    def refresh_credentials(self):
+        """
+        Refresh the credentials if they expire within TOKEN_REFRESH_MARGIN and
+        rebuild the service around the new credentials.
+        :return: True if the client has valid credentials, else False
+        """
+        if not _credentials_need_refresh(self.creds):
+            return True
+        token_data = json.loads(self.creds.to_json()) if self.creds else None
+        creds = self.get_credentials(self.user_id, token_data, self.credentials_data, self.scopes)
+        if not creds:
+            return False
+        self.creds = creds
+        # the per thread transports hold the old credentials
+        self._thread_local = threading.local()
+        self.service = _build_service(creds, self.__build_request)
+        return True
+
+def get_gmail_client(user_id, use_cache=True):
+    """
+    Get the Gmail client of a user
+    Clients are cached per user, the token and credentials are read from s3 once
+    and the token is refreshed when it is about to expire.
+    :param user_id: User id
+    :param use_cache: Reuse the cached client, False to build a new one from s3
+    :return: GmailClient
+    """
+    with _get_user_lock(user_id):
+        with _gmail_clients_lock:
+            gmail_client = _gmail_clients.get(user_id) if use_cache else None
+        if gmail_client is not None and gmail_client.refresh_credentials():
+            return gmail_client
+
+        token_data = s3_read.read_email_token_from_s3(user_id)
+        credentials_data = s3_read.read_email_credentials_from_s3(user_id)
+        gmail_client = GmailClient(token_data, credentials_data, GMAIL_SCOPES, user_id)
+        if gmail_client.service is not None:
+            with _gmail_clients_lock:
+                _gmail_clients[user_id] = gmail_client
     return gmail_client
 
+
+def clear_gmail_client_cache(user_id=None):
+    """
+    Drop cached Gmail clients, e.g. after a user re-authorized
+    :param user_id: User id, None to drop every client
+    """
+    with _gmail_clients_lock:
+        if user_id is None:
+            _gmail_clients.clear()
+        else:
+            _gmail_clients.pop(user_id, None)
+
 # Usage
 #scopes = ['https://www.googleapis.com/auth/gmail.modify']
 #gmail_client = GmailClient('token.json', 'credentials.json', scopes)
@@ -1 +1,2 @@
-SUMMARIZE_ATTACHMENT_PROMPT = "Your taks is to summarize the attachment. The attachment is a {file_type} file. The file is named {file_name}. Here is the content of the file, detected by OCR: {file_content}."
\ No newline at end of file
+SUMMARIZE_ATTACHMENT_PROMPT = "Your taks is to summarize the attachment. The attachment is a {file_type} file. The file is named {file_name}. Here is the content of the file, detected by OCR: {file_content}."
+SUMMARIZE_ATTACHMENT_PARTS_PROMPT = "Your task is to summarize the attachment. The attachment is a {file_type} file. The file is named {file_name}. The file was too long to summarize at once, here are summaries of its consecutive parts: {file_content}."
@@ -0,0 +1,75 @@
+import base64
+import io
+
+"""
+Streaming decoders for email payloads.
+
+Gmail returns attachments as base64url strings. Decoding them in chunks lets
+large attachments be uploaded to S3 part by part instead of holding the
+decoded file in memory next to the encoded string.
+"""
+
+# encoded characters decoded per step, a multiple of 4
+DECODE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class Base64URLDecodeReader(io.RawIOBase):
+    """
+    Read-only binary stream of the bytes encoded in a base64url string
+    """
+    def __init__(self, encoded, chunk_size=DECODE_CHUNK_SIZE, hasher=None):
+        """
+        :param encoded: base64url encoded string, padding is optional
+        :param chunk_size: Encoded characters decoded per step, rounded down to a multiple of 4
+        :param hasher: Optional hashlib object updated with the decoded bytes
+        """
+        self._encoded = encoded
+        self._chunk_size = max(chunk_size - chunk_size % 4, 4)
+        self._position = 0
+        self._buffer = bytearray()
+        self.hasher = hasher
+        self.bytes_decoded = 0
+
+    def readable(self):
+        return True
+
+    def _decode_next_chunk(self):
+        end = min(self._position + self._chunk_size, len(self._encoded))
+        piece = self._encoded[self._position:end]
+        self._position = end
+        if self._position == len(self._encoded):
+            piece += "=" * (-len(piece) % 4)
+        decoded = base64.urlsafe_b64decode(piece)
+        if self.hasher is not None:
+            self.hasher.update(decoded)
+        self.bytes_decoded += len(decoded)
+        self._buffer += decoded
+
+    def readinto(self, b):
+        while len(self._buffer) < len(b) and self._position < len(self._encoded):
+            self._decode_next_chunk()
+        n_bytes = min(len(b), len(self._buffer))
+        b[:n_bytes] = self._buffer[:n_bytes]
+        del self._buffer[:n_bytes]
+        return n_bytes
+
+
+def open_base64url_stream(encoded, chunk_size=DECODE_CHUNK_SIZE, hasher=None):
+    """
+    Open a buffered binary stream over a base64url string
+
+    :param encoded: base64url encoded string
+    :param chunk_size: Encoded characters decoded per step
+    :param hasher: Optional hashlib object updated with the decoded bytes
+    :return: io.BufferedReader
+    """
+    return io.BufferedReader(Base64URLDecodeReader(encoded, chunk_size, hasher), buffer_size=io.DEFAULT_BUFFER_SIZE)
+
+
+def decoded_size(encoded):
+    """
+    :param encoded: base64url encoded string, padding is optional
+    :return: Number of bytes encoded in the string
+    """
+    unpadded_length = len(encoded.rstrip("="))
+    return unpadded_length * 3 // 4
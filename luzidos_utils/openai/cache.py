@@ -0,0 +1,141 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Optional
+from luzidos_utils.aws_io.cache import LRUCache
+from luzidos_utils.aws_io.s3 import read as s3_read
+from luzidos_utils.aws_io.s3 import write as s3_write
+from luzidos_utils.aws_io.s3 import file_paths as fp
+
+"""
+Response cache for the OpenAI API.
+
+Responses are keyed on a hash of the model, messages, temperature and
+response format, so an identical request is only sent once. Backends keep
+entries in memory, in a local sqlite file or in S3, each with a TTL.
+"""
+
+# default seconds a cached response stays valid, None to never expire
+CACHE_TTL = 7 * 24 * 60 * 60
+
+
+def make_cache_key(data: Dict[str, Any]) -> str:
+    """
+    Args:
+        data (dict): Chat completion request body.
+
+    Returns:
+        str: sha256 hex digest of the fields that determine the response.
+    """
+    key_data = {field: data.get(field) for field in ["model", "messages", "temperature", "response_format"]}
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = CACHE_TTL):
+        self._cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, value: str):
+        self._cache.set(key, value)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return self._cache.stats()
+
+
+class SQLiteCache:
+    def __init__(self, path: str, ttl: Optional[float] = CACHE_TTL):
+        """
+        Args:
+            path (str): sqlite database file, created if missing.
+            ttl (float, optional): Seconds an entry stays valid, None to never expire.
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS gpt_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT value, expires_at FROM gpt_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= time.time():
+                with self._connection:
+                    self._connection.execute("DELETE FROM gpt_cache WHERE key = ?", (key,))
+                return None
+            return value
+
+    def set(self, key: str, value: str):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO gpt_cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at)
+            )
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM gpt_cache")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class S3Cache:
+    def __init__(self, bucket_name: str = fp.ROOT_BUCKET, ttl: Optional[float] = CACHE_TTL):
+        """
+        Args:
+            bucket_name (str): Bucket the responses are stored in, under fp.GPT_CACHE_PATH.
+            ttl (float, optional): Seconds an entry stays valid, None to never expire.
+        """
+        self.bucket_name = bucket_name
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[str]:
+        entry = s3_read.read_json_from_s3(self.bucket_name, fp.GPT_CACHE_PATH.format(cache_key=key))
+        if entry is None:
+            return None
+        if entry.get("expires_at") is not None and entry["expires_at"] <= time.time():
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value: str):
+        entry = {
+            "value": value,
+            "expires_at": time.time() + self.ttl if self.ttl is not None else None,
+        }
+        s3_write.upload_dict_as_json_to_s3(self.bucket_name, entry, fp.GPT_CACHE_PATH.format(cache_key=key))
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    """
+    Returns:
+        The cache used by get_gpt_response and get_gpt_responses, None if caching is off.
+    """
+    return _response_cache
+
+
+def set_response_cache(cache):
+    """
+    Set the cache used by get_gpt_response and get_gpt_responses.
+
+    Args:
+        cache: MemoryCache, SQLiteCache, S3Cache or any object with get(key) and set(key, value). None turns caching off.
+    """
+    global _response_cache
+    _response_cache = cache
@@ -0,0 +1,125 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Optional
+
+"""
+Reusable HTTP client for the OpenAI API.
+
+A single pooled requests.Session keeps TLS connections alive between prompts,
+and every request has connect/read timeouts so a stalled call cannot hang a
+Lambda until its hard timeout.
+"""
+
+OPENAI_API_URL = "https://api.openai.com/v1"
+
+# default connection pool and timeout settings, timeouts are in seconds
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 50
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 120
+
+
+class OpenAIClient:
+    def __init__(self, api_key: Optional[str] = None, base_url: str = OPENAI_API_URL,
+                 pool_connections: int = POOL_CONNECTIONS, pool_maxsize: int = POOL_MAXSIZE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT):
+        """
+        Args:
+            api_key (str, optional): OpenAI API key. Read from OPENAI_API_KEY on first use if not given.
+            base_url (str): Base URL of the API.
+            pool_connections (int): Number of connection pools to cache.
+            pool_maxsize (int): Maximum number of connections kept alive per pool.
+            connect_timeout (float): Seconds to wait for a connection.
+            read_timeout (float): Seconds to wait for the response.
+        """
+        self._api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_key(self) -> str:
+        """
+        Raises:
+            ValueError: If no API key was given and OPENAI_API_KEY is not set.
+        """
+        if self._api_key is None:
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OPENAI_API_KEY not set in environment variables")
+            self._api_key = api_key
+        return self._api_key
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def post(self, path: str, data: Dict[str, Any], timeout=None, **kwargs) -> requests.Response:
+        """
+        Send a POST request to the API.
+
+        Args:
+            path (str): Endpoint path, e.g. '/chat/completions'.
+            data (dict): JSON body.
+            timeout (tuple, optional): (connect, read) timeout overriding the client default.
+
+        Returns:
+            requests.Response: The raw response.
+        """
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        return self.session.post(f"{self.base_url}{path}", headers=headers, json=data,
+                                 timeout=timeout or self.timeout, **kwargs)
+
+    def chat_completion(self, data: Dict[str, Any], timeout=None, stream: bool = False) -> requests.Response:
+        return self.post("/chat/completions", data, timeout=timeout, stream=stream)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client() -> OpenAIClient:
+    """
+    Returns:
+        OpenAIClient: The client shared by module level helpers such as get_gpt_response.
+    """
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = OpenAIClient()
+    return _default_client
+
+
+def set_default_client(client: Optional[OpenAIClient]):
+    """
+    Replace the shared client, None to create a new one on next use.
+    """
+    global _default_client
+    with _default_client_lock:
+        old_client = _default_client
+        _default_client = client
+    if old_client is not None and old_client is not client:
+        old_client.close()
@@ -1,9 +1,15 @@
-import os
-import requests
+import json
 import logging
 from requests.exceptions import HTTPError, RequestException
 import time
-from typing import Dict, Any
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Callable, Iterable, Iterator, List, Optional, Union
+from luzidos_utils.openai.client import OpenAIClient, get_default_client
+from luzidos_utils.openai.rate_limit import RateLimiter, get_default_rate_limiter
+from luzidos_utils.openai.cache import make_cache_key, get_response_cache
+from luzidos_utils.openai import tokens
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -13,34 +19,15 @@ This code interacts with the OpenAI GPT API.
 Allows querying different models and supports JSON mode.
 """
 
-def get_gpt_response(prompt: str, model="gpt-4o", json_mode=False, retries=3, backoff_factor=2)-> Dict[str, Any]:
-    """
-    Queries the OpenAI API with a specified model and prompt.
-    
-    Args:
-        prompt (str): The prompt to send to the API.
-        model (str): Model to use for the query. Defaults to 'gpt-3.5-turbo-0125'.
-        response_format (dict, optional): Specifies the response format. Use {"type": "json_object"} for JSON mode.
-        retries (int): Number of retries for transient errors.
-        backoff_factor (int): Factor by which to multiply delay for each retry.
-        
-    Returns:
-        dict: The API response.
-        
-    Raises:
-        ValueError: If the OpenAI API key is not set.
-        Exception: For unrecoverable errors.
-    """
-    api_key = os.getenv("OPENAI_API_KEY")  # Get API key from environment variable
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY not set in environment variables")
+# default number of prompts sent at the same time by get_gpt_responses
+MAX_CONCURRENCY = 8
+# reduce rounds of get_gpt_response_for_long_input before the input is truncated
+MAX_REDUCE_DEPTH = 3
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+GPTResult = namedtuple("GPTResult", ["prompt", "response", "error"])
 
-    data = {
+def _build_request_data(prompt: str, model: str, json_mode: bool) -> Dict[str, Any]:
+    return {
         "model": model,
         "messages": [{"role": "user", "content": prompt}],
         "temperature": 0.7,
@@ -49,28 +36,332 @@ def get_gpt_response(prompt: str, model="gpt-4o", json_mode=False, retries=3, ba
         }
     }
 
-    # if json_mode:
-    #     data["type"] = "json_object"   ## FIX THIS LATER
+def _estimate_request_tokens(data: Dict[str, Any]) -> int:
+    return sum(tokens.estimate_tokens(message["content"], data["model"]) for message in data["messages"])
+
+def _guard_prompt_size(prompt: str, model: str) -> str:
+    """
+    Truncate a prompt that does not fit the model context instead of sending a request that fails with a 400.
+    """
+    max_prompt_tokens = tokens.get_max_prompt_tokens(model)
+    prompt_tokens = tokens.estimate_tokens(prompt, model)
+    if prompt_tokens <= max_prompt_tokens:
+        return prompt
+    logging.warning(f'Prompt has {prompt_tokens} tokens, truncating to {max_prompt_tokens} for {model}')
+    tokens.token_metrics.record_truncation()
+    return tokens.truncate_to_tokens(prompt, max_prompt_tokens, model)
+
+def _retry_delay(response, attempt: int, backoff_factor: float) -> float:
+    """
+    Seconds to wait before the next attempt, honouring a Retry-After header.
+    """
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    return backoff_factor * (2 ** attempt)
 
-    url = "https://api.openai.com/v1/chat/completions"
+def _chat_completion(client: OpenAIClient, data: Dict[str, Any], retries: int, backoff_factor: float,
+                     rate_limiter: Optional[RateLimiter] = None, stream: bool = False):
+    """
+    Send a chat completion request, retrying 429s, server errors and connection errors.
 
+    Returns:
+        str: The response content, or the open requests.Response if stream is set.
+
+    Raises:
+        HTTPError: For client errors other than 429.
+        Exception: If all attempts failed.
+    """
+    request_tokens = _estimate_request_tokens(data)
     for attempt in range(retries):
+        if rate_limiter is not None:
+            rate_limiter.acquire(request_tokens)
+        response = None
         try:
-            response = requests.post(url, headers=headers, json=data)
+            response = client.chat_completion(data, stream=stream)
             response.raise_for_status()  # Raises HTTPError for bad responses
-            return response.json()["choices"][0]["message"]["content"]
+            if stream:
+                return response
+            response_data = response.json()
+            usage = response_data.get("usage") or {}
+            tokens.token_metrics.record_call(usage.get("prompt_tokens", request_tokens), usage.get("completion_tokens", 0))
+            return response_data["choices"][0]["message"]["content"]
         except HTTPError as http_err:
             logging.error(f'HTTP error occurred: {http_err}')
-            if response.status_code < 500:  # Client error, no retry
-                break
+            response.close()
+            if response.status_code < 500 and response.status_code != 429:  # Client error, no retry
+                raise
         except RequestException as err:
             logging.error(f'Request error occurred: {err}')
         except Exception as e:
             logging.error(f'An unexpected error occurred: {e}')
             raise
-        time.sleep(backoff_factor * (2 ** attempt))
-    else:
-        raise Exception(f"Failed to get response after {retries} attempts.")
+        time.sleep(_retry_delay(response, attempt, backoff_factor))
+    raise Exception(f"Failed to get response after {retries} attempts.")
+
+def _cached_chat_completion(client: OpenAIClient, data: Dict[str, Any], retries: int, backoff_factor: float,
+                            rate_limiter: Optional[RateLimiter] = None, use_cache: bool = True) -> str:
+    cache = get_response_cache() if use_cache else None
+    if cache is None:
+        return _chat_completion(client, data, retries, backoff_factor, rate_limiter)
+
+    cache_key = make_cache_key(data)
+    response = cache.get(cache_key)
+    if response is not None:
+        return response
+    response = _chat_completion(client, data, retries, backoff_factor, rate_limiter)
+    cache.set(cache_key, response)
+    return response
+
+def get_gpt_response(prompt: str, model="gpt-4o", json_mode=False, retries=3, backoff_factor=2,
+                     client: Optional[OpenAIClient] = None, rate_limiter: Optional[RateLimiter] = None,
+                     use_cache=True, stream=False) -> Optional[Union[str, Iterator[str]]]:
+    """
+    Queries the OpenAI API with a specified model and prompt.
+    
+    Args:
+        prompt (str): The prompt to send to the API.
+        model (str): Model to use for the query. Defaults to 'gpt-3.5-turbo-0125'.
+        response_format (dict, optional): Specifies the response format. Use {"type": "json_object"} for JSON mode.
+        retries (int): Number of retries for transient errors.
+        backoff_factor (int): Factor by which to multiply delay for each retry. A Retry-After header takes precedence.
+        client (OpenAIClient, optional): Client to send the request with. Defaults to the shared client.
+        rate_limiter (RateLimiter, optional): Limiter to reserve request and token budget from.
+        use_cache (bool): Read and store the response in the configured response cache, see openai.cache.
+        stream (bool): Return an iterator of content deltas instead, see stream_gpt_response.
+            The request is sent before the iterator is returned, so client errors return None
+            like the non-stream path. Errors while reading the stream are raised by the iterator.
+        
+    Returns:
+        str: The response content, or an iterator of content deltas if stream is set.
+        None for client errors.
+
+    Prompts that do not fit the model context are truncated, see
+    get_gpt_response_for_long_input to summarize long inputs instead.
+        
+    Raises:
+        ValueError: If the OpenAI API key is not set.
+        Exception: For unrecoverable errors.
+    """
+    if stream:
+        try:
+            return stream_gpt_response(prompt, model=model, json_mode=json_mode, retries=retries,
+                                       backoff_factor=backoff_factor, client=client, rate_limiter=rate_limiter)
+        except HTTPError:
+            return None
+    if client is None:
+        client = get_default_client()
+
+    data = _build_request_data(_guard_prompt_size(prompt, model), model, json_mode)
+    try:
+        return _cached_chat_completion(client, data, retries, backoff_factor, rate_limiter, use_cache)
+    except HTTPError:
+        return None
+
+def _iter_sse_data(response) -> Iterator[str]:
+    """
+    Yield the data field of every server-sent event in a streamed response.
+    """
+    data_lines = []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+        elif line.startswith("data:"):
+            data_lines.append(line[5:].lstrip())
+    if data_lines:
+        yield "\n".join(data_lines)
+
+def stream_gpt_response(prompt: str, model="gpt-4o", json_mode=False, retries=3, backoff_factor=2,
+                        client: Optional[OpenAIClient] = None, rate_limiter: Optional[RateLimiter] = None) -> Iterator[str]:
+    """
+    Queries the OpenAI API and yields the response content as it is generated.
+
+    The request is sent before the iterator is returned, so failures to
+    start the response are raised here and retried like get_gpt_response.
+    The client read timeout applies between events, and closing the
+    iterator early closes the connection.
+
+    Args:
+        prompt (str): The prompt to send to the API.
+        model (str): Model to use for the query.
+        json_mode (bool): Request a JSON response, see assemble_gpt_stream to validate it.
+        retries (int): Number of retries for transient errors.
+        backoff_factor (int): Factor by which to multiply delay for each retry.
+        client (OpenAIClient, optional): Client to send the request with. Defaults to the shared client.
+        rate_limiter (RateLimiter, optional): Limiter to reserve request and token budget from.
+
+    Returns:
+        iterator: Content deltas, in order.
+
+    Raises:
+        HTTPError: For client errors other than 429.
+        Exception: If all attempts failed.
+    """
+    if client is None:
+        client = get_default_client()
+
+    data = _build_request_data(_guard_prompt_size(prompt, model), model, json_mode)
+    data["stream"] = True
+    data["stream_options"] = {"include_usage": True}
+    response = _chat_completion(client, data, retries, backoff_factor, rate_limiter, stream=True)
+    return _iter_stream_deltas(response)
+
+def _iter_stream_deltas(response) -> Iterator[str]:
+    """
+    Yield the content deltas of a streamed chat completion and close the response.
+    """
+    try:
+        for event_data in _iter_sse_data(response):
+            if event_data == "[DONE]":
+                break
+            event = json.loads(event_data)
+            if event.get("usage"):
+                tokens.token_metrics.record_call(event["usage"].get("prompt_tokens", 0), event["usage"].get("completion_tokens", 0))
+            for choice in event.get("choices", []):
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+    finally:
+        response.close()
+
+def assemble_gpt_stream(deltas: Iterable[str], json_mode=False, on_delta: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Join streamed content deltas into the full response.
+
+    Args:
+        deltas (iterable): Content deltas, e.g. from stream_gpt_response.
+        json_mode (bool): Check that the full response is valid JSON.
+        on_delta (callable, optional): Called with every delta as it arrives.
+
+    Returns:
+        str: The full response content.
+
+    Raises:
+        ValueError: If json_mode is set and the response is not valid JSON.
+    """
+    parts = []
+    for delta in deltas:
+        if on_delta is not None:
+            on_delta(delta)
+        parts.append(delta)
+    content = "".join(parts)
+    if json_mode:
+        try:
+            json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Streamed response is not valid JSON: {e}") from e
+    return content
+
+def get_gpt_responses(prompts: List[str], model="gpt-4o", json_mode=False, max_concurrency=MAX_CONCURRENCY,
+                      retries=3, backoff_factor=2, client: Optional[OpenAIClient] = None,
+                      rate_limiter: Optional[RateLimiter] = None, use_cache=True) -> List[GPTResult]:
+    """
+    Queries the OpenAI API with many prompts concurrently.
+
+    Requests share a requests-per-minute and tokens-per-minute budget, so a
+    large batch is spread out instead of being rejected with 429s.
+
+    Args:
+        prompts (list): Prompts to send to the API.
+        model (str): Model to use for the queries.
+        json_mode (bool): Request JSON responses.
+        max_concurrency (int): Maximum number of requests in flight.
+        retries (int): Number of retries for transient errors, per prompt.
+        backoff_factor (int): Factor by which to multiply delay for each retry.
+        client (OpenAIClient, optional): Client to send the requests with. Defaults to the shared client.
+        rate_limiter (RateLimiter, optional): Limiter to use. Defaults to the shared limiter.
+        use_cache (bool): Read and store responses in the configured response cache, see openai.cache.
+
+    Returns:
+        list: GPTResult(prompt, response, error) per prompt, in the same order as prompts.
+    """
+    if client is None:
+        client = get_default_client()
+    if rate_limiter is None:
+        rate_limiter = get_default_rate_limiter()
+
+    def get_result(prompt):
+        data = _build_request_data(_guard_prompt_size(prompt, model), model, json_mode)
+        try:
+            response = _cached_chat_completion(client, data, retries, backoff_factor, rate_limiter, use_cache)
+            return GPTResult(prompt, response, None)
+        except Exception as e:
+            return GPTResult(prompt, None, e)
+
+    if not prompts:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(prompts))) as executor:
+        return list(executor.map(get_result, prompts))
+
+def get_gpt_response_for_long_input(prompt_template: str, content: str, content_field="file_content",
+                                    reduce_prompt_template: Optional[str] = None, model="gpt-4o",
+                                    strategy="map_reduce", max_concurrency=MAX_CONCURRENCY,
+                                    max_reduce_depth=MAX_REDUCE_DEPTH, **template_kwargs) -> Optional[str]:
+    """
+    Queries the OpenAI API with a prompt built around a possibly oversized input.
+
+    If the filled prompt does not fit the model context, the input is either
+    truncated or split into chunks that are answered separately (map) and then
+    combined with reduce_prompt_template (reduce), repeating until it fits.
+    After max_reduce_depth reduce rounds the combined responses are truncated.
+
+    Args:
+        prompt_template (str): Prompt with a {content_field} placeholder for the input.
+        content (str): The input, e.g. OCR output.
+        content_field (str): Name of the placeholder that receives the input.
+        reduce_prompt_template (str, optional): Prompt used to combine the chunk responses, given
+            the joined responses in {content_field}. Defaults to prompt_template.
+        model (str): Model to use for the queries.
+        strategy (str): "map_reduce" or "truncate".
+        max_concurrency (int): Maximum number of chunk requests in flight.
+        max_reduce_depth (int): Maximum number of reduce rounds before falling back to truncation.
+        template_kwargs: Other values used to fill the templates.
+
+    Returns:
+        str: The API response, None if a request failed.
+    """
+    if strategy not in ("map_reduce", "truncate"):
+        raise ValueError(f"Invalid strategy: {strategy}")
+    if reduce_prompt_template is None:
+        reduce_prompt_template = prompt_template
+
+    def build_prompt(template, value):
+        return template.format(**template_kwargs, **{content_field: value})
+
+    max_prompt_tokens = tokens.get_max_prompt_tokens(model)
+    content_budget = max_prompt_tokens - tokens.estimate_tokens(build_prompt(prompt_template, ""), model)
+    if tokens.estimate_tokens(content, model) <= content_budget:
+        return get_gpt_response(build_prompt(prompt_template, content), model=model)
+    if content_budget <= 0:
+        raise ValueError(f"Prompt template alone does not fit the {model} context")
+
+    # responses that do not shrink below the budget would otherwise be reduced forever
+    if strategy == "truncate" or max_reduce_depth <= 0:
+        tokens.token_metrics.record_truncation()
+        return get_gpt_response(build_prompt(prompt_template, tokens.truncate_to_tokens(content, content_budget, model)), model=model)
+
+    tokens.token_metrics.record_chunked_input()
+    chunks = tokens.split_into_chunks(content, content_budget, model)
+    logging.info(f'Input split into {len(chunks)} chunks for {model}')
+    results = get_gpt_responses([build_prompt(prompt_template, chunk) for chunk in chunks], model=model,
+                                max_concurrency=max_concurrency)
+    for result in results:
+        if result.error is not None or result.response is None:
+            logging.error(f'Chunk request failed: {result.error}')
+            return None
+
+    combined = "\n\n".join(result.response for result in results)
+    return get_gpt_response_for_long_input(reduce_prompt_template, combined, content_field=content_field, model=model,
+                                           strategy=strategy, max_concurrency=max_concurrency,
+                                           max_reduce_depth=max_reduce_depth - 1, **template_kwargs)
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import Optional
+
+"""
+Token bucket rate limiting for the OpenAI API.
+
+Requests reserve capacity from a requests-per-minute and a tokens-per-minute
+bucket before they are sent, so concurrent callers stay inside the account
+limits instead of running into 429 responses.
+"""
+
+# default account budgets
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 300000
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate_per_minute (float): Units added to the bucket per minute.
+            capacity (float, optional): Maximum burst size. Defaults to one minute of budget.
+        """
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, amount: float = 1) -> float:
+        """
+        Take amount units if available.
+
+        Returns:
+            float: 0 if the units were taken, else the seconds until they are available.
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0
+            return (amount - self._tokens) / self.rate
+
+    def acquire(self, amount: float = 1):
+        """
+        Block until amount units are available and take them.
+        """
+        while True:
+            wait_time = self.try_acquire(amount)
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float = REQUESTS_PER_MINUTE, tokens_per_minute: float = TOKENS_PER_MINUTE):
+        """
+        Args:
+            requests_per_minute (float): Request budget per minute.
+            tokens_per_minute (float): Token budget per minute.
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def acquire(self, tokens: int = 0):
+        """
+        Block until one request and the given number of tokens fit in the budget.
+
+        Args:
+            tokens (int): Estimated tokens used by the request.
+        """
+        self.requests.acquire(1)
+        if tokens:
+            self.tokens.acquire(tokens)
+
+
+_default_rate_limiter = None
+_default_rate_limiter_lock = threading.Lock()
+
+
+def get_default_rate_limiter() -> RateLimiter:
+    """
+    Returns:
+        RateLimiter: The limiter shared by module level helpers such as get_gpt_responses.
+    """
+    global _default_rate_limiter
+    if _default_rate_limiter is None:
+        with _default_rate_limiter_lock:
+            if _default_rate_limiter is None:
+                _default_rate_limiter = RateLimiter()
+    return _default_rate_limiter
+
+
+def set_default_rate_limiter(rate_limiter: Optional[RateLimiter]):
+    """
+    Replace the shared limiter, None to create a new one with the default budgets on next use.
+    """
+    global _default_rate_limiter
+    with _default_rate_limiter_lock:
+        _default_rate_limiter = rate_limiter
@@ -0,0 +1,168 @@
+import math
+import threading
+from typing import Dict, List, Optional
+
+try:
+    import tiktoken
+except ImportError:  # estimates fall back to characters / 4
+    tiktoken = None
+
+"""
+Token estimation and prompt size helpers for the OpenAI API.
+
+Token counts are exact when tiktoken is installed and estimated from the
+text length otherwise. Oversized inputs can be truncated or split into
+chunks that fit the model context.
+"""
+
+CHARS_PER_TOKEN = 4
+
+# context window per model, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo-0125": 16385,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+# tokens kept free for the response
+RESPONSE_TOKEN_RESERVE = 4096
+
+_encodings = {}
+
+
+def _get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def estimate_tokens(text: str, model: str = "gpt-4o") -> int:
+    """
+    Args:
+        text (str): Text to count.
+        model (str): Model whose tokenizer to use.
+
+    Returns:
+        int: Number of tokens in text.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def get_max_prompt_tokens(model: str = "gpt-4o") -> int:
+    """
+    Returns:
+        int: Largest prompt that leaves RESPONSE_TOKEN_RESERVE tokens for the response.
+    """
+    return MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS) - RESPONSE_TOKEN_RESERVE
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    """
+    Args:
+        text (str): Text to truncate.
+        max_tokens (int): Maximum number of tokens to keep.
+        model (str): Model whose tokenizer to use.
+
+    Returns:
+        str: The start of text, at most max_tokens long.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return text[:max(max_tokens, 0) * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max(max_tokens, 0)])
+
+
+def split_into_chunks(text: str, max_tokens: int, model: str = "gpt-4o") -> List[str]:
+    """
+    Split text into consecutive chunks of at most max_tokens tokens.
+
+    Args:
+        text (str): Text to split.
+        max_tokens (int): Maximum tokens per chunk.
+        model (str): Model whose tokenizer to use.
+
+    Returns:
+        list: Chunks in order.
+    """
+    if max_tokens <= 0:
+        raise ValueError("max_tokens must be positive")
+    encoding = _get_encoding(model)
+    if encoding is None:
+        chunk_size = max_tokens * CHARS_PER_TOKEN
+        return [text[start:start + chunk_size] for start in range(0, len(text), chunk_size)]
+    tokens = encoding.encode(text)
+    return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+
+class TokenMetrics:
+    """
+    Counters for the tokens sent to and received from the API.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.max_prompt_tokens = 0
+            self.truncations = 0
+            self.chunked_inputs = 0
+
+    def record_call(self, prompt_tokens: int, completion_tokens: int = 0):
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, prompt_tokens)
+
+    def record_truncation(self):
+        with self._lock:
+            self.truncations += 1
+
+    def record_chunked_input(self):
+        with self._lock:
+            self.chunked_inputs += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Returns:
+            dict: Call and token counters, with the average prompt size per call.
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "avg_prompt_tokens": self.prompt_tokens / self.calls if self.calls else 0.0,
+                "max_prompt_tokens": self.max_prompt_tokens,
+                "truncations": self.truncations,
+                "chunked_inputs": self.chunked_inputs,
+            }
+
+
+token_metrics = TokenMetrics()
+
+
+def get_token_metrics() -> Dict[str, float]:
+    return token_metrics.stats()
+
+
+def reset_token_metrics():
+    token_metrics.reset()
@@ -1,5 +1,6 @@
 import boto3
 from luzidos_utils.testing.mock.eventbridge import MockEventBridge
+from luzidos_utils.testing.mock.scheduler import MockScheduler
 from luzidos_utils.testing.mock.ses import MockSES
 from luzidos_utils.testing.mock.workmailmessageflow import MockWorkMailMessageFlow
 from luzidos_utils.testing.mock.dynamodb import MockDynamoDB
@@ -11,6 +12,8 @@ class MockBoto3:
     def mock_client(self, service_name, **kwargs):
         if service_name == 'events' and 'eventbridge_data' in self.mock_data:
             return MockEventBridge(self.mock_data['eventbridge_data'])
+        elif service_name == 'scheduler' and 'scheduler_data' in self.mock_data:
+            return MockScheduler(self.mock_data['scheduler_data'])
         elif service_name == 'ses' and 'workmail_data' in self.mock_data:
             return MockSES(self.mock_data['workmail_data'])
         elif service_name == 'workmailmessageflow' and 'workmail_data' in self.mock_data:
@@ -1,10 +1,30 @@
+from luzidos_utils.aws_io.db.write import INVOICE_TABLE, EMAIL_TO_USER_ID_TABLE
+
+# key attributes of each table, the same key_names passed to _batch_write_items
+TABLE_KEY_NAMES = {
+    INVOICE_TABLE: ["userID", "invoiceID"],
+    EMAIL_TO_USER_ID_TABLE: ["email"],
+}
+
+def _item_key(table_name, attributes):
+    """
+    Key an item is stored under: the value of a single key attribute, or a
+    tuple of the values for composite keys. Tables without a known key
+    schema use the first attribute.
+    """
+    key_names = TABLE_KEY_NAMES.get(table_name)
+    if key_names is None:
+        return next(iter(attributes.values()))
+    key_values = tuple(attributes[key_name] for key_name in key_names)
+    return key_values[0] if len(key_values) == 1 else key_values
+
 class MockTable:
     def __init__(self, table_name, data_store):
         self.table_name = table_name
         self.data_store = data_store.get(table_name, {})
 
     def get_item(self, Key):
-        key_name, key_value = next(iter(Key.items()))
+        key_value = _item_key(self.table_name, Key)
         item = self.data_store.get(key_value)
         if item:
             return {
@@ -13,7 +33,7 @@ class MockTable:
                 }
             }
         else:
-            return {'Error': f"No item found with {key_name}: {key_value}"}
+            return {'Error': f"No item found with {Key}"}
 
 class MockDynamoDB:
     def __init__(self, mock_dynamodb_data=None):
@@ -23,3 +43,23 @@ class MockDynamoDB:
 
     def Table(self, table_name):
         return MockTable(table_name, self.mock_dynamodb_data)
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            data_store = self.mock_dynamodb_data.get(table_name, {})
+            responses[table_name] = []
+            for key in request['Keys']:
+                key_value = _item_key(table_name, key)
+                if key_value in data_store:
+                    responses[table_name].append({**key, "value": data_store[key_value]})
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        # items are stored under the table's key, like get_item reads them
+        for table_name, requests in RequestItems.items():
+            data_store = self.mock_dynamodb_data.setdefault(table_name, {})
+            for request in requests:
+                item = request['PutRequest']['Item']
+                data_store[_item_key(table_name, item)] = item.get("value", item)
+        return {'UnprocessedItems': {}}
@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 import boto3
 import luzidos_utils.aws_io.s3.read as s3_read
 import luzidos_utils.aws_io.s3.write as s3_write
@@ -68,6 +69,60 @@ class MockS3:
         
         return data
 
+    def mock_iter_file_chunks_from_s3(self, bucket_name, object_name, chunk_size=s3_read.STREAM_CHUNK_SIZE, byte_range=None):
+        """
+        Mock function for iter_file_chunks_from_s3
+        Yields the mocked file contents as bytes chunks.
+        """
+        if self.should_override(f"{bucket_name}/{object_name}"):
+            for patcher in self.patchers:
+                patcher.stop()
+            res = list(s3_read.iter_file_chunks_from_s3(bucket_name, object_name, chunk_size, byte_range))
+            for patcher in self.patchers:
+                patcher.start()
+            yield from res
+            return
+
+        data = self.mock_read_file_from_s3(bucket_name, object_name)
+        if data is None:
+            raise FileNotFoundError(f"Mock file not found in {bucket_name}/{object_name}")
+        if hasattr(data, "read"):
+            data.seek(0)
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if byte_range is not None:
+            first_byte, last_byte = byte_range
+            data = data[first_byte:None if last_byte is None else last_byte + 1]
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    def mock_read_file_with_etag_from_s3(self, bucket_name, object_name, if_none_match=None):
+        """
+        Mock function for read_file_with_etag_from_s3
+        The ETag is the md5 of the mocked file contents.
+        """
+        if self.should_override(f"{bucket_name}/{object_name}"):
+            for patcher in self.patchers:
+                patcher.stop()
+            res = s3_read.read_file_with_etag_from_s3(bucket_name, object_name, if_none_match)
+            for patcher in self.patchers:
+                patcher.start()
+            return res
+
+        data = self.mock_read_file_from_s3(bucket_name, object_name)
+        if data is None:
+            return None, None
+        etag = self.mock_etag(data)
+        if if_none_match == etag:
+            return s3_read.NOT_MODIFIED, etag
+        return data, etag
+
+    def mock_etag(self, data):
+        if not isinstance(data, bytes):
+            data = str(data).encode("utf-8")
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
     def mock_read_dir_filenames_from_s3(self, bucket_name, dir_name):
         """
         Mock function for read_dir_filenames_from_s3
@@ -141,13 +196,40 @@ class MockS3:
 
         return subfolders
 
+    def mock_iter_dir_filenames_from_s3(self, bucket_name, dir_name, start_after=None, page_size=s3_read.LIST_PAGE_SIZE, max_items=None):
+        """
+        Mock function for iter_dir_filenames_from_s3
+        Yields the sorted output of mock_read_dir_filenames_from_s3.
+        """
+        filenames = sorted(self.mock_read_dir_filenames_from_s3(bucket_name, dir_name))
+        yield from self._paginate(filenames, start_after, max_items)
+
+    def mock_iter_childdirectories(self, bucket_name, prefix, start_after=None, page_size=s3_read.LIST_PAGE_SIZE, max_items=None):
+        """
+        Mock function for iter_childdirectories
+        The prefix may end in a partial directory name, e.g. "public/a".
+        """
+        parent = prefix[:prefix.rfind('/') + 1]
+        subfolders = sorted(
+            subfolder for subfolder in self.mock_list_childdirectories(bucket_name, parent)
+            if subfolder.startswith(prefix)
+        )
+        yield from self._paginate(subfolders, start_after, max_items)
+
+    def _paginate(self, keys, start_after, max_items):
+        if start_after is not None:
+            keys = [key for key in keys if key > start_after]
+        if max_items is not None:
+            keys = keys[:max_items]
+        return keys
+
     """
     ******************************************************************
                     luzidos_utils.aws_io.s3.write Mock Functions
     ******************************************************************
     """
     
-    def mock_upload_file_to_s3(self, file_path, bucket_name, object_name):
+    def mock_upload_file_to_s3(self, file_path, bucket_name, object_name, part_size=None, max_concurrency=None):
         """
         Mock function for upload_file_to_s3
         This function writes to self.mock_s3_data dictionary.
@@ -159,7 +241,7 @@ class MockS3:
         if self.should_override(f"{bucket_name}/{object_name}"):
             for patcher in self.patchers:
                 patcher.stop()
-            res = s3_write.upload_file_to_s3(file_path, bucket_name, object_name)
+            res = s3_write.upload_file_to_s3(file_path, bucket_name, object_name, part_size, max_concurrency)
             for patcher in self.patchers:
                 patcher.start()
             return res
@@ -171,17 +253,18 @@ class MockS3:
             current_level = current_level.setdefault(part, {})
 
         current_level[path_parts[-1]] = file_path
+        s3_read.invalidate_json_cache(bucket_name, object_name)
         return True
 
     
-    def mock_upload_file_obj_to_s3(self, file_obj, bucket_name,  object_name):
+    def mock_upload_file_obj_to_s3(self, file_obj, bucket_name,  object_name, part_size=None, max_concurrency=None):
         """
         Mock function for upload_file_obj_to_s3
         """
         if self.should_override(f"{bucket_name}/{object_name}"):
             for patcher in self.patchers:
                 patcher.stop()
-            res = s3_write.upload_file_obj_to_s3(file_obj, bucket_name, object_name)
+            res = s3_write.upload_file_obj_to_s3(file_obj, bucket_name, object_name, part_size, max_concurrency)
             for patcher in self.patchers:
                 patcher.start()
             return res
@@ -193,6 +276,7 @@ class MockS3:
             current_level = current_level.setdefault(part, {})
 
         current_level[path_parts[-1]] = file_obj
+        s3_read.invalidate_json_cache(bucket_name, object_name)
         return True
         
     
@@ -214,8 +298,56 @@ class MockS3:
             current_level = current_level.setdefault(part, {})
 
         current_level[path_parts[-1]] = dict_data
+        s3_read.invalidate_json_cache(bucket_name, object_name)
         return True
     
+    def mock_upload_dict_as_json_to_s3_if_match(self, bucket_name, dict_data, object_name, etag):
+        """
+        Mock function for upload_dict_as_json_to_s3_if_match
+        Raises ConcurrentModificationError if the mocked file's ETag differs from etag.
+        """
+        if self.should_override(f"{bucket_name}/{object_name}"):
+            for patcher in self.patchers:
+                patcher.stop()
+            res = s3_write.upload_dict_as_json_to_s3_if_match(bucket_name, dict_data, object_name, etag)
+            for patcher in self.patchers:
+                patcher.start()
+            return res
+
+        _, current_etag = self.mock_read_file_with_etag_from_s3(bucket_name, object_name)
+        if current_etag != etag:
+            raise s3_write.ConcurrentModificationError(f"{bucket_name}/{object_name} was modified concurrently")
+        return self.mock_upload_dict_as_json_to_s3(bucket_name, dict_data, object_name)
+
+    def mock_delete_file_from_s3(self, bucket_name, object_name):
+        """
+        Mock function for delete_file_from_s3
+        """
+        if self.should_override(f"{bucket_name}/{object_name}"):
+            for patcher in self.patchers:
+                patcher.stop()
+            res = s3_write.delete_file_from_s3(bucket_name, object_name)
+            for patcher in self.patchers:
+                patcher.start()
+            return res
+
+        current_level = self.mock_s3_data.get(bucket_name, {})
+        path_parts = object_name.strip('/').split('/')
+        for part in path_parts[:-1]:
+            current_level = current_level.get(part, {})
+        current_level.pop(path_parts[-1], None)
+        s3_read.invalidate_json_cache(bucket_name, object_name)
+        return True
+
+    def mock_delete_files_from_s3(self, bucket_name, object_names):
+        """
+        Mock function for delete_files_from_s3
+        """
+        status = True
+        for object_name in object_names:
+            status = self.mock_delete_file_from_s3(bucket_name, object_name) and status
+        return status
+
     def mock_copy_file(self, bucket_name, source_file, dest_file):
         """
         Mock function for copy_file
@@ -0,0 +1,36 @@
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+
+def _client_error(code, message, operation_name):
+    # raised like the real client so backend error handling is exercised
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation_name)
+
+class MockScheduler:
+    def __init__(self, mock_scheduler_data=None):
+        if mock_scheduler_data is None:
+            mock_scheduler_data = {'schedules': {}}
+        self.schedules = mock_scheduler_data.setdefault('schedules', {})
+
+    """
+    ******************************************************************
+                    boto3.client Mock Functions
+    ******************************************************************
+    """
+    def create_schedule(self, Name, GroupName='default', **kwargs):
+        key = f"{GroupName}/{Name}"
+        if key in self.schedules:
+            raise _client_error('ConflictException', f"Schedule {key} already exists.", 'CreateSchedule')
+        self.schedules[key] = dict(kwargs, CreationDate=datetime.now().isoformat())
+        return {'ScheduleArn': f'arn:aws:scheduler:region:account-id:schedule/{key}'}
+
+    def update_schedule(self, Name, GroupName='default', **kwargs):
+        key = f"{GroupName}/{Name}"
+        if key not in self.schedules:
+            raise _client_error('ResourceNotFoundException', f"Schedule {key} does not exist.", 'UpdateSchedule')
+        self.schedules[key] = dict(kwargs, CreationDate=self.schedules[key]['CreationDate'])
+        return {'ScheduleArn': f'arn:aws:scheduler:region:account-id:schedule/{key}'}
+
+    def delete_schedule(self, Name, GroupName='default', **kwargs):
+        self.schedules.pop(f"{GroupName}/{Name}", None)
+        return {}
@@ -8,6 +8,7 @@ from luzidos_utils.testing.mock.boto3 import MockBoto3
 import os
 from luzidos_utils.aws_io.s3 import read
 from luzidos_utils.aws_io.s3 import write
+from luzidos_utils.aws_io.db import read as db_read
 import runpy
 import tempfile
 import re
@@ -184,8 +185,12 @@ class BaseTest(unittest.TestCase):
         return patch.multiple(
             'luzidos_utils.aws_io.s3.read',
             read_file_from_s3=mock_s3.mock_read_file_from_s3,
+            read_file_with_etag_from_s3=mock_s3.mock_read_file_with_etag_from_s3,
+            iter_file_chunks_from_s3=mock_s3.mock_iter_file_chunks_from_s3,
             read_dir_filenames_from_s3=mock_s3.mock_read_dir_filenames_from_s3,
-            list_childdirectories=mock_s3.mock_list_childdirectories
+            list_childdirectories=mock_s3.mock_list_childdirectories,
+            iter_dir_filenames_from_s3=mock_s3.mock_iter_dir_filenames_from_s3,
+            iter_childdirectories=mock_s3.mock_iter_childdirectories
         )
     
     def patch_s3_write(self, mock_s3: MockS3):
@@ -194,7 +199,10 @@ class BaseTest(unittest.TestCase):
             upload_file_to_s3=mock_s3.mock_upload_file_to_s3,
             upload_file_obj_to_s3=mock_s3.mock_upload_file_obj_to_s3,
             upload_dict_as_json_to_s3=mock_s3.mock_upload_dict_as_json_to_s3,
-            copy_file=mock_s3.mock_copy_file
+            upload_dict_as_json_to_s3_if_match=mock_s3.mock_upload_dict_as_json_to_s3_if_match,
+            copy_file=mock_s3.mock_copy_file,
+            delete_file_from_s3=mock_s3.mock_delete_file_from_s3,
+            delete_files_from_s3=mock_s3.mock_delete_files_from_s3
         )
     
     def patch_boto3_client(self, mock_boto3):
@@ -224,6 +232,9 @@ class ModuleTest(BaseTest):
         self.state_data = self.payload["state_data"]
         self.expected_state = self.expected_data["expected_state"]
 
+        # cached lookups must not leak between test cases
+        db_read.clear_user_cache()
+
         self.mock_s3 = MockS3(self.mock_data["mock_s3_data"])
         self.expected_mock_s3 = MockS3(self.expected_data["expected_s3_data"])
 
@@ -251,6 +262,7 @@ class ModuleTest(BaseTest):
         self.assert_email_s3_data()
         self.assert_s3_data()
         self.assert_eventbridge_data()
+        self.assert_scheduler_data()
         # self.assert_workmail_data()
         # self.assert_boto3_data()
 
@@ -316,6 +328,22 @@ class ModuleTest(BaseTest):
                     expected_eventbridge_data["targets"][target][i] = target_dict
         self.assertRegexDictEqual(mock_eventbridge_data, expected_eventbridge_data, msg=msg)
     
+    def assert_scheduler_data(self):
+        msg = f"Scheduler data does not match expected data after running {self.module_name}"
+        if "scheduler_data" not in self.mock_boto3.mock_data and "scheduler_data" not in self.expected_boto3.mock_data:
+            # test case does not use the scheduler backend
+            return
+        schedules = []
+        for boto3_mock in [self.mock_boto3, self.expected_boto3]:
+            scheduler_data = {}
+            if "scheduler_data" in boto3_mock.mock_data:
+                scheduler_data = boto3_mock.mock_data["scheduler_data"]
+                for schedule in scheduler_data.get("schedules", {}).values():
+                    if isinstance(schedule.get("Target", {}).get("Input"), str):
+                        schedule["Target"]["Input"] = json.loads(schedule["Target"]["Input"])
+            schedules.append(scheduler_data)
+        self.assertRegexDictEqual(schedules[0], schedules[1], msg=msg)
+
     def assert_workmail_data(self):
         msg = f"Workmail data does not match expected data after running {self.module_name}"
         mock_workmail_data = None
@@ -0,0 +1,337 @@
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import pytz
+from botocore.exceptions import ClientError
+from luzidos_utils.aws_io import clients
+from luzidos_utils.constants.aws import (
+    REGION_NAME, TIMEBOMB_LAMBDA_ARN, TIMEBOMB_SCHEDULER_ROLE_ARN, TIMEBOMB_SCHEDULE_GROUP
+)
+
+"""
+Backends that schedule timebombs.
+
+eventbridge: one EventBridge cron rule per timebomb (legacy, rules are never deleted)
+scheduler:   one-shot EventBridge Scheduler at() schedules, deleted after they fire
+local:       in-process heap scheduler for tests and single node runs
+
+The backend is selected with the LUZIDOS_TIMEBOMB_BACKEND environment variable
+or set_backend. Timebomb metadata records the backend that dispatched it, and
+timebombs without one are EventBridge rules.
+"""
+
+TIMEBOMB_BACKEND_ENV = "LUZIDOS_TIMEBOMB_BACKEND"
+DEFAULT_BACKEND = "eventbridge"
+
+# throttling retry settings for the AWS backends
+THROTTLE_RETRIES = 5
+THROTTLE_BACKOFF = 0.2
+THROTTLING_ERROR_CODES = {"ThrottlingException", "Throttling", "TooManyRequestsException", "LimitExceededException"}
+
+
+class TimebombRescheduleError(Exception):
+    """Raised when a timebomb was cancelled for a reschedule but could not be dispatched again"""
+    def __init__(self, timebomb_id, error):
+        super().__init__(f"Timebomb {timebomb_id} was cancelled but could not be rescheduled: {error}")
+        self.timebomb_id = timebomb_id
+
+
+def call_with_throttle_retry(operation, retries=THROTTLE_RETRIES, backoff_factor=THROTTLE_BACKOFF, **kwargs):
+    """
+    Call an AWS operation, retrying throttling errors with jittered backoff
+    """
+    for attempt in range(retries):
+        try:
+            return operation(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or attempt == retries - 1:
+                raise
+            time.sleep(backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def _to_utc(execution_datetime):
+    # naive datetimes are treated as UTC, like the EventBridge cron expressions
+    if execution_datetime.tzinfo is None:
+        return execution_datetime
+    return execution_datetime.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+class TimebombBackend:
+    name = None
+
+    def dispatch(self, timebomb_id, execution_datetime, timebomb_payload):
+        """
+        Schedule timebomb_payload to be triggered at execution_datetime
+        """
+        raise NotImplementedError
+
+    def cancel(self, timebomb_id):
+        """
+        Cancel a timebomb, cancelling a timebomb that does not exist is not an error
+        """
+        raise NotImplementedError
+
+    def reschedule(self, timebomb_id, execution_datetime, timebomb_payload):
+        """
+        Move an existing timebomb to a new execution time
+
+        Backends whose dispatch replaces a timebomb with the same id override
+        this with a plain dispatch. Here the timebomb is cancelled first, and
+        TimebombRescheduleError is raised if it can not be dispatched again.
+        """
+        self.cancel(timebomb_id)
+        try:
+            self.dispatch(timebomb_id, execution_datetime, timebomb_payload)
+        except Exception as e:
+            raise TimebombRescheduleError(timebomb_id, e) from e
+
+
+class EventBridgeRuleBackend(TimebombBackend):
+    name = "eventbridge"
+
+    def __init__(self, lambda_arn=TIMEBOMB_LAMBDA_ARN):
+        self.lambda_arn = lambda_arn
+
+    @property
+    def client(self):
+        return clients.get_client('events', region_name=REGION_NAME)
+
+    def dispatch(self, timebomb_id, execution_datetime, timebomb_payload):
+        client = self.client
+        execution_datetime = _to_utc(execution_datetime)
+        rule_name = f"trigger-lambda-{timebomb_id}"
+        call_with_throttle_retry(
+            client.put_rule,
+            Name=rule_name,
+            ScheduleExpression=f"cron({execution_datetime.minute} {execution_datetime.hour} {execution_datetime.day} {execution_datetime.month} ? {execution_datetime.year})",
+            State='ENABLED',
+        )
+
+        # Add target to the rule
+        call_with_throttle_retry(
+            client.put_targets,
+            Rule=rule_name,
+            Targets=[
+                {
+                    'Id': timebomb_id,
+                    'Arn': self.lambda_arn,
+                    'Input': json.dumps(timebomb_payload)
+                },
+            ]
+        )
+
+    def reschedule(self, timebomb_id, execution_datetime, timebomb_payload):
+        # put_rule and put_targets replace the rule and target with the same name and id
+        self.dispatch(timebomb_id, execution_datetime, timebomb_payload)
+
+    def cancel(self, timebomb_id):
+        client = self.client
+        rule_name = f"trigger-lambda-{timebomb_id}"
+        try:
+            call_with_throttle_retry(client.remove_targets, Rule=rule_name, Ids=[timebomb_id])
+            call_with_throttle_retry(client.delete_rule, Name=rule_name)
+        except ClientError as e:
+            # already triggered and cleaned up, or cancelled before
+            if e.response['Error']['Code'] != "ResourceNotFoundException":
+                raise
+
+
+class SchedulerBackend(TimebombBackend):
+    name = "scheduler"
+
+    def __init__(self, lambda_arn=TIMEBOMB_LAMBDA_ARN, role_arn=TIMEBOMB_SCHEDULER_ROLE_ARN, group_name=TIMEBOMB_SCHEDULE_GROUP):
+        """
+        :param lambda_arn: Lambda triggered by the timebombs
+        :param role_arn: IAM role EventBridge Scheduler assumes to invoke the lambda
+        :param group_name: Schedule group the timebombs are created in
+        """
+        self.lambda_arn = lambda_arn
+        self.role_arn = role_arn
+        self.group_name = group_name
+
+    @property
+    def client(self):
+        return clients.get_client('scheduler', region_name=REGION_NAME)
+
+    def _schedule_kwargs(self, timebomb_id, execution_datetime, timebomb_payload):
+        return {
+            "Name": f"timebomb-{timebomb_id}",
+            "GroupName": self.group_name,
+            "ScheduleExpression": f"at({_to_utc(execution_datetime).strftime('%Y-%m-%dT%H:%M:%S')})",
+            "ScheduleExpressionTimezone": "UTC",
+            "FlexibleTimeWindow": {"Mode": "OFF"},
+            "Target": {
+                "Arn": self.lambda_arn,
+                "RoleArn": self.role_arn,
+                "Input": json.dumps(timebomb_payload),
+            },
+            "ActionAfterCompletion": "DELETE",
+        }
+
+    def dispatch(self, timebomb_id, execution_datetime, timebomb_payload):
+        call_with_throttle_retry(self.client.create_schedule, **self._schedule_kwargs(timebomb_id, execution_datetime, timebomb_payload))
+
+    def cancel(self, timebomb_id):
+        try:
+            call_with_throttle_retry(self.client.delete_schedule, Name=f"timebomb-{timebomb_id}", GroupName=self.group_name)
+        except ClientError as e:
+            # already triggered and deleted, or cancelled before
+            if e.response['Error']['Code'] != "ResourceNotFoundException":
+                raise
+
+    def reschedule(self, timebomb_id, execution_datetime, timebomb_payload):
+        try:
+            call_with_throttle_retry(self.client.update_schedule, **self._schedule_kwargs(timebomb_id, execution_datetime, timebomb_payload))
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ResourceNotFoundException":
+                raise
+            # the schedule already fired and was deleted, create it again
+            self.dispatch(timebomb_id, execution_datetime, timebomb_payload)
+
+
+class LocalBackend(TimebombBackend):
+    """
+    Keeps timebombs in a heap ordered by execution time and triggers them from
+    a background thread, or from run_pending when run_in_background is False.
+    """
+    name = "local"
+
+    def __init__(self, handler=None, run_in_background=True):
+        """
+        :param handler: Called with the timebomb payload when a timebomb triggers,
+                        triggered payloads are collected in self.triggered if None
+        :param run_in_background: Trigger timebombs from a daemon thread
+        """
+        self.handler = handler
+        self.run_in_background = run_in_background
+        self.triggered = []
+        self._heap = []
+        self._timebombs = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def dispatch(self, timebomb_id, execution_datetime, timebomb_payload):
+        # naive datetimes are local time here, dt.datetime.now() in set_countdown_timebomb
+        execute_at = execution_datetime.timestamp()
+        with self._condition:
+            self._timebombs[timebomb_id] = (execute_at, timebomb_payload)
+            heapq.heappush(self._heap, (execute_at, timebomb_id))
+            self._condition.notify()
+        if self.run_in_background:
+            self._ensure_thread()
+
+    def reschedule(self, timebomb_id, execution_datetime, timebomb_payload):
+        # dispatch replaces the timebomb, the old heap entry is skipped when it comes up
+        self.dispatch(timebomb_id, execution_datetime, timebomb_payload)
+
+    def cancel(self, timebomb_id):
+        # the heap entry is skipped when it comes up
+        with self._condition:
+            self._timebombs.pop(timebomb_id, None)
+            self._condition.notify()
+
+    def pending(self):
+        """
+        :return: Ids of the timebombs that have not triggered yet
+        """
+        with self._condition:
+            return list(self._timebombs)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            execute_at, timebomb_id = heapq.heappop(self._heap)
+            timebomb = self._timebombs.get(timebomb_id)
+            # skip cancelled timebombs and entries left behind by a reschedule
+            if timebomb is not None and timebomb[0] == execute_at:
+                del self._timebombs[timebomb_id]
+                due.append(timebomb[1])
+        return due
+
+    def _trigger(self, timebomb_payload):
+        if self.handler is None:
+            self.triggered.append(timebomb_payload)
+            return
+        try:
+            self.handler(timebomb_payload)
+        except Exception as e:
+            print(f"Timebomb handler failed: {e}")
+
+    def run_pending(self, now=None):
+        """
+        Trigger every timebomb due at now
+
+        :param now: Datetime to run at, defaults to the current time
+        :return: Number of timebombs triggered
+        """
+        now = time.time() if now is None else now.timestamp()
+        with self._condition:
+            due = self._pop_due(now)
+        for timebomb_payload in due:
+            self._trigger(timebomb_payload)
+        return len(due)
+
+    def _ensure_thread(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timebomb-scheduler", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._pop_due(time.time())
+                if not due:
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._condition.wait(timeout)
+                    continue
+            for timebomb_payload in due:
+                self._trigger(timebomb_payload)
+
+
+BACKENDS = {
+    EventBridgeRuleBackend.name: EventBridgeRuleBackend,
+    SchedulerBackend.name: SchedulerBackend,
+    LocalBackend.name: LocalBackend,
+}
+
+_backends = {}
+_backend_name = None
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    """
+    Get a timebomb backend
+
+    :param name: Backend name, defaults to the configured backend
+    :return: TimebombBackend
+    """
+    if name is None:
+        name = _backend_name or os.getenv(TIMEBOMB_BACKEND_ENV, DEFAULT_BACKEND)
+    if name not in BACKENDS:
+        raise ValueError(f"Invalid timebomb backend: {name}")
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = BACKENDS[name]()
+        return _backends[name]
+
+
+def set_backend(backend):
+    """
+    Select the backend used for new timebombs
+
+    :param backend: Backend name, a TimebombBackend instance, or None to use the environment configuration
+    """
+    global _backend_name
+    with _backends_lock:
+        if isinstance(backend, TimebombBackend):
+            _backends[backend.name] = backend
+            _backend_name = backend.name
+        else:
+            if backend is not None and backend not in BACKENDS:
+                raise ValueError(f"Invalid timebomb backend: {backend}")
+            _backend_name = backend
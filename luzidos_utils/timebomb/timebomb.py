@@ -1,67 +1,135 @@
-import boto3
-import json
 import datetime as dt
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from luzidos_utils.constants.format import DATE_TIME_FORMAT
 from luzidos_utils.timebomb.timebomb_status import ACTIVE, CANCELLED, TRIGGERED
+from luzidos_utils.timebomb import backends
 import uuid
 from dateutil.relativedelta import relativedelta
 import pytz
-from luzidos_utils.constants.aws import REGION_NAME
+
+# concurrency for batch dispatch/cancel
+TIMEBOMB_WORKERS = 10
+
+TimebombResult = namedtuple("TimebombResult", ["timebomb_id", "metadata", "error"])
+
+def _set_backend_name(timebomb_metadata, backend):
+    # timebombs without a backend name are EventBridge rules
+    if backend.name != backends.EventBridgeRuleBackend.name:
+        timebomb_metadata["backend"] = backend.name
+
+def _get_backend_name(timebomb_metadata):
+    return timebomb_metadata.get("backend", backends.EventBridgeRuleBackend.name)
+
+def _dispatch_timebomb(backend, execution_datetime, timebomb_payload):
+    timebomb_id =  str(uuid.uuid4())
+    timebomb_payload["metadata"]["timebomb_id"] = timebomb_id
+    _set_backend_name(timebomb_payload["metadata"], backend)
+    backend.dispatch(timebomb_id, execution_datetime, timebomb_payload)
+    return timebomb_payload["metadata"]
+
 def dispatch_timebomb(execution_datetime, timebomb_payload ):
     """
     Dispatches time bomb to be triggered at a later time
     """
-    # Use the EventBridge client to put a scheduled event
-    client = boto3.client('events', region_name=REGION_NAME)
-    timebomb_id =  str(uuid.uuid4())
-    timebomb_payload["metadata"]["timebomb_id"] = timebomb_id
-    rule_name = f"trigger-lambda-{timebomb_id}"
-    response = client.put_rule(
-        Name=rule_name,
-        ScheduleExpression=f"cron({execution_datetime.minute} {execution_datetime.hour} {execution_datetime.day} {execution_datetime.month} ? {execution_datetime.year})",
-        State='ENABLED',
-    )
+    return _dispatch_timebomb(backends.get_backend(), execution_datetime, timebomb_payload)
 
-    
+def dispatch_timebombs(timebombs, max_workers=TIMEBOMB_WORKERS):
+    """
+    Dispatches many time bombs concurrently
 
-    # Add target to the rule
-    target_response = client.put_targets(
-        Rule=rule_name,
-        Targets=[
-            {
-                'Id': timebomb_id,
-                'Arn': 'arn:aws:lambda:us-west-2:385772193343:function:timebomb',
-                'Input': json.dumps(timebomb_payload)
-            },
-        ]
-    )
+    :param timebombs: List of (execution_datetime, timebomb_payload) tuples
+    :param max_workers: Maximum number of timebombs dispatched at the same time
+    :return: List of TimebombResult(timebomb_id, metadata, error), in the same order as timebombs
+    """
+    backend = backends.get_backend()
+
+    def dispatch(timebomb):
+        execution_datetime, timebomb_payload = timebomb
+        try:
+            metadata = _dispatch_timebomb(backend, execution_datetime, timebomb_payload)
+            return TimebombResult(metadata["timebomb_id"], metadata, None)
+        except Exception as e:
+            print(f"Failed to dispatch timebomb: {e}")
+            return TimebombResult(timebomb_payload["metadata"].get("timebomb_id"), None, e)
 
+    if not timebombs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(timebombs))) as executor:
+        return list(executor.map(dispatch, timebombs))
+
+def reschedule_timebomb(timebomb_metadata, execution_datetime, timebomb_payload):
+    """
+    Moves an existing time bomb to a new execution time, keeping its id
+
+    :param timebomb_metadata: Metadata of the dispatched timebomb
+    :param execution_datetime: New execution time
+    :param timebomb_payload: Payload delivered when the timebomb triggers
+    :return: Updated timebomb metadata
+    """
+    backend = backends.get_backend(_get_backend_name(timebomb_metadata))
+    timebomb_payload["metadata"]["timebomb_id"] = timebomb_metadata["timebomb_id"]
+    _set_backend_name(timebomb_payload["metadata"], backend)
+    backend.reschedule(timebomb_metadata["timebomb_id"], execution_datetime, timebomb_payload)
     return timebomb_payload["metadata"]
 
+def _get_cancel_target(timebomb, backend):
+    # metadata names its backend, plain ids without a backend are EventBridge rules like metadata without one
+    if isinstance(timebomb, dict):
+        return timebomb["timebomb_id"], _get_backend_name(timebomb)
+    if isinstance(timebomb, tuple):
+        return timebomb
+    return timebomb, backend or backends.EventBridgeRuleBackend.name
 
-def cancel_timebomb(timebomb_id):
+def cancel_timebomb(timebomb_id, backend=None):
     """
     Cancels time bomb
+
+    :param timebomb_id: Timebomb id, or the timebomb metadata to cancel it on the backend that dispatched it
+    :param backend: Name of the backend that dispatched a plain timebomb id, defaults to EventBridge
     """
-    client = boto3.client('events', region_name=REGION_NAME)
-    rule_name = f"trigger-lambda-{timebomb_id}"
-    client.remove_targets(
-        Rule=rule_name,
-        Ids=[timebomb_id] 
-    )
-    client.delete_rule(
-        Name=rule_name
-    )
+    timebomb_id, backend = _get_cancel_target(timebomb_id, backend)
+    backends.get_backend(backend).cancel(timebomb_id)
+
+def cancel_timebombs(timebomb_ids, max_workers=TIMEBOMB_WORKERS, backend=None):
+    """
+    Cancels many time bombs concurrently
+
+    :param timebomb_ids: List of timebomb ids, (timebomb_id, backend name) tuples or timebomb metadata
+    :param max_workers: Maximum number of timebombs cancelled at the same time
+    :param backend: Backend name used for plain timebomb ids, defaults to EventBridge
+    :return: List of TimebombResult(timebomb_id, metadata, error), in the same order as timebomb_ids
+    """
+    def cancel(timebomb):
+        timebomb_id, timebomb_backend = _get_cancel_target(timebomb, backend)
+        try:
+            backends.get_backend(timebomb_backend).cancel(timebomb_id)
+            return TimebombResult(timebomb_id, None, None)
+        except Exception as e:
+            print(f"Failed to cancel timebomb {timebomb_id}: {e}")
+            return TimebombResult(timebomb_id, None, e)
+
+    if not timebomb_ids:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(timebomb_ids))) as executor:
+        return list(executor.map(cancel, timebomb_ids))
 
 def clear_timebombs(thread_id, state_data):
     """
     Clears all timebombs associated with a thread
+
+    Active timebombs are cancelled concurrently on the backend that dispatched
+    them, timebombs that could not be cancelled stay ACTIVE.
     """
-    for timebomb_id in state_data["state"]["metadata"]["timebombs"][thread_id]:
-        timebomb = state_data["state"]["metadata"]["timebombs"][thread_id][timebomb_id]
-        if timebomb["status"] == ACTIVE:
-            cancel_timebomb(timebomb["timebomb_id"])
-            state_data["state"]["metadata"]["timebombs"][thread_id][timebomb_id]["status"] = CANCELLED
+    thread_timebombs = state_data["state"]["metadata"]["timebombs"][thread_id]
+    active_keys = [timebomb_key for timebomb_key, timebomb in thread_timebombs.items() if timebomb["status"] == ACTIVE]
+    results = cancel_timebombs([
+        (thread_timebombs[timebomb_key]["timebomb_id"], _get_backend_name(thread_timebombs[timebomb_key]))
+        for timebomb_key in active_keys
+    ])
+    for timebomb_key, result in zip(active_keys, results):
+        if result.error is None:
+            thread_timebombs[timebomb_key]["status"] = CANCELLED
     return state_data
 
 def round_up_to_time(utc_datetime, time_tuple):
@@ -84,10 +152,11 @@ def round_up_to_time(utc_datetime, time_tuple):
     # Return the result in UTC
     return target_datetime.astimezone(pytz.utc)
 
-def set_countdown_timebomb(timebomb_payload, send_time=None, n_hours=24, n_days=0, n_weeks=0, n_months=0, n_years=0, type= None):
+def set_countdown_timebomb(timebomb_payload, send_time=None, n_hours=24, n_days=0, n_weeks=0, n_months=0, n_years=0, type= None, reschedule_metadata=None):
     """
     Sets countdown time bomb
     Send time is the time when the time bomb should be triggered, within the next n_hours, n_days, n_weeks, n_months, or n_years
+    If reschedule_metadata is given, that timebomb is moved to the new trigger time instead of dispatching a new one
     """
     current_datetime = dt.datetime.now()
     # Calculate trigger_time based on send_time and n_hours, n_days, n_weeks, n_months, or n_years
@@ -107,7 +176,10 @@ def set_countdown_timebomb(timebomb_payload, send_time=None, n_hours=24, n_days=
     timebomb_payload["metadata"]["type"] = type
     timebomb_payload["metadata"]["timebomb_id"] = None
 
-    timebomb_metadata = dispatch_timebomb(trigger_datetime, timebomb_payload)
+    if reschedule_metadata is not None:
+        timebomb_metadata = reschedule_timebomb(reschedule_metadata, trigger_datetime, timebomb_payload)
+    else:
+        timebomb_metadata = dispatch_timebomb(trigger_datetime, timebomb_payload)
 
     return timebomb_metadata
 
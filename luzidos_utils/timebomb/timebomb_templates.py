@@ -3,13 +3,26 @@ from luzidos_utils.constants.state import (
 )
 
 from luzidos_utils.timebomb import timebomb
+from luzidos_utils.timebomb.backends import TimebombRescheduleError
+from luzidos_utils.timebomb.timebomb_status import ACTIVE, CANCELLED
 
-def set_1d_followup_timebomb(user_id, invoice_id, state_data, response_type=GENERIC_FOLLOWUP, thread_id= None, context=None):
-    """
-    Sets a 1 day followup timebomb to the focused email thread
-    """
+# coalescing modes for followups set while an ACTIVE followup of the same type exists on the thread
+COALESCE_KEEP = "keep"                # keep the active timebomb if it sends the same followup, else reschedule it
+COALESCE_RESCHEDULE = "reschedule"    # move the active timebomb to the new trigger time and payload
+COALESCE_OFF = None                   # always dispatch a new timebomb
+COALESCE_MODE = COALESCE_KEEP
+
+def _find_active_timebomb(thread_timebombs, timebomb_type):
+    for timebomb_metadata in thread_timebombs.values():
+        if timebomb_metadata["status"] == ACTIVE and timebomb_metadata.get("type") == timebomb_type:
+            return timebomb_metadata
+    return None
+
+def _set_followup_timebomb(user_id, invoice_id, state_data, response_type, thread_id, context, n_hours, timebomb_type, coalesce):
     if thread_id is None:
         thread_id = state_data["state"]["state_data"]["focused_email_thread_id"]
+    thread_timebombs = state_data["state"]["metadata"]["timebombs"].setdefault(thread_id, {})
+
     timebomb_payload = {"state_update": None, "metadata": None}
     timebomb_payload["metadata"] = {
         "user_id": user_id,
@@ -26,48 +39,55 @@ def set_1d_followup_timebomb(user_id, invoice_id, state_data, response_type=GENE
     if context is not None:
         timebomb_payload["state_update"]["state_data"]["context"] = context
 
+    active_timebomb = None
+    if coalesce is not COALESCE_OFF:
+        active_timebomb = _find_active_timebomb(thread_timebombs, timebomb_type)
+    # the active timebomb only covers this followup if it sends the same response type and context,
+    # timebombs set before state updates were recorded are kept as before
+    if (active_timebomb is not None and coalesce == COALESCE_KEEP
+            and active_timebomb.get("state_update", timebomb_payload["state_update"]) == timebomb_payload["state_update"]):
+        return state_data
+
+    try:
+        timebomb_metadata = timebomb.set_countdown_timebomb(
+            timebomb_payload,
+            send_time = (8,0, 'America/Bogota'),
+            n_hours=n_hours,
+            type=timebomb_type,
+            reschedule_metadata=active_timebomb
+        )
+    except TimebombRescheduleError as e:
+        print(e)
+        active_timebomb["status"] = CANCELLED
+        timebomb_payload["metadata"].pop("backend", None)
+        timebomb_metadata = timebomb.set_countdown_timebomb(
+            timebomb_payload,
+            send_time = (8,0, 'America/Bogota'),
+            n_hours=n_hours,
+            type=timebomb_type
+        )
 
-    timebomb_metadata = timebomb.set_countdown_timebomb(
-        timebomb_payload,
-        send_time = (8,0, 'America/Bogota'),
-        n_hours=24,
-        type="1d_followup"
-    )
-    
     timebomb_id = timebomb_metadata["timebomb_id"]
-    state_data["state"]["metadata"]["timebombs"][thread_id][timebomb_id] = timebomb_metadata
+    # kept to tell whether a later followup is the same one
+    thread_timebombs[timebomb_id] = dict(timebomb_metadata, state_update=timebomb_payload["state_update"])
     return state_data
 
-def set_next_day_followup_timebomb(user_id, invoice_id, state_data, response_type=GENERIC_FOLLOWUP, thread_id= None, context=None):
+def set_1d_followup_timebomb(user_id, invoice_id, state_data, response_type=GENERIC_FOLLOWUP, thread_id= None, context=None, coalesce=COALESCE_MODE):
     """
     Sets a 1 day followup timebomb to the focused email thread
+    If the thread already has an ACTIVE 1d_followup timebomb, coalesce decides whether it is kept when it sends the same followup
+    and rescheduled otherwise (COALESCE_KEEP),
+    rescheduled (COALESCE_RESCHEDULE) or a new one is set anyway (COALESCE_OFF)
     """
-    if thread_id is None:
-        thread_id = state_data["state"]["state_data"]["focused_email_thread_id"]
-    timebomb_payload = {"state_update": None, "metadata": None}
-    timebomb_payload["metadata"] = {
-        "user_id": user_id,
-        "invoice_id": invoice_id,
-        "thread_id": thread_id,
-    }
-    timebomb_payload["state_update"] = {
-        "state": SEND_EMAIL, 
-        "state_data": {
-            "focused_email_thread_id": thread_id,
-            "email_response_type": response_type
-        }
-    }
-    if context is not None:
-        timebomb_payload["state_update"]["state_data"]["context"] = context
+    return _set_followup_timebomb(user_id, invoice_id, state_data, response_type, thread_id, context,
+                                  n_hours=24, timebomb_type="1d_followup", coalesce=coalesce)
 
-
-    timebomb_metadata = timebomb.set_countdown_timebomb(
-        timebomb_payload,
-        send_time = (8,0, 'America/Bogota'),
-        n_hours=8,
-        type="next_day_followup"
-    )
-    
-    timebomb_id = timebomb_metadata["timebomb_id"]
-    state_data["state"]["metadata"]["timebombs"][thread_id][timebomb_id] = timebomb_metadata
-    return state_data
\ No newline at end of file
+def set_next_day_followup_timebomb(user_id, invoice_id, state_data, response_type=GENERIC_FOLLOWUP, thread_id= None, context=None, coalesce=COALESCE_MODE):
+    """
+    Sets a 1 day followup timebomb to the focused email thread
+    If the thread already has an ACTIVE next_day_followup timebomb, coalesce decides whether it is kept when it sends the same followup
+    and rescheduled otherwise (COALESCE_KEEP),
+    rescheduled (COALESCE_RESCHEDULE) or a new one is set anyway (COALESCE_OFF)
+    """
+    return _set_followup_timebomb(user_id, invoice_id, state_data, response_type, thread_id, context,
+                                  n_hours=8, timebomb_type="next_day_followup", coalesce=coalesce)
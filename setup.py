@@ -5,9 +5,10 @@ setup(
     version="0.1",
     packages=find_packages(),
     install_requires=[
-        "boto3",
+        # conditional PutObject (IfMatch / IfNoneMatch) used by atomic_update_json
+        "boto3>=1.35.99",
         "datetime",
-        "botocore",
+        "botocore>=1.35.99",
         "google-api-core",
         "google-api-python-client",
         "google-auth",